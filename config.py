@@ -7,6 +7,8 @@ load_dotenv()
 # Bot configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "7628457855:AAH1VSKv9iHJ0xHozGRm6dhSucV91rfGLV8")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///expenses.db")
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")  # Optional replica for read-only queries
+READ_YOUR_WRITES_SECONDS = int(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))  # Reads stay on the writer after a write
 
 # Scheduler configuration
 SCHEDULER_TIMEZONE = "Asia/Jakarta"  # WIB timezone
@@ -24,5 +26,96 @@ DEFAULT_CATEGORIES = [
     "Lainnya"
 ]
 
+# Users whose category list is kept in memory
+CATEGORY_CACHE_SIZE = int(os.getenv("CATEGORY_CACHE_SIZE", "5000"))
+
+# Inline mode autocomplete
+AUTOCOMPLETE_CACHE_USERS = int(os.getenv("AUTOCOMPLETE_CACHE_USERS", "2000"))  # Warm user indexes
+AUTOCOMPLETE_MAX_DESCRIPTIONS = int(os.getenv("AUTOCOMPLETE_MAX_DESCRIPTIONS", "200"))  # Per user
+
+# Expenses per /riwayat page
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
+
 # Currency formatting
-CURRENCY_SYMBOL = "Rp "
\ No newline at end of file
+CURRENCY_SYMBOL = "Rp "
+DEFAULT_CURRENCY = "IDR"  # Expenses without a currency code, exchange rates are quoted in it
+CURRENCY_SYMBOLS = {
+    "IDR": CURRENCY_SYMBOL,
+    "USD": "US$",
+    "SGD": "S$",
+    "MYR": "RM ",
+}
+RATE_CACHE_CHECK_SECONDS = int(os.getenv("RATE_CACHE_CHECK_SECONDS", "60"))  # Rate table version polling
+
+# Update dispatching configuration
+UPDATE_LANES_ENABLED = os.getenv("UPDATE_LANES_ENABLED", "true").lower() == "true"
+UPDATE_MAX_CONCURRENCY = int(os.getenv("UPDATE_MAX_CONCURRENCY", "64"))  # Updates processed at once
+UPDATE_LANE_MAX_DEPTH = int(os.getenv("UPDATE_LANE_MAX_DEPTH", "20"))  # Queued updates per user
+
+# Guided expense flow state
+FLOW_STATE_TTL_MINUTES = int(os.getenv("FLOW_STATE_TTL_MINUTES", "30"))  # Abandoned flows expire
+FLOW_STATE_CACHE_SIZE = int(os.getenv("FLOW_STATE_CACHE_SIZE", "1000"))  # Users kept in memory
+FLOW_STATE_SWEEP_BATCH = int(os.getenv("FLOW_STATE_SWEEP_BATCH", "500"))  # Rows deleted per batch
+FLOW_STATE_SWEEP_INTERVAL_MINUTES = int(os.getenv("FLOW_STATE_SWEEP_INTERVAL_MINUTES", "10"))
+
+# Spending anomaly detection
+SPENDING_STATS_DECAY = float(os.getenv("SPENDING_STATS_DECAY", "0.97"))  # Weight kept by older amounts per new one
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", "3"))  # Standard deviations above typical
+ANOMALY_MIN_SAMPLES = int(os.getenv("ANOMALY_MIN_SAMPLES", "5"))  # Expenses (or days) seen before flagging
+
+# Webhook ingress (polling is used when no webhook URL is known)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or (
+    f"https://{os.getenv('RAILWAY_STATIC_URL')}{WEBHOOK_PATH}" if os.getenv("RAILWAY_STATIC_URL") else ""
+)
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")  # A random one per start if empty
+WEBHOOK_MAX_PENDING_UPDATES = int(os.getenv("WEBHOOK_MAX_PENDING_UPDATES", "1000"))  # 503 beyond this
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Parallel Telegram deliveries
+WEBHOOK_MAX_BODY_BYTES = int(os.getenv("WEBHOOK_MAX_BODY_BYTES", "1048576"))  # 413 beyond this
+
+# Update deduplication (Telegram redelivers webhook updates it got no timely answer for)
+UPDATE_DEDUP_ENABLED = os.getenv("UPDATE_DEDUP_ENABLED", "true").lower() == "true"
+UPDATE_DEDUP_CACHE_SIZE = int(os.getenv("UPDATE_DEDUP_CACHE_SIZE", "10000"))  # Update IDs kept in memory
+UPDATE_DEDUP_RETENTION_HOURS = int(os.getenv("UPDATE_DEDUP_RETENTION_HOURS", "24"))  # Telegram keeps updates 24h
+UPDATE_DEDUP_SWEEP_INTERVAL_MINUTES = int(os.getenv("UPDATE_DEDUP_SWEEP_INTERVAL_MINUTES", "60"))
+
+# Outbound sends (Telegram allows about 30 messages/s per bot and 1/s per chat)
+OUTBOUND_QUEUE_ENABLED = os.getenv("OUTBOUND_QUEUE_ENABLED", "true").lower() == "true"
+OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "30"))
+OUTBOUND_CHAT_RATE_PER_SECOND = float(os.getenv("OUTBOUND_CHAT_RATE_PER_SECOND", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))  # Replies sent back to back before pacing
+OUTBOUND_INTERACTIVE_RESERVE = int(os.getenv("OUTBOUND_INTERACTIVE_RESERVE", "5"))  # Sends broadcasts leave free
+
+# Metrics endpoint
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# No authentication, so only local by default; set 0.0.0.0 to let a scraper on another host in
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Slow update profiler
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "true").lower() == "true"
+PROFILER_THRESHOLD_MS = int(os.getenv("PROFILER_THRESHOLD_MS", "1000"))  # Profile updates slower than this
+PROFILER_SAMPLE_INTERVAL_MS = int(os.getenv("PROFILER_SAMPLE_INTERVAL_MS", "5"))
+PROFILER_RING_SIZE = int(os.getenv("PROFILER_RING_SIZE", "20"))  # Slow update profiles kept
+
+# SQL instrumentation
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", "100"))  # Log queries slower than this
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "3"))  # Identical statements per update
+MAX_QUERIES_PER_UPDATE = int(os.getenv("MAX_QUERIES_PER_UPDATE", "0"))  # Fail updates above this (0 = off)
+
+# Recurring expenses
+RECURRING_HOUR = int(os.getenv("RECURRING_HOUR", "0"))  # Daily materialization job, WIB
+RECURRING_BATCH_SIZE = int(os.getenv("RECURRING_BATCH_SIZE", "1000"))  # Due rules per transaction
+
+# Expense partitioning
+EXPENSE_HOT_YEARS = int(os.getenv("EXPENSE_HOT_YEARS", "2"))  # Years kept in the expenses table
+EXPENSE_ARCHIVE_HOUR = int(os.getenv("EXPENSE_ARCHIVE_HOUR", "3"))  # Daily archive job, WIB
+
+# Month-end spending forecasts
+FORECAST_HOUR = int(os.getenv("FORECAST_HOUR", "2"))  # Nightly batch over all users, WIB
+
+# Global statistics for admins (/stats)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+STATS_FLUSH_MINUTES = int(os.getenv("STATS_FLUSH_MINUTES", "5"))  # Sketches recorded in memory are stored this often
+STATS_RELATIVE_ACCURACY = float(os.getenv("STATS_RELATIVE_ACCURACY", "0.01"))  # Error of the amount percentiles
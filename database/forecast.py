@@ -0,0 +1,187 @@
+import calendar
+import logging
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from sqlalchemy import Float, delete, func, insert, select
+
+from .models import SpendingForecast, User, for_each_shard, get_session
+from .partitions import partitions_for_range
+from .rates import convert_amounts_or_nan
+
+logger = logging.getLogger(__name__)
+
+# Complete months before the forecast month the model learns from; the first of them is
+# the same calendar month a year earlier, which gives the seasonal factor
+HISTORY_MONTHS = 12
+
+# Bounds of the seasonal factor, so one odd month last year can't dominate the forecast
+SEASONAL_RANGE = (0.5, 2.0)
+
+
+def _month_number(day):
+    return day.year * 12 + day.month - 1
+
+
+def project_month_end(totals, to_date, days_elapsed, days_in_month):
+    """Projected month-end totals, one per row of the matrices.
+
+    totals[i, m] and to_date[i, m] are what series i spent in the whole month m and by day
+    days_elapsed of it, for HISTORY_MONTHS past months followed by the forecast month.
+    The rest of the month is expected to cost what it cost in past months (scaled by how
+    the same month last year compared to the year), blended with the current month's pace
+    as the month goes on.
+    """
+    past, past_to_date = totals[:, :HISTORY_MONTHS], to_date[:, :HISTORY_MONTHS]
+    spent = totals[:, HISTORY_MONTHS]
+
+    # Months since the series started, so a new category isn't averaged with empty months
+    active = past > 0
+    started = np.where(active.any(axis=1), active.argmax(axis=1), HISTORY_MONTHS)
+    months = HISTORY_MONTHS - started
+    has_history = months > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        history_rest = np.where(has_history, (past - past_to_date).sum(axis=1) / months, 0.0)
+        seasonal = np.where(
+            started == 0, past[:, 0] / (past.sum(axis=1) / HISTORY_MONTHS), 1.0
+        )
+    seasonal = np.clip(np.nan_to_num(seasonal, nan=1.0), *SEASONAL_RANGE)
+
+    share = days_elapsed / days_in_month
+    pace_rest = spent / days_elapsed * (days_in_month - days_elapsed) if days_elapsed else np.zeros_like(spent)
+    rest = np.where(has_history, share * pace_rest + (1 - share) * history_rest * seasonal, pace_rest)
+    return spent + rest
+
+
+def _shard_rollups(shard, first_day, last_day):
+    """Per user, category, currency and day totals of a shard between the dates"""
+    session = get_session(shard=shard, readonly=True)
+    try:
+        currencies = dict(session.execute(select(User.user_id, User.base_currency)).all())
+        groups = []
+        for table in partitions_for_range(first_day, last_day, shard):
+            groups.extend(session.execute(
+                select(
+                    table.c.user_id, table.c.category, table.c.currency, table.c.date,
+                    func.sum(table.c.amount, type_=Float).label("total"),  # No Decimal per row
+                )
+                .where(table.c.date.between(first_day, last_day))
+                .group_by(table.c.user_id, table.c.category, table.c.currency, table.c.date)
+            ))
+        return currencies, groups
+    finally:
+        session.close()
+
+
+def _refresh_shard(shard, today):
+    month_start = today.replace(day=1)
+    first_month = _month_number(month_start) - HISTORY_MONTHS
+    first_day = date(first_month // 12, first_month % 12 + 1, 1)
+    days_elapsed = today.day - 1  # Whole days of the month so far
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+
+    currencies, groups = _shard_rollups(shard, first_day, today - timedelta(days=1))
+    rows = []
+    if groups:
+        series = {}
+        codes = np.fromiter(
+            (series.setdefault((group.user_id, group.category), len(series)) for group in groups),
+            dtype=np.int64, count=len(groups),
+        )
+        dates = [group.date for group in groups]
+        months = np.fromiter((_month_number(day) for day in dates), dtype=np.int64, count=len(groups)) - first_month
+        days = np.fromiter((day.day for day in dates), dtype=np.int64, count=len(groups))
+
+        # Amounts in each user's base currency, one conversion per base currency
+        targets = np.array([currencies[group.user_id] for group in groups], dtype=object)
+        amounts = np.zeros(len(groups))
+        for target in set(targets):
+            rows_of_target = np.flatnonzero(targets == target)
+            amounts[rows_of_target] = convert_amounts_or_nan(
+                [groups[i].total for i in rows_of_target], [groups[i].currency for i in rows_of_target],
+                [dates[i] for i in rows_of_target], target,
+            )
+        amounts = np.nan_to_num(amounts)  # Currencies without a rate yet count as nothing
+
+        totals = np.zeros((len(series), HISTORY_MONTHS + 1))
+        to_date = np.zeros_like(totals)
+        np.add.at(totals, (codes, months), amounts)
+        by_day = days <= days_elapsed
+        np.add.at(to_date, (codes[by_day], months[by_day]), amounts[by_day])
+        projected = project_month_end(totals, to_date, days_elapsed, days_in_month)
+
+        computed_at = datetime.now()
+        rows = [
+            {
+                "user_id": user_id, "category": category, "month": month_start,
+                "projected": float(value), "currency": currencies[user_id], "computed_at": computed_at,
+            }
+            for (user_id, category), value in zip(series, projected)
+            if value > 0
+        ]
+
+    session = get_session(shard=shard)
+    try:
+        # The whole cache of the shard is replaced in one transaction
+        connection = session.connection()
+        connection.execute(delete(SpendingForecast.__table__))
+        if rows:
+            connection.execute(insert(SpendingForecast.__table__), rows)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error storing spending forecasts on shard {shard}: {str(e)}")
+        raise
+    finally:
+        session.close()
+    return len(rows)
+
+
+def refresh_forecasts(today=None):
+    """Recompute every user's month-end forecast per category, returns how many were stored"""
+    from config import SCHEDULER_TIMEZONE
+    # The job runs at night WIB, when a UTC host's date is still yesterday (last month on the 1st)
+    today = today or datetime.now(ZoneInfo(SCHEDULER_TIMEZONE)).date()
+    stored = sum(for_each_shard(lambda shard: _refresh_shard(shard, today)))
+    logger.info(f"Stored {stored} month-end spending forecasts")
+    return stored
+
+
+def with_spent(forecast, expenses):
+    """Projected totals per category, raised to what the expenses of this month already add up to.
+
+    The cached forecast is from last night, today's expenses may have gone past it.
+    """
+    projected = dict(forecast['categories'])
+    spent = {}
+    for expense in expenses:
+        spent[expense.category] = spent.get(expense.category, 0.0) + float(expense.amount)
+    for category, amount in spent.items():
+        projected[category] = max(projected.get(category, 0.0), amount)
+    return projected
+
+
+def get_month_forecast(telegram_user_id, today=None):
+    """The cached month-end forecast of a user: {'categories': {name: total}, 'total', 'currency'}.
+
+    None when no forecast of the current month in the user's base currency is cached yet.
+    """
+    month_start = (today or date.today()).replace(day=1)
+    session = get_session(telegram_user_id, readonly=True)
+    try:
+        rows = session.execute(
+            select(SpendingForecast.category, SpendingForecast.projected, SpendingForecast.currency)
+            .join(User, User.user_id == SpendingForecast.user_id)
+            .where(
+                User.telegram_user_id == telegram_user_id,
+                SpendingForecast.month == month_start,
+                SpendingForecast.currency == User.base_currency,
+            )
+        ).all()
+    finally:
+        session.close()
+    if not rows:
+        return None
+    categories = {row.category: row.projected for row in rows}
+    return {'categories': categories, 'total': sum(categories.values()), 'currency': rows[0].currency}
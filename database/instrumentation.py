@@ -0,0 +1,122 @@
+import functools
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Statistics of the update (or job) currently executing in this task/thread
+_current_stats = ContextVar("query_stats", default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a query scope runs more statements than it is allowed to"""
+
+
+class QueryStats:
+    """Statements executed within one update or job"""
+
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        self.statements[statement] += 1
+
+    def repeated_statements(self, threshold):
+        """Identical statements executed at least threshold times, likely N+1 patterns"""
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+
+def parameter_shape(parameters, executemany=False):
+    """Describe bound parameters by type only, so values never end up in the log"""
+    if executemany:
+        rows = list(parameters or [])
+        return f"{len(rows)} x {parameter_shape(rows[0]) if rows else '()'}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters or ()) + ")"
+
+
+def attach_query_instrumentation(engine):
+    """Count statements per query scope and log slow queries on an engine"""
+    from config import SLOW_QUERY_MS
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("scope_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["scope_query_started"].pop()
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.record(statement, duration)
+        if duration * 1000 >= SLOW_QUERY_MS:
+            scope = stats.label if stats is not None else "-"
+            logger.warning(
+                f"Slow query ({duration * 1000:.1f} ms, scope {scope}): {' '.join(statement.split())} "
+                f"params {parameter_shape(parameters, executemany)}"
+            )
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute, its start time is dropped here
+        started = context.connection.info.get("scope_query_started") if context.connection is not None else None
+        if started and context.execution_context is not None:
+            started.pop()
+
+
+@contextmanager
+def query_scope(label, max_queries=None):
+    """Collect statistics for the statements executed inside the block.
+
+    Repeated identical statements are logged as likely N+1 patterns. With
+    max_queries set (as tests do), exceeding it raises QueryBudgetExceeded.
+    """
+    from config import N_PLUS_ONE_THRESHOLD
+    from utils.metrics import DB_QUERIES_PER_UPDATE
+
+    stats = QueryStats(label)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+        DB_QUERIES_PER_UPDATE.observe(stats.count, handler=label)
+        for statement, count in stats.repeated_statements(N_PLUS_ONE_THRESHOLD):
+            logger.warning(
+                f"Possible N+1 in {label}: statement ran {count} times: {' '.join(statement.split())[:200]}"
+            )
+    if max_queries is not None and stats.count > max_queries:
+        raise QueryBudgetExceeded(
+            f"{label} ran {stats.count} queries, allowed {max_queries}:\n"
+            + "\n".join(f"{count} x {' '.join(statement.split())}" for statement, count in stats.statements.most_common())
+        )
+
+
+def assert_max_queries(max_queries, label="test"):
+    """Test helper: ``with assert_max_queries(2): ...`` fails if more queries run"""
+    return query_scope(label, max_queries=max_queries)
+
+
+def install_query_tracking(application, max_queries=None):
+    """Give every update processed by the application its own query scope"""
+    from utils.profiler import describe_update
+
+    process_update = application.process_update
+
+    @functools.wraps(process_update)
+    async def tracked_process_update(update):
+        with query_scope(describe_update(update), max_queries=max_queries):
+            await process_update(update)
+
+    application.process_update = tracked_process_update
@@ -1,8 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, DECIMAL, DateTime, Date, ForeignKey, Boolean
+from sqlalchemy import create_engine, event, inspect, Column, Integer, String, DECIMAL, DateTime, Date, Float, ForeignKey, Boolean, Index, LargeBinary, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.schema import CreateIndex
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import parse_qsl
 import os
+import re
+import threading
+import time
+import zlib
 
 Base = declarative_base()
 
@@ -18,6 +26,7 @@ class User(Base):
     is_active = Column(Boolean, default=True)  # For unsubscribing from weekly reports
     weekly_report_enabled = Column(Boolean, default=True)  # Whether to receive weekly reports
     monthly_budget = Column(DECIMAL(10, 2))  # Optional monthly budget
+    base_currency = Column(String(3), nullable=False, default="IDR", server_default="IDR")  # Reports convert to this
     
     expenses = relationship("Expense", back_populates="user")
 
@@ -28,12 +37,18 @@ class Expense(Base):
     expense_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
     amount = Column(DECIMAL(10, 2), nullable=False)
+    currency = Column(String(3), nullable=False, default="IDR", server_default="IDR")  # ISO 4217 code of amount
     category = Column(String(255), nullable=False)
     description = Column(String(500))  # Optional description
     date = Column(Date, default=datetime.now().date())
     created_at = Column(DateTime, default=datetime.now)
     
     user = relationship("User", back_populates="expenses")
+    
+    __table_args__ = (
+        # Date range reports and /riwayat pages are index range scans on one user
+        Index('ix_expenses_user_date_id', 'user_id', 'date', 'expense_id'),
+    )
 
 
 class Category(Base):
@@ -43,6 +58,108 @@ class Category(Base):
     category_name = Column(String(255), nullable=False)
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=True)  # Null for default categories
     is_default = Column(Boolean, default=False)  # True for default categories
+    
+    __table_args__ = (
+        # A user can't have "Kopi" and "kopi" as two different categories
+        Index('ix_categories_user_name_ci', 'user_id', func.lower(category_name), unique=True),
+    )
+
+
+class FlowState(Base):
+    __tablename__ = 'flow_states'
+    
+    # One row per user with an unfinished guided /tambah flow
+    telegram_user_id = Column(Integer, primary_key=True, autoincrement=False)
+    step = Column(Integer, nullable=False)
+    amount = Column(DECIMAL(10, 2))
+    category = Column(String(50))
+    description = Column(String(500))
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class SpendingStat(Base):
+    __tablename__ = 'spending_stats'
+    
+    # Decayed running mean and variance of a user's log amounts per category, updated on
+    # insert; the DAILY_TOTALS row holds the statistics of whole days instead
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    category = Column(String(255), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    weight = Column(Float, nullable=False, default=0.0)
+    mean = Column(Float, nullable=False, default=0.0)
+    m2 = Column(Float, nullable=False, default=0.0)
+    day = Column(Date)  # DAILY_TOTALS only: the last day with spending and its running total
+    day_total = Column(Float)
+
+
+# SpendingStat category of the daily totals row, no real category is empty
+DAILY_TOTALS = ""
+
+
+class SpendingForecast(Base):
+    __tablename__ = 'spending_forecasts'
+    
+    # Projected month-end total per user and category, recomputed for all users nightly
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    category = Column(String(255), primary_key=True)
+    month = Column(Date, nullable=False)  # First day of the month the projection is for
+    projected = Column(Float, nullable=False)
+    currency = Column(String(3), nullable=False)  # The user's base currency at the time
+    computed_at = Column(DateTime, nullable=False)
+
+
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+    
+    # Telegram update IDs already handled, on the shard of the update's user, so a
+    # redelivered webhook update is recognised even after a restart
+    update_id = Column(Integer, primary_key=True, autoincrement=False)
+    received_at = Column(DateTime, nullable=False, index=True)
+
+
+class RecurringExpense(Base):
+    __tablename__ = 'recurring_expenses'
+    
+    rule_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False, index=True)
+    amount = Column(DECIMAL(10, 2), nullable=False)
+    currency = Column(String(3), nullable=False, default="IDR", server_default="IDR")
+    category = Column(String(255), nullable=False)
+    description = Column(String(500))
+    schedule = Column(String(100), nullable=False)  # Cron fields "day month day_of_week"
+    next_run = Column(Date, nullable=False, index=True)  # Due rules are found by seeking on this
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class ExpensePartition(Base):
+    __tablename__ = 'expense_partitions'
+    
+    # One row per closed year whose expenses moved to an archive table
+    year = Column(Integer, primary_key=True, autoincrement=False)
+    table_name = Column(String(50), nullable=False)
+    row_count = Column(Integer, nullable=False, default=0)
+    archived_at = Column(DateTime, default=datetime.now)
+
+
+class ExchangeRate(Base):
+    __tablename__ = 'exchange_rates'
+    
+    # Value of one unit of a currency in rupiah from a date on, loaded from a rates file
+    currency = Column(String(3), primary_key=True)
+    date = Column(Date, primary_key=True)
+    rate = Column(DECIMAL(18, 6), nullable=False)
+    version = Column(Integer, nullable=False, index=True)  # Load that last wrote the row
+
+
+class StatsSketch(Base):
+    __tablename__ = 'stats_sketches'
+    
+    # Mergeable sketches of all users' expenses per day, on shard 0 only: distinct users
+    # (HyperLogLog) and amounts overall and per category (DDSketch), fed by the insert path
+    day = Column(Date, primary_key=True)
+    name = Column(String(255), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
 
 
 def get_database_url():
@@ -51,24 +168,244 @@ def get_database_url():
     return DATABASE_URL
 
 
-def get_engine():
-    """Create and return a database engine"""
-    database_url = get_database_url()
-    return create_engine(database_url)
+def get_read_database_url():
+    """URL of the replica used for read-only queries, empty when reads go to the writer"""
+    from config import DATABASE_READ_URL
+    return DATABASE_READ_URL
+
+
+SHARDED_URL_PREFIX = "sharded+"
+
+
+def parse_sharded_url(url):
+    """Expand 'sharded+sqlite:///expenses.db?shards=4' into the URLs of its shard files.
+
+    Returns None for a regular database URL.
+    """
+    if not url.startswith(SHARDED_URL_PREFIX):
+        return None
+    base_url, _, query = url[len(SHARDED_URL_PREFIX):].partition("?")
+    if not base_url.startswith("sqlite:"):
+        raise ValueError(f"Only SQLite can be sharded: {url}")
+    shards = int(dict(parse_qsl(query)).get("shards", "1"))
+    if shards < 1:
+        raise ValueError(f"Invalid shard count in {url}")
+    root, extension = os.path.splitext(base_url)
+    return [f"{root}.{index}{extension or '.db'}" for index in range(shards)]
+
 
+def shard_for_user(telegram_user_id, shards):
+    """Shard index of a user, a stable hash of the Telegram user ID"""
+    return zlib.crc32(str(telegram_user_id).encode()) % shards
 
-def get_session():
-    """Create and return a database session"""
-    engine = get_engine()
-    Session = sessionmaker(bind=engine)
-    return Session()
+
+_shard_urls = None
+_read_shard_urls = None
+_engines = {}
+_session_factories = {}
+_reader_engines = {}
+_reader_session_factories = {}
+
+# telegram_user_id -> time.monotonic() until which the user's reads stay on the writer
+_recent_writes = OrderedDict()
+_recent_writes_lock = threading.Lock()
+
+
+def get_shard_urls():
+    """Database URL of every shard, a single one unless DATABASE_URL is sharded"""
+    global _shard_urls
+    if _shard_urls is None:
+        url = get_database_url()
+        _shard_urls = parse_sharded_url(url) or [url]
+    return _shard_urls
+
+
+def get_read_shard_urls():
+    """Replica URL of every shard, an empty list when no replica is configured"""
+    global _read_shard_urls
+    if _read_shard_urls is None:
+        url = get_read_database_url()
+        urls = (parse_sharded_url(url) or [url]) if url else []
+        if urls and len(urls) != get_shard_count():
+            raise ValueError("DATABASE_READ_URL must have as many shards as DATABASE_URL")
+        _read_shard_urls = urls
+    return _read_shard_urls
+
+
+def get_shard_count():
+    return len(get_shard_urls())
+
+
+def _create_engine(url):
+    from utils.metrics import attach_engine_metrics
+    from .instrumentation import attach_query_instrumentation
+    engine = create_engine(url)
+    attach_engine_metrics(engine)
+    attach_query_instrumentation(engine)
+    return engine
+
+
+def get_engine(shard=0):
+    """Create the database engine of a shard on first use and return it"""
+    engine = _engines.get(shard)
+    if engine is None:
+        engine = _create_engine(get_shard_urls()[shard])
+        _engines[shard] = engine
+    return engine
+
+
+def get_reader_engine(shard=0):
+    """Create the replica engine of a shard on first use and return it"""
+    engine = _reader_engines.get(shard)
+    if engine is None:
+        engine = _create_engine(get_read_shard_urls()[shard])
+        _reader_engines[shard] = engine
+    return engine
+
+
+def _note_write(session):
+    """after_commit hook of writer sessions: pin the user's reads to the writer for a while"""
+    telegram_user_id = session.info.get("telegram_user_id")
+    if telegram_user_id is None:
+        return
+    from config import READ_YOUR_WRITES_SECONDS
+    now = time.monotonic()
+    with _recent_writes_lock:
+        _recent_writes[telegram_user_id] = now + READ_YOUR_WRITES_SECONDS
+        _recent_writes.move_to_end(telegram_user_id)
+        # Entries are ordered by deadline, so the expired ones are at the front
+        while _recent_writes and next(iter(_recent_writes.values())) <= now:
+            _recent_writes.popitem(last=False)
+
+
+def wrote_recently(telegram_user_id):
+    """Whether the user committed a write within the read-your-writes window"""
+    with _recent_writes_lock:
+        deadline = _recent_writes.get(telegram_user_id)
+    return deadline is not None and deadline > time.monotonic()
+
+
+def get_session(telegram_user_id=None, shard=None, readonly=False):
+    """Create and return a database session on the shard holding the user (shard 0 if none is given).
+
+    With readonly=True the session uses the replica, unless none is configured or the user
+    wrote something within the last READ_YOUR_WRITES_SECONDS.
+    """
+    if shard is None:
+        shard = shard_for_user(telegram_user_id, get_shard_count()) if telegram_user_id is not None else 0
+    
+    if readonly and get_read_shard_urls() and not (telegram_user_id is not None and wrote_recently(telegram_user_id)):
+        session_factory = _reader_session_factories.get(shard)
+        if session_factory is None:
+            session_factory = sessionmaker(
+                bind=get_reader_engine(shard), expire_on_commit=False, info={"shard": shard, "readonly": True}
+            )
+            _reader_session_factories[shard] = session_factory
+        return session_factory()
+    
+    session_factory = _session_factories.get(shard)
+    if session_factory is None:
+        # Handlers read the returned objects after the session is closed, so don't expire them
+        session_factory = sessionmaker(bind=get_engine(shard), expire_on_commit=False, info={"shard": shard})
+        event.listen(session_factory, "after_commit", _note_write)
+        _session_factories[shard] = session_factory
+    session = session_factory()
+    session.info["telegram_user_id"] = telegram_user_id
+    return session
+
+
+def for_each_shard(function):
+    """Call function(shard) for every shard, in parallel when there are several, and return the results"""
+    shards = range(get_shard_count())
+    if len(shards) == 1:
+        return [function(0)]
+    with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="shard") as executor:
+        return list(executor.map(function, shards))
+
+
+def dispose_engine():
+    """Close all connections so the next session uses the currently configured database"""
+    global _shard_urls, _read_shard_urls
+    for engine in list(_engines.values()) + list(_reader_engines.values()):
+        engine.dispose()
+    _engines.clear()
+    _session_factories.clear()
+    _reader_engines.clear()
+    _reader_session_factories.clear()
+    _shard_urls = None
+    _read_shard_urls = None
+    with _recent_writes_lock:
+        _recent_writes.clear()
+    
+    from .partitions import reset_partition_cache
+    from .rates import reset_rate_cache
+    reset_partition_cache()
+    reset_rate_cache()
+
+
+def migrate_categories(engine):
+    """Bring categories created by older versions in line with the case-insensitive index"""
+    with engine.begin() as conn:
+        # Custom categories used to be stored with the Telegram user ID instead of users.user_id
+        conn.execute(text(
+            "UPDATE categories SET user_id = "
+            "(SELECT users.user_id FROM users WHERE users.telegram_user_id = categories.user_id) "
+            "WHERE user_id IS NOT NULL "
+            "AND user_id NOT IN (SELECT user_id FROM users) "
+            "AND user_id IN (SELECT telegram_user_id FROM users)"
+        ))
+        # Keep the oldest of categories that only differ in case
+        conn.execute(text(
+            "DELETE FROM categories WHERE user_id IS NOT NULL AND category_id NOT IN ("
+            "SELECT MIN(category_id) FROM categories WHERE user_id IS NOT NULL "
+            "GROUP BY user_id, lower(category_name))"
+        ))
+        # create_all() skips indexes of tables that already existed
+        for index in Category.__table__.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def add_missing_columns(engine):
+    """Add columns introduced by newer versions to tables that already existed"""
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names()
+    # Archive tables copy the columns of expenses
+    tables = [(name, Expense.__table__) for name in table_names if re.fullmatch(r"expenses_\d{4}", name)]
+    tables += [(table.name, table) for table in Base.metadata.sorted_tables if table.name in table_names]
+    with engine.begin() as conn:
+        for table_name, model_table in tables:
+            existing = {column["name"] for column in inspector.get_columns(table_name)}
+            for column in model_table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" NOT NULL DEFAULT '{column.server_default.arg}'"
+                conn.execute(text(ddl))
 
 
 def initialize_database():
     """Initialize the database with tables"""
-    engine = get_engine()
+    for shard in range(get_shard_count()):
+        initialize_shard(shard)
+
+
+def initialize_shard(shard):
+    """Create the tables and default categories of one shard"""
+    engine = get_engine(shard)
     Base.metadata.create_all(engine)
-    session = get_session()
+    add_missing_columns(engine)
+    migrate_categories(engine)
+    with engine.begin() as conn:
+        # create_all() skips indexes of tables that already existed
+        for index in Expense.__table__.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+    
+    from .search import install_search_index
+    from .partitions import install_archive_search_indexes
+    install_search_index(engine)
+    install_archive_search_indexes(engine)
+    session = get_session(shard=shard)
     
     # Add default categories if they don't exist
     from config import DEFAULT_CATEGORIES
@@ -83,4 +420,4 @@ def initialize_database():
             session.add(default_category)
         session.commit()
     
-    session.close()
\ No newline at end of file
+    session.close()
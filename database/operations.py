@@ -1,14 +1,44 @@
+from sqlalchemy import and_, bindparam, func, insert, select, tuple_, or_, text, update, table as sql_table, column as sql_column
 from sqlalchemy.exc import IntegrityError
-from .models import User, Expense, Category, get_session
+from .models import (
+    User, Expense, Category, FlowState, ProcessedUpdate, RecurringExpense, SpendingStat, DAILY_TOTALS, get_session,
+    for_each_shard, get_shard_count, shard_for_user,
+)
+from .partitions import partitions_for_range
+from .search import SEARCH_TABLE, archive_search_table, build_match_expression, is_search_available, search_words
+from .rates import convert_amounts, convert_amounts_or_nan, convert_expenses
+from .stats import record_expenses
 from datetime import datetime, date, timedelta
 from decimal import Decimal
+from zoneinfo import ZoneInfo
+from collections import OrderedDict
+from utils.metrics import CACHE_REQUESTS, DUPLICATE_UPDATES
+from utils.autocomplete import note_expense, note_category
+from utils.recurrence import due_dates, next_occurrence
+from utils.anomaly import fold, typical_if_unusual
 import logging
+import math
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Bounded write-through cache of guided flow states: telegram_user_id -> tuple or None.
+# Handlers and the scheduler's sweep both change it, so it is only touched under its lock.
+_flow_state_cache = OrderedDict()
+_flow_state_lock = threading.Lock()
+
+# Bounded cache of each user's ordered category names: telegram_user_id -> tuple.
+# Handlers, worker threads and the scheduler's recurring job share it, so it is locked too.
+_category_cache = OrderedDict()
+_category_lock = threading.Lock()
+
+# Bounded set of the most recently claimed update IDs: update_id -> None, under its lock
+_claimed_updates = OrderedDict()
+_claimed_updates_lock = threading.Lock()
+
 def register_user(telegram_user_id, username=None, first_name=None, last_name=None):
     """Register a new user or update existing user info"""
-    session = get_session()
+    session = get_session(telegram_user_id)
     try:
         # Check if user already exists
         user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
@@ -40,9 +70,9 @@ def register_user(telegram_user_id, username=None, first_name=None, last_name=No
         session.close()
 
 
-def add_expense(telegram_user_id, amount, category, description=None):
-    """Add a new expense for a user"""
-    session = get_session()
+def add_expense(telegram_user_id, amount, category, description=None, currency=None):
+    """Add a new expense for a user, in their base currency unless another one is given"""
+    session = get_session(telegram_user_id)
     try:
         # Get user by telegram user ID
         user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
@@ -53,13 +83,17 @@ def add_expense(telegram_user_id, amount, category, description=None):
         expense = Expense(
             user_id=user.user_id,
             amount=Decimal(str(amount)),
+            currency=currency or user.base_currency,
             category=category,
             description=description,
             date=date.today()
         )
         
         session.add(expense)
+        _track_spending(session, user, [expense])
         session.commit()
+        note_expense(telegram_user_id, category, description)
+        record_expenses(telegram_user_id, [expense])
         return expense
     except Exception as e:
         session.rollback()
@@ -69,29 +103,310 @@ def add_expense(telegram_user_id, amount, category, description=None):
         session.close()
 
 
+def add_expenses(telegram_user_id, entries):
+    """Add several (amount, category, description, currency) expenses in one transaction"""
+    session = get_session(telegram_user_id)
+    try:
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if not user:
+            raise ValueError("User not found")
+        
+        today = date.today()
+        rows = [
+            {
+                "user_id": user.user_id,
+                "amount": Decimal(str(amount)),
+                "currency": currency or user.base_currency,
+                "category": category,
+                "description": description,
+                "date": today,
+            }
+            for amount, category, description, currency in entries
+        ]
+        
+        # Returned for the confirmation message, without primary keys
+        expenses = [Expense(**row) for row in rows]
+        _track_spending(session, user, expenses)
+        
+        # One executemany INSERT; the ORM would fall back to a statement per row to fetch ids
+        session.connection().execute(insert(Expense.__table__), rows)
+        session.commit()
+        
+        for expense in expenses:
+            note_expense(telegram_user_id, expense.category, expense.description)
+        record_expenses(telegram_user_id, expenses)
+        return expenses
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error adding {len(entries)} expenses for user {telegram_user_id}: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+
+def _track_spending(session, user, expenses):
+    """Fold new expenses into the user's spending statistics and flag unusual ones.
+
+    Flagged expenses get an ``anomaly`` dict for the confirmation message. Only the
+    statistics rows of the touched categories are read, never the expense history.
+    """
+    from config import SPENDING_STATS_DECAY, ANOMALY_Z_THRESHOLD, ANOMALY_MIN_SAMPLES
+    currency = user.base_currency
+    if all(expense.currency == currency for expense in expenses):
+        amounts = [float(expense.amount) for expense in expenses]
+    else:
+        # Statistics never block an insert: amounts without a rate yet are left out
+        amounts = convert_amounts_or_nan(
+            [expense.amount for expense in expenses], [expense.currency for expense in expenses],
+            [expense.date for expense in expenses], currency
+        )
+    keys = {expense.category for expense in expenses} | {DAILY_TOTALS}
+    stats = {row.category: row for row in session.query(SpendingStat).filter(
+        SpendingStat.user_id == user.user_id, SpendingStat.category.in_(keys)
+    )}
+    for key in keys - stats.keys():
+        stats[key] = SpendingStat(user_id=user.user_id, category=key, count=0, weight=0.0, mean=0.0, m2=0.0)
+        session.add(stats[key])
+    
+    daily = stats[DAILY_TOTALS]
+    for expense, amount in zip(expenses, amounts):
+        expense.anomaly = None
+        if not amount > 0:  # Also skips amounts without an exchange rate yet (NaN)
+            continue
+        category_stats = stats[expense.category]
+        typical = typical_if_unusual(category_stats, amount, ANOMALY_Z_THRESHOLD, ANOMALY_MIN_SAMPLES)
+        if typical is not None:
+            expense.anomaly = {'kind': 'category', 'typical': typical, 'currency': currency}
+        fold(category_stats, amount, SPENDING_STATS_DECAY)
+        
+        if daily.day is not None and expense.date < daily.day:
+            continue  # A recurring expense caught up for a day already folded in
+        # A day's total joins the daily statistics once the next day with spending starts
+        if daily.day != expense.date:
+            if daily.day_total:
+                fold(daily, daily.day_total, SPENDING_STATS_DECAY)
+            daily.day, daily.day_total = expense.date, 0.0
+        previous_total = daily.day_total
+        daily.day_total += amount
+        typical = typical_if_unusual(daily, daily.day_total, ANOMALY_Z_THRESHOLD, ANOMALY_MIN_SAMPLES)
+        # Flagged once, by the expense that pushes the day over the line
+        if typical is not None and expense.anomaly is None and typical_if_unusual(
+            daily, previous_total, ANOMALY_Z_THRESHOLD, ANOMALY_MIN_SAMPLES
+        ) is None:
+            expense.anomaly = {'kind': 'day', 'typical': typical, 'total': daily.day_total, 'currency': currency}
+
+
+def _query_expenses(session, user_id, start_date=None, end_date=None):
+    """Expenses of a user between the dates, read only from the partitions overlapping them"""
+    expenses = []
+    for table in partitions_for_range(start_date, end_date, session.info.get("shard", 0)):
+        query = select(table).where(table.c.user_id == user_id)
+        if start_date:
+            query = query.where(table.c.date >= start_date)
+        if end_date:
+            query = query.where(table.c.date <= end_date)
+        
+        if table is Expense.__table__:
+            expenses.extend(session.scalars(select(Expense).from_statement(query)))
+        else:
+            # Archived rows become transient Expense(**row) objects rather than mapped loads:
+            # their IDs may repeat hot ones, so they must stay outside the identity map
+            expenses.extend(Expense(**row._mapping) for row in session.execute(query))
+    return expenses
+
+
 def get_user_expenses(telegram_user_id, start_date=None, end_date=None):
     """Get expenses for a user within a date range"""
-    session = get_session()
+    session = get_session(telegram_user_id, readonly=True)
     try:
         user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
         if not user:
             return []
         
-        query = session.query(Expense).filter(Expense.user_id == user.user_id)
+        return _query_expenses(session, user.user_id, start_date, end_date)
+    finally:
+        session.close()
+
+
+def get_expense_page(telegram_user_id, cursor=None, newer=False, limit=10):
+    """One page of a user's expenses, newest first, with keyset pagination on (date, expense_id).
+    
+    cursor is the (date, expense_id) the page continues from, newer=True pages towards more
+    recent expenses. Returns (expenses, more) where more tells if the next page in that
+    direction exists.
+    """
+    session = get_session(telegram_user_id, readonly=True)
+    try:
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if not user:
+            return [], False
         
-        if start_date:
-            query = query.filter(Expense.date >= start_date)
-        if end_date:
-            query = query.filter(Expense.date <= end_date)
+        # Years don't overlap between partitions, so they are read in page order until it is full
+        shard = session.info.get("shard", 0)
+        if newer:
+            tables = partitions_for_range(cursor[0] if cursor else None, None, shard)
+        else:
+            tables = partitions_for_range(None, cursor[0] if cursor else None, shard)[::-1]
         
-        return query.all()
+        expenses = []
+        for table in tables:
+            key = tuple_(table.c.date, table.c.expense_id)
+            query = select(table).where(table.c.user_id == user.user_id)
+            if newer:
+                if cursor:
+                    query = query.where(key > tuple_(*cursor))
+                query = query.order_by(table.c.date, table.c.expense_id)
+            else:
+                if cursor:
+                    query = query.where(key < tuple_(*cursor))
+                query = query.order_by(table.c.date.desc(), table.c.expense_id.desc())
+            query = query.limit(limit + 1 - len(expenses))
+            expenses.extend(Expense(**row._mapping) for row in session.execute(query))
+            if len(expenses) > limit:
+                break
+        
+        more = len(expenses) > limit
+        expenses = expenses[:limit]
+        if newer:
+            expenses.reverse()
+        return expenses, more
     finally:
         session.close()
 
 
+def _totals_columns(table):
+    """Count and sum of amounts, grouped by currency and date so they can be converted"""
+    return (
+        table.c.currency, table.c.date,
+        func.count().label("expenses"), func.sum(table.c.amount).label("total"),
+    )
+
+
+def search_expenses(telegram_user_id, query, start_date=None, end_date=None, limit=10):
+    """Find a user's expenses whose description or category contains every word of the query.
+    
+    Returns {'count', 'total', 'currency', 'matches'}: count and total (in the user's base
+    currency) cover every match, matches holds at most limit of them, best ranked first.
+    """
+    result = {'count': 0, 'total': Decimal('0'), 'currency': None, 'matches': []}
+    words = search_words(query)
+    if not words:
+        return result
+    
+    session = get_session(telegram_user_id, readonly=True)
+    try:
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if not user:
+            return result
+        result['currency'] = user.base_currency
+        
+        # Match totals per currency and day, converted together at the end
+        totals = []
+        for table in partitions_for_range(start_date, end_date, session.info.get("shard", 0)):
+            conditions = [table.c.user_id == user.user_id]
+            if start_date:
+                conditions.append(table.c.date >= start_date)
+            if end_date:
+                conditions.append(table.c.date <= end_date)
+            
+            if table is Expense.__table__ and is_search_available(session.get_bind()):
+                # FTS5 index lookup, cost follows the number of matches rather than the table size
+                fts = sql_table(SEARCH_TABLE, sql_column("rowid"), sql_column("rank"))
+                match = text(f"{SEARCH_TABLE} MATCH :match").bindparams(
+                    match=build_match_expression(user.user_id, words)
+                )
+                # IN keeps SQLite from walking all of the user's rows to probe the index
+                totals_query = select(*_totals_columns(table)).where(
+                    *conditions, table.c.expense_id.in_(select(fts.c.rowid).where(match))
+                )
+                matches_query = select(table).select_from(
+                    fts.join(table, table.c.expense_id == fts.c.rowid)
+                ).where(*conditions, match).order_by(fts.c.rank)
+            elif table is not Expense.__table__ and is_search_available(
+                session.get_bind(), archive_search_table(table.name)
+            ):
+                # The archive's own FTS5 index, each match joins back on the archive's primary key
+                fts = sql_table(
+                    archive_search_table(table.name),
+                    sql_column("rank"), sql_column("date"), sql_column("expense_id"),
+                )
+                match = text(f"{fts.name} MATCH :match").bindparams(
+                    match=build_match_expression(user.user_id, words)
+                )
+                matched = fts.join(table, and_(
+                    table.c.user_id == user.user_id,
+                    table.c.date == fts.c.date,
+                    table.c.expense_id == fts.c.expense_id,
+                ))
+                totals_query = select(*_totals_columns(table)).select_from(matched).where(*conditions, match)
+                matches_query = select(table).select_from(matched).where(*conditions, match).order_by(fts.c.rank)
+            else:
+                # Without FTS5, archive tables are clustered by user, so this only scans the user's own rows
+                conditions.extend(
+                    or_(table.c.description.icontains(word, autoescape=True),
+                        table.c.category.icontains(word, autoescape=True))
+                    for word in words
+                )
+                totals_query = select(*_totals_columns(table)).where(*conditions)
+                matches_query = select(table).where(*conditions).order_by(table.c.date.desc())
+            
+            groups = session.execute(totals_query.group_by(table.c.currency, table.c.date)).all()
+            if not groups:
+                continue
+            result['count'] += sum(group.expenses for group in groups)
+            totals.extend(groups)
+            if len(result['matches']) < limit:
+                rows = session.execute(matches_query.limit(limit - len(result['matches'])))
+                result['matches'].extend(Expense(**row._mapping) for row in rows)
+        
+        if totals:
+            converted = convert_amounts(
+                [group.total for group in totals], [group.currency for group in totals],
+                [group.date for group in totals], user.base_currency
+            )
+            result['total'] = Decimal(f"{converted.sum():.2f}")
+        return result
+    finally:
+        session.close()
+
+
+def get_daily_totals(telegram_user_id, start_date, end_date):
+    """Per day and category totals of a user in their base currency, aggregated by the database.
+    
+    Returns {'dates', 'categories', 'totals', 'currency'}: parallel lists of dates and category
+    names and a float array of totals, one entry per (date, category) with expenses.
+    """
+    result = {'dates': [], 'categories': [], 'totals': [], 'currency': None}
+    session = get_session(telegram_user_id, readonly=True)
+    try:
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if not user:
+            return result
+        result['currency'] = user.base_currency
+        
+        groups = []
+        for table in partitions_for_range(start_date, end_date, session.info.get("shard", 0)):
+            groups.extend(session.execute(
+                select(table.c.date, table.c.category, table.c.currency, func.sum(table.c.amount).label("total"))
+                .where(table.c.user_id == user.user_id, table.c.date.between(start_date, end_date))
+                .group_by(table.c.date, table.c.category, table.c.currency)
+            ))
+    finally:
+        session.close()
+    
+    if groups:
+        result['dates'] = [group.date for group in groups]
+        result['categories'] = [group.category for group in groups]
+        result['totals'] = convert_amounts(
+            [group.total for group in groups], [group.currency for group in groups],
+            result['dates'], result['currency']
+        )
+    return result
+
+
 def get_expenses_by_period(telegram_user_id, period):
     """Get expenses for a user by predefined period"""
-    session = get_session()
+    session = get_session(telegram_user_id, readonly=True)
     try:
         user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
         if not user:
@@ -125,20 +440,15 @@ def get_expenses_by_period(telegram_user_id, period):
             except:
                 return []
         
-        expenses = session.query(Expense).filter(
-            Expense.user_id == user.user_id,
-            Expense.date >= start_date,
-            Expense.date <= end_date
-        ).all()
-        
-        return expenses
+        # Reports add up amounts, so every expense is converted to the user's base currency
+        return convert_expenses(_query_expenses(session, user.user_id, start_date, end_date), user.base_currency)
     finally:
         session.close()
 
 
 def get_weekly_expenses_comparison(telegram_user_id):
     """Get current week vs previous week expenses for comparison"""
-    session = get_session()
+    session = get_session(telegram_user_id, readonly=True)
     try:
         user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
         if not user:
@@ -153,17 +463,13 @@ def get_weekly_expenses_comparison(telegram_user_id):
         previous_week_start = current_week_start - timedelta(days=7)
         previous_week_end = current_week_end - timedelta(days=7)
         
-        current_week_expenses = session.query(Expense).filter(
-            Expense.user_id == user.user_id,
-            Expense.date >= current_week_start,
-            Expense.date <= current_week_end
-        ).all()
+        current_week_expenses = convert_expenses(
+            _query_expenses(session, user.user_id, current_week_start, current_week_end), user.base_currency
+        )
         
-        previous_week_expenses = session.query(Expense).filter(
-            Expense.user_id == user.user_id,
-            Expense.date >= previous_week_start,
-            Expense.date <= previous_week_end
-        ).all()
+        previous_week_expenses = convert_expenses(
+            _query_expenses(session, user.user_id, previous_week_start, previous_week_end), user.base_currency
+        )
         
         current_total = sum(expense.amount for expense in current_week_expenses)
         previous_total = sum(expense.amount for expense in previous_week_expenses)
@@ -171,11 +477,13 @@ def get_weekly_expenses_comparison(telegram_user_id):
         return {
             'expenses': current_week_expenses,
             'total': current_total,
+            'currency': user.base_currency,
             'start_date': current_week_start,
             'end_date': current_week_end
         }, {
             'expenses': previous_week_expenses,
             'total': previous_total,
+            'currency': user.base_currency,
             'start_date': previous_week_start,
             'end_date': previous_week_end
         }
@@ -183,36 +491,73 @@ def get_weekly_expenses_comparison(telegram_user_id):
         session.close()
 
 
+def _load_custom_categories(session, telegram_user_id):
+    """Custom category names of a user, oldest first"""
+    return [row[0] for row in session.query(Category.category_name).join(
+        User, Category.user_id == User.user_id
+    ).filter(
+        User.telegram_user_id == telegram_user_id
+    ).order_by(Category.category_id).all()]
+
+
 def get_user_categories(telegram_user_id):
     """Get all categories for a user (both default and custom)"""
-    session = get_session()
+    from config import DEFAULT_CATEGORIES, CATEGORY_CACHE_SIZE
+    
+    with _category_lock:
+        cached = _category_cache.get(telegram_user_id)
+        if cached is not None:
+            _category_cache.move_to_end(telegram_user_id)
+    if cached is not None:
+        CACHE_REQUESTS.inc(cache="categories", result="hit")
+        return list(cached)
+    CACHE_REQUESTS.inc(cache="categories", result="miss")
+    
+    session = get_session(telegram_user_id, readonly=True)
     try:
-        # Get default categories
-        default_categories = session.query(Category).filter(
-            Category.is_default == True
-        ).all()
-        
-        # Get user's custom categories
-        user_categories = session.query(Category).filter(
-            Category.user_id == telegram_user_id
-        ).all()
-        
-        all_categories = [cat.category_name for cat in default_categories]
-        all_categories.extend([cat.category_name for cat in user_categories])
-        
-        return list(set(all_categories))  # Remove duplicates
+        custom_categories = _load_custom_categories(session, telegram_user_id)
     finally:
         session.close()
+    
+    # Defaults come from memory in their configured order, custom ones follow in creation order
+    known = {name.lower() for name in DEFAULT_CATEGORIES}
+    categories = list(DEFAULT_CATEGORIES)
+    for name in custom_categories:
+        if name.lower() not in known:
+            known.add(name.lower())
+            categories.append(name)
+    
+    with _category_lock:
+        _category_cache[telegram_user_id] = tuple(categories)
+        _category_cache.move_to_end(telegram_user_id)
+        while len(_category_cache) > CATEGORY_CACHE_SIZE:
+            _category_cache.popitem(last=False)
+    return categories
+
+
+def resolve_category(telegram_user_id, category_name):
+    """Return the user's existing spelling of a category (case-insensitive), or None"""
+    wanted = category_name.strip().lower()
+    for name in get_user_categories(telegram_user_id):
+        if name.lower() == wanted:
+            return name
+    return None
 
 
 def add_user_category(telegram_user_id, category_name):
     """Add a custom category for a user"""
-    session = get_session()
+    from sqlalchemy import func
+    category_name = category_name.strip()
+    session = get_session(telegram_user_id)
     try:
-        # Check if category already exists for this user
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if not user:
+            raise ValueError("User not found")
+        
+        # Check if category already exists for this user, ignoring case
         existing = session.query(Category).filter(
-            Category.user_id == telegram_user_id,
-            Category.category_name == category_name
+            Category.user_id == user.user_id,
+            func.lower(Category.category_name) == category_name.lower()
         ).first()
         
         if existing:
@@ -221,22 +566,49 @@ def add_user_category(telegram_user_id, category_name):
         # Create new category
         category = Category(
             category_name=category_name,
-            user_id=telegram_user_id
+            user_id=user.user_id
         )
         session.add(category)
         session.commit()
+        note_category(telegram_user_id, category_name)
         return category
+    except IntegrityError:
+        # Added concurrently, the unique index kept a single copy
+        session.rollback()
+        return session.query(Category).filter(
+            Category.user_id == user.user_id,
+            func.lower(Category.category_name) == category_name.lower()
+        ).first()
     except Exception as e:
         session.rollback()
         logger.error(f"Error adding category for user {telegram_user_id}: {str(e)}")
         raise
     finally:
         session.close()
+        with _category_lock:
+            _category_cache.pop(telegram_user_id, None)
+
+
+def get_frequent_descriptions(telegram_user_id, limit=200):
+    """Get a user's most used expense descriptions as (description, count) pairs"""
+    from sqlalchemy import func
+    session = get_session(telegram_user_id, readonly=True)
+    try:
+        return session.query(Expense.description, func.count(Expense.expense_id)).join(
+            User, Expense.user_id == User.user_id
+        ).filter(
+            User.telegram_user_id == telegram_user_id,
+            Expense.description.isnot(None)
+        ).group_by(Expense.description).order_by(
+            func.count(Expense.expense_id).desc()
+        ).limit(limit).all()
+    finally:
+        session.close()
 
 
 def get_user_by_telegram_id(telegram_user_id):
     """Get user by Telegram user ID"""
-    session = get_session()
+    session = get_session(telegram_user_id, readonly=True)
     try:
         return session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
     finally:
@@ -245,7 +617,7 @@ def get_user_by_telegram_id(telegram_user_id):
 
 def update_weekly_report_setting(telegram_user_id, enabled):
     """Update whether user receives weekly reports"""
-    session = get_session()
+    session = get_session(telegram_user_id)
     try:
         user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
         if user:
@@ -263,7 +635,7 @@ def update_weekly_report_setting(telegram_user_id, enabled):
 
 def set_monthly_budget(telegram_user_id, budget_amount):
     """Set monthly budget for a user"""
-    session = get_session()
+    session = get_session(telegram_user_id)
     try:
         user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
         if user:
@@ -279,13 +651,427 @@ def set_monthly_budget(telegram_user_id, budget_amount):
         session.close()
 
 
-def get_users_for_weekly_report():
-    """Get all active users who want to receive weekly reports"""
-    session = get_session()
+def set_base_currency(telegram_user_id, currency):
+    """Set the currency a user's reports are converted to"""
+    session = get_session(telegram_user_id)
+    try:
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if user:
+            if currency != user.base_currency:
+                # The budget and the statistics are in the base currency, converted at today's rate
+                rate = convert_amounts_or_nan([1], [user.base_currency], [date.today()], currency)[0]
+                if user.monthly_budget is not None:
+                    if not rate > 0:
+                        raise ValueError(f"Kurs {user.base_currency} ke {currency} belum tersedia")
+                    user.monthly_budget = Decimal(f"{float(user.monthly_budget) * rate:.2f}")
+                _rebase_spending_stats(session, user, rate)
+            user.base_currency = currency
+            session.commit()
+            return user
+        return None
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error setting base currency for user {telegram_user_id}: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+
+def _rebase_spending_stats(session, user, rate):
+    """Move a user's spending statistics to a new base currency, rate being one old unit in it.
+
+    They are kept over log amounts, so converting is a shift of the means by the log of
+    the rate; without a rate (NaN) they start over.
+    """
+    stats = session.query(SpendingStat).filter(SpendingStat.user_id == user.user_id)
+    if not rate > 0:
+        stats.delete(synchronize_session=False)
+        return
+    for row in stats:
+        if row.count:
+            row.mean += math.log(rate)
+        if row.day_total:
+            row.day_total *= rate
+
+
+def add_recurring_expense(telegram_user_id, schedule, amount, category, description=None, currency=None):
+    """Add a recurring expense rule, its first run is the next matching date after today"""
+    session = get_session(telegram_user_id)
+    try:
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if not user:
+            raise ValueError("User not found")
+        
+        rule = RecurringExpense(
+            user_id=user.user_id,
+            amount=Decimal(str(amount)),
+            currency=currency or user.base_currency,
+            category=category,
+            description=description,
+            schedule=schedule,
+            next_run=next_occurrence(schedule, date.today())
+        )
+        session.add(rule)
+        session.commit()
+        return rule
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error adding recurring expense for user {telegram_user_id}: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+
+def get_recurring_expenses(telegram_user_id):
+    """Get the recurring expense rules of a user, next due first"""
+    session = get_session(telegram_user_id, readonly=True)
+    try:
+        return session.query(RecurringExpense).join(
+            User, RecurringExpense.user_id == User.user_id
+        ).filter(
+            User.telegram_user_id == telegram_user_id
+        ).order_by(RecurringExpense.next_run, RecurringExpense.rule_id).all()
+    finally:
+        session.close()
+
+
+def delete_recurring_expense(telegram_user_id, rule_id):
+    """Delete one of the user's recurring expense rules, returns False if it doesn't exist"""
+    session = get_session(telegram_user_id)
+    try:
+        user = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+        if not user:
+            return False
+        deleted = session.query(RecurringExpense).filter(
+            RecurringExpense.rule_id == rule_id,
+            RecurringExpense.user_id == user.user_id
+        ).delete(synchronize_session=False)
+        session.commit()
+        return deleted > 0
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error deleting recurring expense {rule_id} for user {telegram_user_id}: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+
+def materialize_recurring_expenses(today=None):
+    """Create the expenses of every recurring rule due up to today, returns how many were added"""
+    from config import SCHEDULER_TIMEZONE
+    # The job runs just after midnight WIB, when a UTC host's date is still yesterday
+    today = today or datetime.now(ZoneInfo(SCHEDULER_TIMEZONE)).date()
+    created = sum(for_each_shard(lambda shard: _materialize_recurring_on_shard(shard, today)))
+    if created:
+        logger.info(f"Materialized {created} recurring expenses")
+    return created
+
+
+def _materialize_recurring_on_shard(shard, today):
+    from config import RECURRING_BATCH_SIZE
+    rules_table = RecurringExpense.__table__
+    advance = update(rules_table).where(
+        rules_table.c.rule_id == bindparam("b_rule_id"),
+        rules_table.c.next_run == bindparam("b_next_run")
+    ).values(next_run=bindparam("b_new_next_run"))
+    
+    created = 0
+    while True:
+        session = get_session(shard=shard)
+        try:
+            # Index range scan on next_run, rules that aren't due are never read
+            rules = session.query(RecurringExpense).filter(
+                RecurringExpense.next_run <= today
+            ).order_by(RecurringExpense.next_run).limit(RECURRING_BATCH_SIZE).all()
+            if not rules:
+                return created
+            
+            rows = []
+            advances = []
+            for rule in rules:
+                # Every run missed while the bot was down, up to today
+                for run_date in due_dates(rule.schedule, rule.next_run, today):
+                    rows.append({
+                        "user_id": rule.user_id,
+                        "amount": rule.amount,
+                        "currency": rule.currency,
+                        "category": rule.category,
+                        "description": rule.description,
+                        "date": run_date,
+                    })
+                advances.append({
+                    "b_rule_id": rule.rule_id,
+                    "b_next_run": rule.next_run,
+                    "b_new_next_run": next_occurrence(rule.schedule, today) or date.max,
+                })
+            
+            # next_run moves in the same transaction as the inserts, so running again is a no-op.
+            # The next_run check makes a concurrent run lose the race instead of duplicating.
+            connection = session.connection()
+            if connection.execute(advance, advances).rowcount != len(advances):
+                session.rollback()
+                continue
+            connection.execute(insert(Expense.__table__), rows)
+            
+            # The same hooks as expenses users add themselves, one user at a time
+            by_user = {}
+            for row in sorted(rows, key=lambda row: row["date"]):
+                by_user.setdefault(row["user_id"], []).append(Expense(**row))
+            users = session.query(User).filter(User.user_id.in_(by_user)).all()
+            for user in users:
+                _track_spending(session, user, by_user[user.user_id])
+            session.commit()
+            
+            for user in users:
+                for expense in by_user[user.user_id]:
+                    note_expense(user.telegram_user_id, expense.category, expense.description)
+                record_expenses(user.telegram_user_id, by_user[user.user_id])
+            created += len(rows)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error materializing recurring expenses on shard {shard}: {str(e)}")
+            raise
+        finally:
+            session.close()
+
+
+def _users_for_weekly_report_on_shard(shard):
+    session = get_session(shard=shard, readonly=True)
     try:
         return session.query(User).filter(
             User.is_active == True,
             User.weekly_report_enabled == True
         ).all()
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+
+def get_users_for_weekly_report():
+    """Get all active users who want to receive weekly reports"""
+    # Every shard is queried at the same time, the results are merged in shard order
+    users = []
+    for shard_users in for_each_shard(_users_for_weekly_report_on_shard):
+        users.extend(shard_users)
+    return users
+
+
+def _cache_flow_state(telegram_user_id, state):
+    """Put a flow state tuple (or None for "no flow") in the bounded cache"""
+    from config import FLOW_STATE_CACHE_SIZE
+    with _flow_state_lock:
+        _flow_state_cache[telegram_user_id] = state
+        _flow_state_cache.move_to_end(telegram_user_id)
+        while len(_flow_state_cache) > FLOW_STATE_CACHE_SIZE:
+            _flow_state_cache.popitem(last=False)
+
+
+def get_flow_state(telegram_user_id):
+    """Get the unfinished guided expense flow of a user, or None if there is none"""
+    with _flow_state_lock:
+        cached = telegram_user_id in _flow_state_cache
+        if cached:
+            state = _flow_state_cache[telegram_user_id]
+            _flow_state_cache.move_to_end(telegram_user_id)
+    if cached:
+        CACHE_REQUESTS.inc(cache="flow_state", result="hit")
+    else:
+        CACHE_REQUESTS.inc(cache="flow_state", result="miss")
+        session = get_session(telegram_user_id)
+        try:
+            row = session.get(FlowState, telegram_user_id)
+            state = (row.step, row.amount, row.category, row.description, row.expires_at) if row else None
+        finally:
+            session.close()
+        _cache_flow_state(telegram_user_id, state)
+    
+    if state is None:
+        return None
+    
+    step, amount, category, description, expires_at = state
+    if expires_at < datetime.now():
+        # Expired but not swept yet, treat as abandoned
+        clear_flow_state(telegram_user_id)
+        return None
+    
+    return {
+        'step': step,
+        'amount': amount,
+        'category': category,
+        'description': description
+    }
+
+
+def cached_flow_step(telegram_user_id):
+    """Step of a user's flow if it is in the cache, else None; never reads or writes the database"""
+    with _flow_state_lock:
+        state = _flow_state_cache.get(telegram_user_id)
+    return state[0] if state is not None else None
+
+
+def save_flow_state(telegram_user_id, step, amount=None, category=None, description=None):
+    """Store the guided expense flow of a user and restart its expiry timer"""
+    from config import FLOW_STATE_TTL_MINUTES
+    expires_at = datetime.now() + timedelta(minutes=FLOW_STATE_TTL_MINUTES)
+    session = get_session(telegram_user_id)
+    try:
+        session.merge(FlowState(
+            telegram_user_id=telegram_user_id,
+            step=step,
+            amount=Decimal(str(amount)) if amount is not None else None,
+            category=category,
+            description=description,
+            expires_at=expires_at
+        ))
+        session.commit()
+        _cache_flow_state(telegram_user_id, (step, amount, category, description, expires_at))
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error saving flow state for user {telegram_user_id}: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+
+def clear_flow_state(telegram_user_id):
+    """Remove the guided expense flow of a user"""
+    session = get_session(telegram_user_id)
+    try:
+        session.query(FlowState).filter(FlowState.telegram_user_id == telegram_user_id).delete()
+        session.commit()
+        _cache_flow_state(telegram_user_id, None)
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error clearing flow state for user {telegram_user_id}: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+
+def sweep_expired_flow_states(batch_size=None):
+    """Delete abandoned guided flows in batches and return how many were removed"""
+    from config import FLOW_STATE_SWEEP_BATCH
+    batch_size = batch_size or FLOW_STATE_SWEEP_BATCH
+    now = datetime.now()
+    removed = sum(for_each_shard(lambda shard: _sweep_expired_flow_states_on_shard(shard, batch_size, now)))
+    if removed:
+        logger.info(f"Swept {removed} expired flow states")
+    return removed
+
+
+def claim_update(update_id, telegram_user_id=None):
+    """Record an update as handled, returns False if it was handled before (a redelivery).
+
+    Recent IDs are answered from memory, anything else costs one INSERT on the primary
+    key; a conflict means another process or an earlier run already had the update.
+    """
+    from config import UPDATE_DEDUP_CACHE_SIZE
+    with _claimed_updates_lock:
+        remembered = update_id in _claimed_updates
+        if remembered:
+            _claimed_updates.move_to_end(update_id)
+    if remembered:
+        DUPLICATE_UPDATES.inc(source="memory")
+        return False
+    
+    shard = shard_for_user(telegram_user_id, get_shard_count()) if telegram_user_id is not None else 0
+    # No telegram_user_id on the session: this write must not pin the user's reads to the primary
+    session = get_session(shard=shard)
+    try:
+        session.add(ProcessedUpdate(update_id=update_id, received_at=datetime.now()))
+        session.commit()
+        claimed = True
+    except IntegrityError:
+        session.rollback()
+        DUPLICATE_UPDATES.inc(source="database")
+        claimed = False
+    except Exception as e:
+        # Handling an update twice is better than not handling it at all
+        session.rollback()
+        logger.error(f"Error claiming update {update_id}: {str(e)}")
+        return True
+    finally:
+        session.close()
+    
+    with _claimed_updates_lock:
+        _claimed_updates[update_id] = None
+        _claimed_updates.move_to_end(update_id)
+        while len(_claimed_updates) > UPDATE_DEDUP_CACHE_SIZE:
+            _claimed_updates.popitem(last=False)
+    return claimed
+
+
+def sweep_processed_updates(batch_size=None):
+    """Forget handled update IDs older than the retention window, returns how many were removed"""
+    from config import FLOW_STATE_SWEEP_BATCH, UPDATE_DEDUP_RETENTION_HOURS
+    batch_size = batch_size or FLOW_STATE_SWEEP_BATCH
+    cutoff = datetime.now() - timedelta(hours=UPDATE_DEDUP_RETENTION_HOURS)
+    removed = sum(for_each_shard(lambda shard: _sweep_processed_updates_on_shard(shard, batch_size, cutoff)))
+    if removed:
+        logger.info(f"Swept {removed} processed update IDs")
+    return removed
+
+
+def _sweep_processed_updates_on_shard(shard, batch_size, cutoff):
+    removed = 0
+    session = get_session(shard=shard)
+    try:
+        while True:
+            # Oldest first through the received_at index, in short transactions
+            expired_ids = [row[0] for row in session.query(ProcessedUpdate.update_id).filter(
+                ProcessedUpdate.received_at < cutoff
+            ).order_by(ProcessedUpdate.received_at).limit(batch_size).all()]
+            if not expired_ids:
+                break
+            
+            session.query(ProcessedUpdate).filter(
+                ProcessedUpdate.update_id.in_(expired_ids)
+            ).delete(synchronize_session=False)
+            session.commit()
+            removed += len(expired_ids)
+            
+            if len(expired_ids) < batch_size:
+                break
+        
+        return removed
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error sweeping processed updates on shard {shard}: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+
+def _sweep_expired_flow_states_on_shard(shard, batch_size, now):
+    removed = 0
+    session = get_session(shard=shard)
+    try:
+        while True:
+            # Small batches keep each write transaction short so handlers aren't blocked
+            expired_ids = [row[0] for row in session.query(FlowState.telegram_user_id).filter(
+                FlowState.expires_at < now
+            ).limit(batch_size).all()]
+            if not expired_ids:
+                break
+            
+            # Flows restarted since the SELECT have a new expiry and are kept
+            session.query(FlowState).filter(
+                FlowState.telegram_user_id.in_(expired_ids),
+                FlowState.expires_at < now
+            ).delete(synchronize_session=False)
+            session.commit()
+            
+            with _flow_state_lock:
+                for telegram_user_id in expired_ids:
+                    _flow_state_cache.pop(telegram_user_id, None)  # Kept flows are read back on a miss
+            removed += len(expired_ids)
+            
+            if len(expired_ids) < batch_size:
+                break
+        
+        return removed
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error sweeping expired flow states on shard {shard}: {str(e)}")
+        raise
+    finally:
+        session.close()
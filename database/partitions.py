@@ -0,0 +1,165 @@
+import logging
+import threading
+from datetime import date, datetime
+
+from sqlalchemy import Column, MetaData, PrimaryKeyConstraint, Table, delete, func, insert, inspect, select, text
+
+from .models import Expense, ExpensePartition, for_each_shard, get_engine, get_session
+from .search import SEARCH_TABLE, archive_search_table, build_archive_search_index, is_search_available
+
+logger = logging.getLogger(__name__)
+
+# Archive tables are created by archive_year(), never by Base.metadata.create_all()
+archive_metadata = MetaData()
+
+_archive_tables = {}
+_archived_years = {}  # shard -> frozenset of archived years
+_lock = threading.Lock()
+
+
+def archive_table(year):
+    """Table holding the archived expenses of one closed year"""
+    table = _archive_tables.get(year)
+    if table is None:
+        columns = [
+            Column(column.name, column.type, nullable=column.nullable)
+            for column in Expense.__table__.columns
+        ]
+        # Clustered by user and date (WITHOUT ROWID on SQLite), so a user's range is one contiguous read
+        table = Table(
+            f"expenses_{year}",
+            archive_metadata,
+            *columns,
+            PrimaryKeyConstraint("user_id", "date", "expense_id"),
+            sqlite_with_rowid=False,
+        )
+        _archive_tables[year] = table
+    return table
+
+
+def archived_years(shard=0):
+    """Years whose expenses live in archive tables, loaded once per shard from expense_partitions"""
+    years = _archived_years.get(shard)
+    if years is None:
+        session = get_session(shard=shard)
+        try:
+            years = frozenset(year for (year,) in session.query(ExpensePartition.year))
+        finally:
+            session.close()
+        with _lock:
+            _archived_years[shard] = years
+    return years
+
+
+def reset_partition_cache(shard=None):
+    """Forget the archived years of a shard (all shards by default), e.g. after switching databases"""
+    with _lock:
+        if shard is None:
+            _archived_years.clear()
+        else:
+            _archived_years.pop(shard, None)
+
+
+def partitions_for_range(start_date=None, end_date=None, shard=0):
+    """Tables that can hold expenses between the dates (open ends allowed), oldest first.
+
+    Archive tables are only included when their year overlaps the range, and the hot
+    expenses table only when some year of the range was never archived.
+    """
+    archived = archived_years(shard)
+    first_year = start_date.year if start_date else None
+    last_year = end_date.year if end_date else None
+
+    tables = [
+        archive_table(year)
+        for year in sorted(archived)
+        if (first_year is None or year >= first_year) and (last_year is None or year <= last_year)
+    ]
+    if first_year is None or last_year is None or any(
+        year not in archived for year in range(first_year, last_year + 1)
+    ):
+        tables.append(Expense.__table__)
+    return tables
+
+
+def archive_year(year, shard=0):
+    """Move a closed year's expenses of a shard from the hot table into its archive table"""
+    from config import EXPENSE_HOT_YEARS
+
+    if year > date.today().year - EXPENSE_HOT_YEARS:
+        raise ValueError(f"Year {year} is still kept in the expenses table")
+
+    hot = Expense.__table__
+    table = archive_table(year)
+    column_names = [column.name for column in hot.columns]
+    in_year = hot.c.date.between(date(year, 1, 1), date(year, 12, 31))
+
+    engine = get_engine(shard)
+    searchable = is_search_available(engine)
+    with engine.begin() as conn:
+        table.create(conn, checkfirst=True)
+        # Inserted in primary key order so the archive pages are written sequentially
+        moved = conn.execute(
+            insert(table).from_select(
+                column_names,
+                select(*hot.columns).where(in_year).order_by(hot.c.user_id, hot.c.date, hot.c.expense_id),
+            )
+        ).rowcount
+        conn.execute(delete(hot).where(in_year))
+
+        row_count = conn.execute(select(func.count()).select_from(table)).scalar()
+        partition = {"table_name": table.name, "row_count": row_count, "archived_at": datetime.now()}
+        updated = conn.execute(
+            ExpensePartition.__table__.update().where(ExpensePartition.year == year).values(**partition)
+        ).rowcount
+        if not updated:
+            conn.execute(insert(ExpensePartition.__table__).values(year=year, **partition))
+        if searchable:
+            # /cari looks words up in the archive's own index instead of scanning it
+            build_archive_search_index(conn, table.name)
+
+    if searchable:
+        # Merge away the index entries deleted together with the moved rows
+        with engine.begin() as conn:
+            conn.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')"))
+
+    if engine.dialect.name == "sqlite":
+        # Give the pages freed in the hot table back to the file system
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
+
+    reset_partition_cache(shard)
+    logger.info(f"Archived {moved} expenses of {year} into {table.name} on shard {shard} ({row_count} rows)")
+    return moved
+
+
+def install_archive_search_indexes(engine):
+    """Index archive tables written before archives had a search index of their own"""
+    if not is_search_available(engine):
+        return
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for (table_name,) in conn.execute(select(ExpensePartition.table_name)):
+            if inspector.has_table(table_name) and not inspector.has_table(archive_search_table(table_name)):
+                build_archive_search_index(conn, table_name)
+
+
+def archive_closed_years():
+    """Archive every year that fell out of the hot window and still has rows in the hot table"""
+    return sum(for_each_shard(_archive_closed_years_on_shard))
+
+
+def _archive_closed_years_on_shard(shard):
+    from config import EXPENSE_HOT_YEARS
+
+    last_closed_year = date.today().year - EXPENSE_HOT_YEARS
+    moved = 0
+    while True:
+        session = get_session(shard=shard)
+        try:
+            oldest = session.query(func.min(Expense.date)).scalar()
+        finally:
+            session.close()
+        if oldest is None or oldest.year > last_closed_year:
+            return moved
+        moved += archive_year(oldest.year, shard)
@@ -0,0 +1,179 @@
+import csv
+import logging
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import delete, func, insert, select
+
+from .models import Expense, ExchangeRate, get_session
+
+logger = logging.getLogger(__name__)
+
+# Rate table in memory: version, when the version was last checked, currency -> (date ordinals, rates)
+_cache = {"version": None, "checked": 0.0, "series": {}}
+_lock = threading.Lock()
+
+
+def load_rates(rates):
+    """Store (currency, date, rate) rows as a new version of the rate table, returns the version"""
+    from config import DEFAULT_CURRENCY
+
+    rows = {}
+    for currency, rate_date, rate in rates:
+        currency = currency.strip().upper()
+        if currency == DEFAULT_CURRENCY:
+            continue
+        rows[(currency, rate_date)] = {"currency": currency, "date": rate_date, "rate": Decimal(str(rate))}
+    if not rows:
+        raise ValueError("No exchange rates to load")
+
+    session = get_session(shard=0)
+    try:
+        version = (session.query(func.max(ExchangeRate.version)).scalar() or 0) + 1
+        table = ExchangeRate.__table__
+        connection = session.connection()
+        dates_by_currency = {}
+        for currency, rate_date in rows:
+            dates_by_currency.setdefault(currency, []).append(rate_date)
+        for currency, dates in dates_by_currency.items():
+            connection.execute(delete(table).where(table.c.currency == currency, table.c.date.in_(dates)))
+        connection.execute(insert(table), [{**row, "version": version} for row in rows.values()])
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error loading exchange rates: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+    reset_rate_cache()
+    logger.info(f"Loaded {len(rows)} exchange rates as version {version}")
+    return version
+
+
+def load_rates_file(path):
+    """Load a CSV file with date (YYYY-MM-DD), currency and rate (in rupiah) columns"""
+    with open(path, newline="") as rates_file:
+        rates = [
+            (row["currency"], datetime.strptime(row["date"].strip(), "%Y-%m-%d").date(), row["rate"].strip())
+            for row in csv.DictReader(rates_file)
+        ]
+    return load_rates(rates)
+
+
+def reset_rate_cache():
+    """Drop the rates held in memory, the next conversion reloads them"""
+    global _cache
+    with _lock:
+        _cache = {"version": None, "checked": 0.0, "series": {}}
+
+
+def rate_series():
+    """currency -> (sorted date ordinals, rates) arrays, reloaded only when the table version changes"""
+    global _cache
+    from config import RATE_CACHE_CHECK_SECONDS
+
+    cache = _cache
+    now = time.monotonic()
+    if cache["version"] is not None and now - cache["checked"] < RATE_CACHE_CHECK_SECONDS:
+        return cache["series"]
+
+    session = get_session(shard=0, readonly=True)
+    try:
+        version = session.query(func.max(ExchangeRate.version)).scalar() or 0
+        series = cache["series"]
+        if version != cache["version"]:
+            rows = session.execute(
+                select(ExchangeRate.currency, ExchangeRate.date, ExchangeRate.rate)
+                .order_by(ExchangeRate.currency, ExchangeRate.date)
+            ).all()
+            grouped = {}
+            for currency, rate_date, rate in rows:
+                grouped.setdefault(currency, []).append((rate_date.toordinal(), float(rate)))
+            series = {
+                currency: (np.array([o for o, _ in points], dtype=np.int64), np.array([r for _, r in points]))
+                for currency, points in grouped.items()
+            }
+    finally:
+        session.close()
+
+    with _lock:
+        _cache = {"version": version, "checked": now, "series": series}
+    return series
+
+
+def known_currencies():
+    """Currencies amounts can be converted from and to"""
+    from config import DEFAULT_CURRENCY
+    return {DEFAULT_CURRENCY} | set(rate_series())
+
+
+def _rupiah_rates(currencies, ordinals, series):
+    """Rate of each (currency, date) pair: the latest rate on or before the date, or the earliest one"""
+    from config import DEFAULT_CURRENCY
+
+    rates = np.ones(len(ordinals))
+    for currency in np.unique(currencies):
+        if currency == DEFAULT_CURRENCY:
+            continue
+        if currency not in series:
+            raise ValueError(f"Kurs {currency} belum tersedia")
+        rate_ordinals, currency_rates = series[currency]
+        mask = currencies == currency
+        # As-of join of all the currency's rows at once
+        positions = np.searchsorted(rate_ordinals, ordinals[mask], side="right") - 1
+        rates[mask] = currency_rates[np.maximum(positions, 0)]
+    return rates
+
+
+def convert_amounts(amounts, currencies, dates, target):
+    """Convert amounts in the given currencies on the given dates to the target currency (float array)"""
+    series = rate_series()
+    count = len(amounts)
+    amounts = np.fromiter((float(amount) for amount in amounts), dtype=float, count=count)
+    currencies = np.array(list(currencies), dtype=object)
+    ordinals = np.fromiter((day.toordinal() for day in dates), dtype=np.int64, count=count)
+    in_rupiah = amounts * _rupiah_rates(currencies, ordinals, series)
+    return in_rupiah / _rupiah_rates(np.full(count, target, dtype=object), ordinals, series)
+
+
+def convert_amounts_or_nan(amounts, currencies, dates, target):
+    """Like convert_amounts, but amounts whose currency (or target) has no rate yet become NaN"""
+    from config import DEFAULT_CURRENCY
+
+    known = {DEFAULT_CURRENCY} | set(rate_series())
+    currencies = list(currencies)
+    if target not in known:
+        return np.full(len(currencies), np.nan)
+    convertible = [i for i, currency in enumerate(currencies) if currency in known]
+    converted = np.full(len(currencies), np.nan)
+    if convertible:
+        amounts, dates = list(amounts), list(dates)
+        converted[convertible] = convert_amounts(
+            [amounts[i] for i in convertible], [currencies[i] for i in convertible],
+            [dates[i] for i in convertible], target
+        )
+    return converted
+
+
+def convert_expenses(expenses, target):
+    """Copies of the expenses with amounts converted to the target currency, for reports"""
+    from config import DEFAULT_CURRENCY
+
+    currencies = [expense.currency or DEFAULT_CURRENCY for expense in expenses]
+    if all(currency == target for currency in currencies):
+        return expenses
+
+    amounts = convert_amounts(
+        [expense.amount for expense in expenses], currencies, [expense.date for expense in expenses], target
+    )
+    columns = [column.name for column in Expense.__table__.columns]
+    converted = []
+    for expense, amount in zip(expenses, amounts):
+        values = {name: getattr(expense, name) for name in columns}
+        values.update(amount=Decimal(f"{amount:.2f}"), currency=target)
+        converted.append(Expense(**values))
+    return converted
@@ -0,0 +1,109 @@
+import logging
+import re
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = "expenses_fts"
+
+# External content table over expenses: the index holds tokens only, rows stay in expenses.
+# user_id is indexed too, so a query only intersects the doclists of one user's rows.
+CREATE_SEARCH_TABLE = (
+    f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+    "description, category, user_id, "
+    "content='expenses', content_rowid='expense_id', "
+    "tokenize='unicode61 remove_diacritics 2')"
+)
+
+SEARCH_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON expenses BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, description, category, user_id)
+        VALUES (new.expense_id, new.description, new.category, new.user_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON expenses BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, description, category, user_id)
+        VALUES ('delete', old.expense_id, old.description, old.category, old.user_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE ON expenses BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, description, category, user_id)
+        VALUES ('delete', old.expense_id, old.description, old.category, old.user_id);
+        INSERT INTO {SEARCH_TABLE}(rowid, description, category, user_id)
+        VALUES (new.expense_id, new.description, new.category, new.user_id);
+    END""",
+]
+
+# Archive tables never change once written, so their index is a plain FTS5 table filled from
+# the archive in one go. expense_id repeats across shards (a rebalance keeps archived IDs), so
+# it is a column next to user_id and date rather than the rowid; the three are the archive's key.
+CREATE_ARCHIVE_SEARCH_TABLE = (
+    "CREATE VIRTUAL TABLE {name} USING fts5("
+    "description, category, user_id, date UNINDEXED, expense_id UNINDEXED, "
+    "tokenize='unicode61 remove_diacritics 2')"
+)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# (database URL, table) -> whether the FTS5 index exists
+_available = {}
+
+
+def install_search_index(engine):
+    """Create the FTS5 index of expenses and its triggers, returns False where FTS5 is unavailable"""
+    _available.pop((str(engine.url), SEARCH_TABLE), None)
+    if engine.dialect.name != "sqlite":
+        return False
+    with engine.begin() as conn:
+        if inspect(conn).has_table(SEARCH_TABLE):
+            created = False
+        else:
+            try:
+                conn.execute(text(CREATE_SEARCH_TABLE))
+            except Exception as e:
+                logger.warning(f"FTS5 is not available, /cari falls back to LIKE: {str(e)}")
+                return False
+            created = True
+        for trigger in SEARCH_TRIGGERS:
+            conn.execute(text(trigger))
+        if created:
+            # Index the expenses written before the search table existed
+            conn.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"))
+    return True
+
+
+def is_search_available(engine, search_table=SEARCH_TABLE):
+    """Whether an FTS5 index (of the hot expenses by default) exists in the engine's database"""
+    key = (str(engine.url), search_table)
+    if key not in _available:
+        _available[key] = engine.dialect.name == "sqlite" and inspect(engine).has_table(search_table)
+    return _available[key]
+
+
+def archive_search_table(table_name):
+    """Name of the FTS5 index of an archive table"""
+    return f"{table_name}_fts"
+
+
+def build_archive_search_index(conn, table_name):
+    """(Re)create the FTS5 index of an archive table from its current rows"""
+    name = archive_search_table(table_name)
+    conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+    conn.execute(text(CREATE_ARCHIVE_SEARCH_TABLE.format(name=name)))
+    conn.execute(text(
+        f"INSERT INTO {name}(description, category, user_id, date, expense_id) "
+        f"SELECT description, category, user_id, date, expense_id FROM {table_name} "
+        "ORDER BY user_id"
+    ))
+    conn.execute(text(f"INSERT INTO {name}({name}) VALUES ('optimize')"))
+    _available.pop((str(conn.engine.url), name), None)
+
+
+def search_words(query):
+    """Lowercased words of a search query"""
+    return [word.lower() for word in _WORD_RE.findall(query)]
+
+
+def build_match_expression(user_id, words):
+    """FTS5 MATCH expression: the user's rows whose description or category has every word as a prefix"""
+    terms = " AND ".join(f'{{description category}} : "{word}"*' for word in words)
+    return f'user_id : "{int(user_id)}" AND {terms}'
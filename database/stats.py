@@ -0,0 +1,178 @@
+import logging
+import threading
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select
+
+from .models import StatsSketch, get_session
+from .rates import convert_amounts_or_nan
+from utils.sketches import DDSketch, HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+# Sketch names of a day: distinct users, all amounts, and amounts per category
+USERS = "users"
+AMOUNTS = "amounts"
+CATEGORY_PREFIX = "category:"
+# User-defined categories are too many to keep apart, they share one distribution
+CUSTOM_CATEGORIES = "Kategori sendiri"
+
+_pending = {}  # day -> {name: sketch} recorded since the last flush
+_lock = threading.Lock()
+
+
+def _new_sketch(name):
+    from config import STATS_RELATIVE_ACCURACY
+    return HyperLogLog() if name == USERS else DDSketch(STATS_RELATIVE_ACCURACY)
+
+
+def _load_sketch(name, data):
+    return HyperLogLog.from_bytes(data) if name == USERS else DDSketch.from_bytes(data)
+
+
+def _category_name(category):
+    from config import DEFAULT_CATEGORIES
+    for default in DEFAULT_CATEGORIES:
+        if default.lower() == category.lower():
+            return CATEGORY_PREFIX + default
+    return CATEGORY_PREFIX + CUSTOM_CATEGORIES
+
+
+def record_expenses(telegram_user_id, expenses):
+    """Add committed expenses to the global sketches of their day, in memory until flush_stats().
+
+    Amounts are counted in DEFAULT_CURRENCY so they add up across users. Never raises:
+    statistics must not fail an expense that is already stored.
+    """
+    from config import DEFAULT_CURRENCY
+    try:
+        if all(expense.currency == DEFAULT_CURRENCY for expense in expenses):
+            amounts = [float(expense.amount) for expense in expenses]
+        else:
+            amounts = convert_amounts_or_nan(
+                [expense.amount for expense in expenses], [expense.currency for expense in expenses],
+                [expense.date for expense in expenses], DEFAULT_CURRENCY
+            )
+        with _lock:
+            for expense, amount in zip(expenses, amounts):
+                sketches = _pending.setdefault(expense.date, {})
+                sketches.setdefault(USERS, _new_sketch(USERS)).add(telegram_user_id)
+                if not amount >= 0:  # No exchange rate yet (NaN), only the user is counted
+                    continue
+                # Created only with an amount, an empty distribution has no quantiles
+                for name in (AMOUNTS, _category_name(expense.category)):
+                    if name not in sketches:
+                        sketches[name] = _new_sketch(name)
+                    sketches[name].add(amount)
+    except Exception as e:
+        logger.warning(f"Could not record global statistics of user {telegram_user_id}: {str(e)}")
+
+
+def _requeue(pending):
+    """Merge sketches that could not be stored back into the ones recorded meanwhile"""
+    with _lock:
+        for day, sketches in pending.items():
+            current = _pending.setdefault(day, {})
+            for name, sketch in sketches.items():
+                current[name] = sketch.merge(current[name]) if name in current else sketch
+
+
+def flush_stats():
+    """Merge the sketches recorded since the last flush into the stored ones, returns rows written"""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return 0
+
+    written = 0
+    session = get_session(shard=0)
+    try:
+        # Each stored sketch is read, merged and written back, so bot processes flushing at the
+        # same time must not interleave: the rows are locked (SELECT ... FOR UPDATE), and on
+        # SQLite, which ignores FOR UPDATE, the write lock is taken before the first read
+        connection = session.connection()
+        if connection.dialect.name == "sqlite":
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+        now = datetime.now()
+        for day, sketches in pending.items():
+            stored = {row.name: row for row in session.scalars(
+                select(StatsSketch)
+                .where(StatsSketch.day == day, StatsSketch.name.in_(sketches))
+                .with_for_update()
+            )}
+            for name, sketch in sketches.items():
+                row = stored.get(name)
+                if row is None:
+                    session.add(StatsSketch(day=day, name=name, data=sketch.to_bytes(), updated_at=now))
+                else:
+                    row.data = _load_sketch(name, row.data).merge(sketch).to_bytes()
+                    row.updated_at = now
+                written += 1
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error storing global statistics: {str(e)}")
+        _requeue(pending)
+        return 0
+    finally:
+        session.close()
+    logger.info(f"Stored {written} global statistics sketches")
+    return written
+
+
+def _merged(sketches_by_day, name, first_day):
+    merged = _new_sketch(name)
+    for day, sketches in sketches_by_day.items():
+        if day >= first_day and name in sketches:
+            merged.merge(sketches[name])
+    return merged
+
+
+def get_global_stats(days=30, today=None):
+    """Statistics of all users over the last days, from the stored and not yet flushed sketches.
+
+    Returns {'users': {'today', 'week', 'period'} distinct user counts, 'today' and 'period'
+    amount sketches, 'categories': {name: amount sketch of the period}, 'days', 'currency'}.
+    """
+    from config import DEFAULT_CURRENCY
+    today = today or date.today()
+    first_day = today - timedelta(days=days - 1)
+
+    sketches_by_day = {}
+    session = get_session(shard=0, readonly=True)
+    try:
+        for row in session.execute(
+            select(StatsSketch.day, StatsSketch.name, StatsSketch.data)
+            .where(StatsSketch.day.between(first_day, today))
+        ):
+            sketches_by_day.setdefault(row.day, {})[row.name] = _load_sketch(row.name, row.data)
+    finally:
+        session.close()
+
+    with _lock:
+        for day, sketches in _pending.items():
+            if not first_day <= day <= today:
+                continue
+            stored = sketches_by_day.setdefault(day, {})
+            for name, sketch in sketches.items():
+                # Copied, the pending sketch keeps collecting until it is flushed
+                copy = _new_sketch(name).merge(sketch)
+                stored[name] = stored[name].merge(copy) if name in stored else copy
+
+    names = {name for sketches in sketches_by_day.values() for name in sketches}
+    return {
+        'users': {
+            'today': _merged(sketches_by_day, USERS, today).count(),
+            'week': _merged(sketches_by_day, USERS, today - timedelta(days=min(days, 7) - 1)).count(),
+            'period': _merged(sketches_by_day, USERS, first_day).count(),
+        },
+        'today': _merged(sketches_by_day, AMOUNTS, today),
+        'period': _merged(sketches_by_day, AMOUNTS, first_day),
+        'categories': {
+            name[len(CATEGORY_PREFIX):]: _merged(sketches_by_day, name, first_day)
+            for name in names if name.startswith(CATEGORY_PREFIX)
+        },
+        'days': days,
+        'currency': DEFAULT_CURRENCY,
+    }
@@ -0,0 +1,38 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from database.operations import get_user_by_telegram_id, set_base_currency
+from database.rates import known_currencies
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def currency_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /matauang command - show or change the currency reports are converted to"""
+    telegram_user_id = update.effective_user.id
+    try:
+        currencies = sorted(known_currencies())
+        if not context.args:
+            user = get_user_by_telegram_id(telegram_user_id)
+            base_currency = user.base_currency if user else currencies[0]
+            await update.message.reply_text(
+                f"💱 Mata uang laporan: {base_currency}\n"
+                f"Tersedia: {', '.join(currencies)}\n\n"
+                "Ganti dengan /matauang [kode], contoh: /matauang SGD\n"
+                "Catat dalam mata uang lain dengan /tambah 12.5usd makan kopi"
+            )
+            return
+
+        currency = context.args[0].upper()
+        if currency not in currencies:
+            await update.message.reply_text(
+                f"❌ Kurs {currency} belum tersedia. Tersedia: {', '.join(currencies)}"
+            )
+            return
+        if not set_base_currency(telegram_user_id, currency):
+            await update.message.reply_text("❌ Ketik /start terlebih dahulu.")
+            return
+        await update.message.reply_text(f"✅ Laporan sekarang dalam {currency}.")
+    except Exception as e:
+        logger.error(f"Error handling currency: {str(e)}")
+        await update.message.reply_text(f"❌ Error occurred while changing currency: {str(e)}")
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.ext._application import _STOP_SIGNAL
+
+logger = logging.getLogger(__name__)
+
+
+def get_lane_key(update):
+    """Return the key of the lane an update must be serialized on (None if it has no owner)"""
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class LaneApplication(Application):
+    """Application that handles different users in parallel but each user's updates in order.
+
+    Every user gets a lane (a FIFO of pending updates) that is drained by a single task, so
+    handlers relying on per-user state such as the guided /tambah flow never run concurrently
+    for the same user. A global semaphore caps how many updates are processed at once and a
+    lane refuses new updates once it holds ``lane_max_depth`` of them.
+    """
+
+    def __init__(self, max_concurrency=64, lane_max_depth=20, **kwargs):
+        super().__init__(**kwargs)
+        self.max_concurrency = max_concurrency
+        self.lane_max_depth = lane_max_depth
+        self.dropped_updates = 0
+        self._lanes = {}
+        self._lane_semaphore = None
+
+    def accepts_update(self, update):
+        """Whether the lane of an update still has room, checked by the webhook before queueing"""
+        lane = self._lanes.get(get_lane_key(update))
+        return lane is None or len(lane) < self.lane_max_depth
+
+    @property
+    def concurrent_updates(self):
+        return self.max_concurrency
+
+    @property
+    def active_lanes(self):
+        """Number of users that currently have updates queued or in progress"""
+        return len(self._lanes)
+
+    @property
+    def lane_depth(self):
+        """Number of updates queued or in progress across all lanes"""
+        return sum(len(lane) for lane in self._lanes.values())
+
+    async def _update_fetcher(self):
+        # Same contract as Application._update_fetcher, but updates are handed over to lanes
+        self._lane_semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        while True:
+            try:
+                update = await self.update_queue.get()
+
+                if update is _STOP_SIGNAL:
+                    logger.debug("Dropping pending updates")
+                    while not self.update_queue.empty():
+                        self.update_queue.task_done()
+
+                    # For the _STOP_SIGNAL
+                    self.update_queue.task_done()
+                    return
+
+                self._dispatch_to_lane(update)
+            except asyncio.CancelledError:
+                logger.warning(
+                    "Fetching updates got a asyncio.CancelledError. Ignoring as this task may only "
+                    "be closed via `Application.stop`."
+                )
+
+    def _dispatch_to_lane(self, update):
+        """Append an update to its lane, starting a worker if the lane was idle"""
+        key = get_lane_key(update)
+        if key is None:
+            # Nothing to keep in order with, just respect the global cap
+            self.create_task(self._process_in_lane(update))
+            return
+
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = deque([update])
+            self._lanes[key] = lane
+            self.create_task(self._run_lane(key, lane))
+            return
+
+        if len(lane) >= self.lane_max_depth:
+            # Webhook deliveries are refused before this point, so these are polled updates or
+            # deliveries that were still in the update queue when the lane filled up
+            self.dropped_updates += 1
+            logger.warning(
+                f"Lane of user {key} is full ({len(lane)} updates), dropping update {update.update_id}"
+            )
+            self.update_queue.task_done()
+            return
+
+        lane.append(update)
+
+    async def _run_lane(self, key, lane):
+        """Process the updates of a single lane one after another until it is empty"""
+        while lane:
+            await self._process_in_lane(lane[0])
+            lane.popleft()
+        # No await between the emptiness check and this line, so no update can slip in
+        del self._lanes[key]
+
+    async def _process_in_lane(self, update):
+        try:
+            async with self._lane_semaphore:
+                await self.process_update(update)
+        except Exception as e:
+            # Handler errors are dispatched by process_update, this only catches framework errors
+            logger.error(f"Error processing update in lane: {str(e)}")
+        finally:
+            self.update_queue.task_done()
@@ -1,16 +1,51 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from database.operations import add_expense, get_user_categories, add_user_category
-from utils.validators import validate_amount, validate_category
-from utils.formatters import format_expense_message
+from database.operations import (
+    add_expense,
+    add_expenses,
+    get_user_categories,
+    add_user_category,
+    resolve_category,
+    get_flow_state,
+    cached_flow_step,
+    save_flow_state,
+    clear_flow_state,
+)
+from utils.validators import validate_amount, validate_category, parse_expense_lines
+from utils.formatters import format_expense_message, format_expense_batch_message
 import logging
 from telegram.ext import ConversationHandler
-CATEGORY, AMOUNT = range(2)
+CATEGORY, AMOUNT, DESCRIPTION, CONFIRM = range(4)
 
 logger = logging.getLogger(__name__)
 
-# State constants for guided input
-GUIDED_AMOUNT, GUIDED_CATEGORY, GUIDED_DESCRIPTION = range(3)
+# State constants for guided input, stored as the step of the user's flow state
+GUIDED_AMOUNT, GUIDED_CATEGORY, GUIDED_DESCRIPTION, GUIDED_CONFIRM = range(4)
+
+
+GUIDED_STEP_NAMES = {
+    GUIDED_AMOUNT: "guided_amount",
+    GUIDED_CATEGORY: "guided_category",
+    GUIDED_DESCRIPTION: "guided_description",
+    GUIDED_CONFIRM: "guided_confirm",
+}
+
+
+def guided_step_name(update: Update):
+    """Name of the guided flow step a text message answers, used to label metrics.
+
+    Only the cache is consulted, labelling a metric must not cost a query.
+    """
+    step = cached_flow_step(update.effective_user.id)
+    return GUIDED_STEP_NAMES.get(step, "guided_amount")
+
+
+async def start_guided_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start the guided expense flow for /tambah without arguments"""
+    save_flow_state(update.effective_user.id, GUIDED_AMOUNT)
+    await update.message.reply_text(
+        "Masukkan jumlah pengeluaran (contoh: 50000 makan):"
+    )
 
 
 async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -18,6 +53,12 @@ async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     telegram_user_id = user.id
     
+    # Later steps of the guided flow are handled by add_expense_command
+    flow_state = get_flow_state(telegram_user_id)
+    if flow_state and flow_state['step'] in (GUIDED_CATEGORY, GUIDED_DESCRIPTION):
+        await add_expense_command(update, context)
+        return
+    
     try:
         amount_str = update.message.text
         amount, error = validate_amount(amount_str)
@@ -26,18 +67,6 @@ async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ {error}. Please enter a valid amount (e.g., 50000):")
             return
         
-        # Validate that this is actually a number the user entered (not a command)
-        try:
-            float(amount_str)
-        except ValueError:
-            await update.message.reply_text("❌ Please enter a valid amount (e.g., 50000):")
-            return
-        
-        # Store amount in user context
-        if 'guided_expense' not in context.user_data:
-            context.user_data['guided_expense'] = {}
-        context.user_data['guided_expense']['amount'] = amount
-        
         # Get user's available categories
         categories = get_user_categories(telegram_user_id)
         
@@ -52,8 +81,7 @@ async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # We'll handle the category input using a different approach since we're not using ConversationHandler
         # The next message from the user will be handled as category input
-        # This requires setting state in the user context
-        context.user_data['awaiting_category'] = True
+        save_flow_state(telegram_user_id, GUIDED_CATEGORY, amount=amount)
         
     except Exception as e:
         logger.error(f"Error receiving amount: {str(e)}")
@@ -65,8 +93,11 @@ async def add_expense_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     user = update.effective_user
     telegram_user_id = user.id
     
+    # Plain text messages (no command arguments) may continue the guided flow
+    flow_state = get_flow_state(telegram_user_id) if not context.args else None
+    
     # Check if we're awaiting category input for guided flow
-    if context.user_data.get('awaiting_category'):
+    if flow_state and flow_state['step'] == GUIDED_CATEGORY:
         # This is category input for guided flow
         category = update.message.text.strip()
         
@@ -76,33 +107,28 @@ async def add_expense_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text(f"❌ {error}")
             return
         
-        # Store category in user context
-        context.user_data['guided_expense']['category'] = category
+        # Store category and set state to awaiting description
+        save_flow_state(telegram_user_id, GUIDED_DESCRIPTION, amount=flow_state['amount'], category=category)
         await update.message.reply_text("Masukkan deskripsi (opsional):")
-        
-        # Set state to awaiting description
-        context.user_data['awaiting_category'] = False
-        context.user_data['awaiting_description'] = True
         return
     
     # Check if we're awaiting description input for guided flow
-    elif context.user_data.get('awaiting_description'):
-        # This is description input for guided flow
+    elif flow_state and flow_state['step'] == GUIDED_DESCRIPTION:
+        # This is description input for guided flow, which completes the expense
         description = update.message.text.strip()
-        
-        # Store description in user context and complete the expense
-        context.user_data['guided_expense']['description'] = description if description.lower() != 'skip' else None
+        description = description if description.lower() != 'skip' else None
         
         # Get stored amount and category
-        amount = context.user_data['guided_expense'].get('amount')
-        category = context.user_data['guided_expense'].get('category')
-        description = context.user_data['guided_expense']['description']
+        amount = flow_state['amount']
+        category = flow_state['category']
         
         try:
-            # Add new category if it doesn't exist for this user
-            categories = get_user_categories(telegram_user_id)
-            if category not in categories:
-                add_user_category(telegram_user_id, category)
+            # Reuse the existing spelling of the category, or add it for this user
+            existing_category = resolve_category(telegram_user_id, category)
+            if existing_category:
+                category = existing_category
+            else:
+                category = add_user_category(telegram_user_id, category).category_name
             
             # Add expense to database
             expense = add_expense(telegram_user_id, amount, category, description)
@@ -115,43 +141,42 @@ async def add_expense_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             logger.error(f"Error saving guided expense: {str(e)}")
             await update.message.reply_text(f"❌ Error occurred while saving expense: {str(e)}")
         finally:
-            # Clear user data
-            context.user_data.clear()
+            # Clear the finished flow
+            clear_flow_state(telegram_user_id)
         
         return
     
-    # If arguments are provided, add expense directly
+    # If arguments are provided, add expenses directly (one per line)
     if context.args:
-        if len(context.args) < 2:
+        # context.args loses the line breaks, so parse the raw message text
+        parts = update.message.text.split(maxsplit=1)
+        entries, errors = parse_expense_lines(parts[1] if len(parts) > 1 else "")
+        if errors or not entries:
+            details = "\n".join(f"Baris {line_number}: {error}" for line_number, error in errors)
             await update.message.reply_text(
-                "❌ Usage: /tambah [amount] [category] [description?]\n"
-                "Example: /tambah 50000 makan 'makan siang'"
+                (f"❌ {details}\n\n" if details else "")
+                + "❌ Usage: /tambah [amount] [category] [description?]\n"
+                "Example: /tambah 50rb makan 'makan siang'\n"
+                "Mata uang lain: /tambah 12.5usd makan kopi\n"
+                "Satu pengeluaran per baris untuk mencatat beberapa sekaligus."
             )
             return
         
-        # Parse arguments
         try:
-            amount_str = context.args[0]
-            category = context.args[1]
-            description = " ".join(context.args[2:]) if len(context.args) > 2 else None
-            
-            # Validate amount
-            amount, error = validate_amount(amount_str)
-            if error:
-                await update.message.reply_text(f"❌ {error}")
-                return
-            
-            # Validate category
-            is_valid, error = validate_category(category)
-            if not is_valid:
-                await update.message.reply_text(f"❌ {error}")
-                return
+            # Reuse the existing spelling of known categories
+            entries = [
+                (amount, resolve_category(telegram_user_id, category) or category, description, currency)
+                for amount, category, description, currency in entries
+            ]
             
-            # Add expense to database
-            expense = add_expense(telegram_user_id, amount, category, description)
+            # All expenses of the message go in with one insert and one commit
+            expenses = add_expenses(telegram_user_id, entries)
             
-            # Send confirmation message
-            success_message = f"✅ Pengeluaran tercatat!\n{format_expense_message(expense)}"
+            # Send one combined confirmation
+            if len(expenses) == 1:
+                success_message = f"✅ Pengeluaran tercatat!\n{format_expense_message(expenses[0])}"
+            else:
+                success_message = format_expense_batch_message(expenses)
             await update.message.reply_text(success_message)
             
         except Exception as e:
@@ -163,87 +188,12 @@ async def add_expense_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         pass
 
 
-async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle receiving the expense amount"""
-    user = update.effective_user
-    telegram_user_id = user.id
-    
-    try:
-        amount_str = update.message.text
-        amount, error = validate_amount(amount_str)
-        
-        if error:
-            await update.message.reply_text(f"❌ {error}. Please enter a valid amount (e.g., 50000):")
-            return AMOUNT
-        
-        # Store amount in user context
-        context.user_data['expense_amount'] = amount
-        
-        # Get user's available categories
-        categories = get_user_categories(telegram_user_id)
-        
-        # Create inline keyboard for categories
-        keyboard = []
-        for cat in categories:
-            keyboard.append([InlineKeyboardButton(cat, callback_data=f"cat_{cat}")])
-        
-        # Add option to add new category
-        keyboard.append([InlineKeyboardButton("➕ Add New Category", callback_data="new_category")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Pilih kategori:", reply_markup=reply_markup)
-        
-        return CATEGORY
-    except Exception as e:
-        logger.error(f"Error receiving amount: {str(e)}")
-        await update.message.reply_text(f"❌ Error occurred while adding expense: {str(e)}")
-    else:
-        # Start guided input - we handle this in main.py by sending the prompt
-        # The actual handling of the amount input will be in receive_amount
-        pass
-
-
-async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle receiving the expense amount"""
-    user = update.effective_user
-    telegram_user_id = user.id
-    
-    try:
-        amount_str = update.message.text
-        amount, error = validate_amount(amount_str)
-        
-        if error:
-            await update.message.reply_text(f"❌ {error}. Please enter a valid amount (e.g., 50000):")
-            return AMOUNT
-        
-        # Store amount in user context
-        context.user_data['expense_amount'] = amount
-        
-        # Get user's available categories
-        categories = get_user_categories(telegram_user_id)
-        
-        # Create inline keyboard for categories
-        keyboard = []
-        for cat in categories:
-            keyboard.append([InlineKeyboardButton(cat, callback_data=f"cat_{cat}")])
-        
-        # Add option to add new category
-        keyboard.append([InlineKeyboardButton("➕ Add New Category", callback_data="new_category")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Pilih kategori:", reply_markup=reply_markup)
-        
-        return CATEGORY
-    except Exception as e:
-        logger.error(f"Error receiving amount: {str(e)}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
-        return ConversationHandler.END
-
-
 async def receive_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle receiving the expense category"""
     query = update.callback_query
     await query.answer()
+    telegram_user_id = update.effective_user.id
+    flow_state = get_flow_state(telegram_user_id) or {}
     
     # Extract category from callback data
     if query.data.startswith("cat_"):
@@ -257,8 +207,8 @@ async def receive_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # If it's a new category, handle it
     if query.data == "new_category":
-        # Store category in user context
-        context.user_data['expense_category'] = category
+        # Store category in the flow state
+        save_flow_state(telegram_user_id, GUIDED_DESCRIPTION, amount=flow_state.get('amount'), category=category)
         await query.edit_message_text(f"Nama kategori yang dimasukkan: {category}")
         await query.message.reply_text("Masukkan deskripsi (opsional):")
         return DESCRIPTION
@@ -269,8 +219,8 @@ async def receive_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(f"❌ {error}")
             return ConversationHandler.END
         
-        # Store category in user context
-        context.user_data['expense_category'] = category
+        # Store category in the flow state
+        save_flow_state(telegram_user_id, GUIDED_DESCRIPTION, amount=flow_state.get('amount'), category=category)
         
         await query.edit_message_text(f"Kategori dipilih: {category}")
         await query.message.reply_text("Masukkan deskripsi (opsional):")
@@ -279,15 +229,17 @@ async def receive_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def receive_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle receiving the expense description"""
+    telegram_user_id = update.effective_user.id
     description = update.message.text
-    
-    # Store description in user context
-    context.user_data['expense_description'] = description if description.strip() else None
+    description = description if description.strip() else None
     
     # Get stored amount and category
-    amount = context.user_data.get('expense_amount')
-    category = context.user_data.get('expense_category')
-    description = context.user_data.get('expense_description')
+    flow_state = get_flow_state(telegram_user_id) or {}
+    amount = flow_state.get('amount')
+    category = flow_state.get('category')
+    
+    # Store description in the flow state until the user confirms
+    save_flow_state(telegram_user_id, GUIDED_CONFIRM, amount=amount, category=category, description=description)
     
     # Show confirmation message
     confirm_text = f"Konfirmasi pengeluaran:\n\n💰 {amount} - {category}"
@@ -309,21 +261,23 @@ async def confirm_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle expense confirmation"""
     query = update.callback_query
     await query.answer()
+    user = update.effective_user
+    telegram_user_id = user.id
     
     if query.data == "confirm_yes":
-        user = update.effective_user
-        telegram_user_id = user.id
-        
         try:
             # Get stored data
-            amount = context.user_data.get('expense_amount')
-            category = context.user_data.get('expense_category')
-            description = context.user_data.get('expense_description')
+            flow_state = get_flow_state(telegram_user_id) or {}
+            amount = flow_state.get('amount')
+            category = flow_state.get('category')
+            description = flow_state.get('description')
             
-            # Add new category if it doesn't exist for this user
-            categories = get_user_categories(telegram_user_id)
-            if category not in categories:
-                add_user_category(telegram_user_id, category)
+            # Reuse the existing spelling of the category, or add it for this user
+            existing_category = resolve_category(telegram_user_id, category)
+            if existing_category:
+                category = existing_category
+            else:
+                category = add_user_category(telegram_user_id, category).category_name
             
             # Add expense to database
             expense = add_expense(telegram_user_id, amount, category, description)
@@ -339,8 +293,8 @@ async def confirm_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == "confirm_no":
         await query.edit_message_text("❌ Pengeluaran dibatalkan.")
     
-    # Clear user data
-    context.user_data.clear()
+    # Clear the finished flow
+    clear_flow_state(telegram_user_id)
     
     return ConversationHandler.END
 
@@ -348,7 +302,7 @@ async def confirm_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the expense addition process"""
     await update.message.reply_text("❌ Pengeluaran dibatalkan.")
-    context.user_data.clear()
+    clear_flow_state(update.effective_user.id)
     return ConversationHandler.END
 
 
@@ -0,0 +1,100 @@
+from datetime import date
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes
+from database.operations import get_expense_page
+from utils.formatters import format_expense_history
+import logging
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_PREFIX = "rw"
+
+
+def encode_cursor(newer, expense_date, expense_id):
+    """Callback data for a page button, e.g. 'rw:o:k8f1:2s5' (date ordinal and ID in base 36)"""
+    direction = "n" if newer else "o"
+    return f"{CALLBACK_PREFIX}:{direction}:{_base36(expense_date.toordinal())}:{_base36(expense_id)}"
+
+
+def decode_cursor(data):
+    """Inverse of encode_cursor: (newer, (date, expense_id))"""
+    _, direction, ordinal, expense_id = data.split(":")
+    return direction == "n", (date.fromordinal(int(ordinal, 36)), int(expense_id, 36))
+
+
+def _base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if not number:
+            return encoded
+
+
+def _history_markup(expenses, has_newer, has_older):
+    """Previous/next buttons carrying the cursors of the first and last expense shown"""
+    buttons = []
+    if has_newer:
+        first = expenses[0]
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Lebih baru", callback_data=encode_cursor(True, first.date, first.expense_id)
+        ))
+    if has_older:
+        last = expenses[-1]
+        buttons.append(InlineKeyboardButton(
+            "Lebih lama ➡️", callback_data=encode_cursor(False, last.date, last.expense_id)
+        ))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def _load_page(telegram_user_id, cursor=None, newer=False):
+    """Return (expenses, has_newer, has_older) for a page of /riwayat"""
+    from config import HISTORY_PAGE_SIZE
+
+    expenses, more = get_expense_page(telegram_user_id, cursor, newer, HISTORY_PAGE_SIZE)
+    if cursor is None:
+        return expenses, False, more
+    if newer:
+        return expenses, more, True
+    return expenses, True, more
+
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /riwayat command - show the most recent expenses with paging buttons"""
+    telegram_user_id = update.effective_user.id
+    try:
+        expenses, has_newer, has_older = _load_page(telegram_user_id)
+        if not expenses:
+            await update.message.reply_text("❌ Belum ada pengeluaran yang tercatat.")
+            return
+        await update.message.reply_text(
+            format_expense_history(expenses),
+            reply_markup=_history_markup(expenses, has_newer, has_older),
+        )
+    except Exception as e:
+        logger.error(f"Error showing history: {str(e)}")
+        await update.message.reply_text(f"❌ Error occurred while loading history: {str(e)}")
+
+
+async def history_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the previous/next buttons of /riwayat"""
+    query = update.callback_query
+    await query.answer()
+    telegram_user_id = update.effective_user.id
+    try:
+        newer, cursor = decode_cursor(query.data)
+        expenses, has_newer, has_older = _load_page(telegram_user_id, cursor, newer)
+        if not expenses:
+            # The expenses around the cursor are gone, start over from the newest page
+            expenses, has_newer, has_older = _load_page(telegram_user_id)
+        if not expenses:
+            await query.edit_message_text("❌ Belum ada pengeluaran yang tercatat.")
+            return
+        await query.edit_message_text(
+            format_expense_history(expenses),
+            reply_markup=_history_markup(expenses, has_newer, has_older),
+        )
+    except Exception as e:
+        logger.error(f"Error paging history: {str(e)}")
+        await query.edit_message_text(f"❌ Error occurred while loading history: {str(e)}")
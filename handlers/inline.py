@@ -0,0 +1,83 @@
+from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import ContextTypes
+from utils.autocomplete import suggest
+from utils.validators import validate_amount
+from utils.formatters import format_currency
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = 8
+
+
+def parse_inline_query(text):
+    """Split '25000 makan siang' into (amount, category prefix, description prefix or None)"""
+    parts = text.split(maxsplit=2)
+    if not parts:
+        return None, "", None
+    amount, error = validate_amount(parts[0])
+    if error:
+        return None, "", None
+    category_prefix = parts[1] if len(parts) > 1 else ""
+    # A space after the category means the user moved on to the description
+    if len(parts) > 2:
+        description_prefix = parts[2]
+    elif len(parts) == 2 and text.endswith(" "):
+        description_prefix = ""
+    else:
+        description_prefix = None
+    return amount, category_prefix, description_prefix
+
+
+def _expense_result(result_id, amount, category, description=None):
+    """Article that sends the matching /tambah command when chosen"""
+    command = f"/tambah {amount} {category}"
+    title = f"{format_currency(amount)} • {category}"
+    if description:
+        command += f" {description}"
+        title += f" • {description}"
+    return InlineQueryResultArticle(
+        id=str(result_id),
+        title=title,
+        description=command,
+        input_message_content=InputTextMessageContent(command),
+    )
+
+
+async def inline_expense_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle inline queries like '@QuillieBOT 25000 ma' by suggesting expense entries"""
+    query = update.inline_query
+    telegram_user_id = query.from_user.id
+
+    amount, category_prefix, description_prefix = parse_inline_query(query.query)
+    if amount is None:
+        await query.answer(
+            [],
+            cache_time=0,
+            is_personal=True,
+            switch_pm_text="Ketik jumlah lalu kategori, contoh: 25000 makan",
+            switch_pm_parameter="inline_help",
+        )
+        return
+
+    # Served from the in-memory prefix index, no database query per keystroke
+    categories, descriptions = suggest(telegram_user_id, category_prefix, description_prefix, MAX_RESULTS)
+
+    results = []
+    if description_prefix is None:
+        for category in categories:
+            results.append(_expense_result(len(results), amount, category))
+    else:
+        # Category is complete, suggest descriptions for the best matching one
+        category = categories[0] if categories else category_prefix
+        if description_prefix:
+            results.append(_expense_result(len(results), amount, category, description_prefix))
+        for description in descriptions:
+            if description.lower() != description_prefix.strip().lower():
+                results.append(_expense_result(len(results), amount, category, description))
+
+    if not results and category_prefix:
+        # Unknown category, still let the user record it as typed
+        results.append(_expense_result(0, amount, category_prefix))
+
+    await query.answer(results[:MAX_RESULTS], cache_time=5, is_personal=True)
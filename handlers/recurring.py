@@ -0,0 +1,91 @@
+import shlex
+from telegram import Update
+from telegram.ext import ContextTypes
+from database.operations import (
+    add_recurring_expense,
+    get_recurring_expenses,
+    delete_recurring_expense,
+    resolve_category,
+)
+from utils.formatters import format_currency
+from utils.recurrence import parse_schedule, describe_schedule
+from utils.validators import validate_money, validate_category
+import logging
+
+logger = logging.getLogger(__name__)
+
+USAGE = (
+    "Usage:\n"
+    "/rutin - Lihat pengeluaran rutin\n"
+    "/rutin tambah [jadwal] [amount] [category] [description?]\n"
+    "/rutin hapus [id]\n\n"
+    "Jadwal: harian, senin..minggu, tanggal 1-31, akhir, atau cron \"1,15 * *\"\n"
+    "Example: /rutin tambah 1 1,5jt Lainnya sewa kos"
+)
+
+
+def format_recurring_rules(rules):
+    """Format the recurring expense rules of a user"""
+    if not rules:
+        return "Belum ada pengeluaran rutin.\n\n" + USAGE
+    message = "🔁 Pengeluaran Rutin\n──────────────────\n"
+    for rule in rules:
+        message += f"#{rule.rule_id} {format_currency(rule.amount, rule.currency)} 🏷️ {rule.category}"
+        if rule.description:
+            message += f" 📝 {rule.description}"
+        message += f"\n    {describe_schedule(rule.schedule)}, berikutnya {rule.next_run.strftime('%d %b %Y')}\n"
+    return message
+
+
+async def recurring_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /rutin command - list, add and delete recurring expenses"""
+    telegram_user_id = update.effective_user.id
+    try:
+        # shlex keeps a quoted cron schedule together
+        args = shlex.split(update.message.text)[1:]
+    except ValueError:
+        args = context.args or []
+
+    try:
+        if not args:
+            await update.message.reply_text(format_recurring_rules(get_recurring_expenses(telegram_user_id)))
+            return
+
+        action = args[0].lower()
+        if action in ["hapus", "delete"] and len(args) == 2:
+            rule_id = args[1].lstrip("#")
+            if not rule_id.isdigit() or not delete_recurring_expense(telegram_user_id, int(rule_id)):
+                await update.message.reply_text(f"❌ Pengeluaran rutin #{rule_id} tidak ditemukan.")
+                return
+            await update.message.reply_text(f"✅ Pengeluaran rutin #{rule_id} dihapus.")
+            return
+
+        if action not in ["tambah", "add"] or len(args) < 4:
+            await update.message.reply_text(USAGE)
+            return
+
+        schedule, error = parse_schedule(args[1])
+        if error:
+            await update.message.reply_text(f"❌ {error}")
+            return
+        amount, currency, error = validate_money(args[2])
+        if error:
+            await update.message.reply_text(f"❌ {error}")
+            return
+        category = args[3]
+        is_valid, error = validate_category(category)
+        if not is_valid:
+            await update.message.reply_text(f"❌ {error}")
+            return
+        category = resolve_category(telegram_user_id, category) or category
+        description = " ".join(args[4:]) or None
+
+        rule = add_recurring_expense(telegram_user_id, schedule, amount, category, description, currency)
+        await update.message.reply_text(
+            f"✅ Pengeluaran rutin #{rule.rule_id} tersimpan: {format_currency(rule.amount, rule.currency)} "
+            f"🏷️ {rule.category}, {describe_schedule(rule.schedule)}.\n"
+            f"Pertama dicatat {rule.next_run.strftime('%d %b %Y')}."
+        )
+    except Exception as e:
+        logger.error(f"Error handling recurring expenses: {str(e)}")
+        await update.message.reply_text(f"❌ Error occurred while managing recurring expenses: {str(e)}")
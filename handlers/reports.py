@@ -1,8 +1,19 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from database.operations import get_expenses_by_period, get_weekly_expenses_comparison, get_user_by_telegram_id
-from utils.formatters import format_report_message, create_expense_chart, format_currency
+from database.operations import (
+    get_expenses_by_period,
+    get_weekly_expenses_comparison,
+    get_user_by_telegram_id,
+    get_daily_totals,
+)
+from database.forecast import get_month_forecast, with_spent
+from utils.formatters import (
+    format_report_message, create_expense_chart, format_currency, format_month_forecast, format_budget_message,
+)
+from utils.charts import chart_range, create_report_charts
+from utils.outbound import reply_texts
 from datetime import date, timedelta, datetime
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,11 +24,15 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     telegram_user_id = user.id
     
+    # "grafik" anywhere in the arguments adds the charts to the report
+    args = [arg for arg in (context.args or []) if arg.lower() not in ["grafik", "chart"]]
+    with_charts = len(args) != len(context.args or [])
+    
     # Determine the report period
     period = "today"  # Default to today
     
-    if context.args:
-        arg = context.args[0].lower()
+    if args:
+        arg = args[0].lower()
         if arg in ["hari", "today", "harian"]:
             period = "today"
         elif arg in ["minggu", "week", "mingguan"]:
@@ -30,19 +45,19 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Check if it's a custom date range
             try:
                 # Parse custom date range like "2024-01-01 2024-01-31"
-                if len(context.args) >= 2:
-                    start_date = context.args[0]
-                    end_date = context.args[1]
+                if len(args) >= 2:
+                    start_date = args[0]
+                    end_date = args[1]
                     period = f"{start_date} {end_date}"
                 else:
                     await update.message.reply_text(
-                        "❌ Periode tidak valid. Gunakan: /laporan [hari|minggu|bulan|tahun] atau "
+                        "❌ Periode tidak valid. Gunakan: /laporan [hari|minggu|bulan|tahun] [grafik?] atau "
                         "/laporan [tanggal_mulai] [tanggal_akhir] (format: YYYY-MM-DD)"
                     )
                     return
             except Exception:
                 await update.message.reply_text(
-                    "❌ Periode tidak valid. Gunakan: /laporan [hari|minggu|bulan|tahun] atau "
+                    "❌ Periode tidak valid. Gunakan: /laporan [hari|minggu|bulan|tahun] [grafik?] atau "
                     "/laporan [tanggal_mulai] [tanggal_akhir] (format: YYYY-MM-DD)"
                 )
                 return
@@ -86,25 +101,51 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
             except ValueError:
                 await update.message.reply_text(
-                    "❌ Periode tidak valid. Gunakan: /laporan [hari|minggu|bulan|tahun] atau "
+                    "❌ Periode tidak valid. Gunakan: /laporan [hari|minggu|bulan|tahun] [grafik?] atau "
                     "/laporan [tanggal_mulai] [tanggal_akhir] (format: YYYY-MM-DD)"
                 )
                 return
         
-        # Format and send report message
+        # Format the report message
         report_message = format_report_message(expenses, period_name, start_date, end_date, comparison_data)
-        await update.message.reply_text(report_message)
+        replies = [report_message]
         
         # If it's a weekly report, also send comparison
         if period == "week" and comparison_data:
             current_data, previous_data = comparison_data
             if current_data['total'] > 0 or previous_data['total'] > 0:
-                comparison_message = (
+                replies.append(
                     f"📊 Perbandingan Minggu Ini vs Minggu Lalu:"
-                    f"minggu ini: {format_currency(current_data['total'])}"
-                    f"minggu lalu: {format_currency(previous_data['total'])}"
+                    f"minggu ini: {format_currency(current_data['total'], current_data['currency'])}"
+                    f"minggu lalu: {format_currency(previous_data['total'], previous_data['currency'])}"
                 )
-                await update.message.reply_text(comparison_message)
+        
+        if period == "month":
+            # Read from the nightly cache, nothing is computed here
+            forecast = get_month_forecast(telegram_user_id)
+            projected = with_spent(forecast, expenses) if forecast else None
+            if projected:
+                replies.append(format_month_forecast(projected, forecast['currency']))
+            user = get_user_by_telegram_id(telegram_user_id)
+            if user and user.monthly_budget:
+                # Expenses and forecast are converted to the base currency the budget is kept in
+                spent = sum(expense.amount for expense in expenses)
+                replies.append(format_budget_message(
+                    user.monthly_budget, spent, sum(projected.values()) if projected else None, user.base_currency
+                ))
+        
+        await reply_texts(update.message, replies)
+        
+        if with_charts:
+            # The report is already sent, a failing chart must not send it again
+            try:
+                # One aggregate query feeds every chart, rendering runs off the event loop
+                totals = get_daily_totals(telegram_user_id, *chart_range(start_date, end_date))
+                chart = await asyncio.to_thread(create_report_charts, totals, start_date, end_date)
+                await update.message.reply_photo(photo=chart, caption=f"📊 Grafik {period_name}")
+            except Exception as e:
+                logger.error(f"Error creating report charts: {str(e)}")
+                await update.message.reply_text("❌ Grafik gagal dibuat")
 
     except Exception as e:
         logger.error(f"Error generating report: {str(e)}")
@@ -120,8 +161,8 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if current_data['total'] > 0 or previous_data['total'] > 0:
                 comparison_message = (
                     f"📊 Perbandingan Minggu Ini vs Minggu Lalu:"
-                    f"minggu ini: {format_currency(current_data['total'])}"
-                    f"minggu lalu: {format_currency(previous_data['total'])}"
+                    f"minggu ini: {format_currency(current_data['total'], current_data['currency'])}"
+                    f"minggu lalu: {format_currency(previous_data['total'], previous_data['currency'])}"
                 )
                 await update.message.reply_text(comparison_message)
     
@@ -173,9 +214,12 @@ async def set_budget_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         # Update user's budget in database
         updated_user = set_monthly_budget(telegram_user_id, budget_amount)
+        if not updated_user:
+            await update.message.reply_text("❌ Ketik /start terlebih dahulu.")
+            return
         
         from utils.formatters import format_currency
-        success_message = f"✅ Monthly budget set to {format_currency(budget_amount)}"
+        success_message = f"✅ Monthly budget set to {format_currency(budget_amount, updated_user.base_currency)}"
         await update.message.reply_text(success_message)
     
     except Exception as e:
@@ -1,31 +1,64 @@
 import logging
 import asyncio
-from datetime import date
+import time
+from datetime import date, datetime
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from telegram import Bot
+from telegram.error import RetryAfter
 
 from database.operations import (
     get_users_for_weekly_report,
     get_weekly_expenses_comparison,
+    sweep_expired_flow_states,
+    sweep_processed_updates,
+    materialize_recurring_expenses,
 )
+from database.partitions import archive_closed_years
+from database.forecast import refresh_forecasts
+from database.stats import flush_stats
+from database.instrumentation import query_scope
 from utils.formatters import format_report_message, format_currency
-from config import BOT_TOKEN, SCHEDULER_TIMEZONE, WEEKLY_REPORT_HOUR
+from utils.outbound import SCHEDULED
+from utils.metrics import (
+    InstrumentedRequest,
+    BROADCAST_PROGRESS,
+    BROADCAST_LAST_RUN,
+    TELEGRAM_API_RETRIES,
+)
+from config import (
+    BOT_TOKEN,
+    SCHEDULER_TIMEZONE,
+    WEEKLY_REPORT_HOUR,
+    FLOW_STATE_SWEEP_INTERVAL_MINUTES,
+    UPDATE_DEDUP_SWEEP_INTERVAL_MINUTES,
+    EXPENSE_ARCHIVE_HOUR,
+    FORECAST_HOUR,
+    STATS_FLUSH_MINUTES,
+    RECURRING_HOUR,
+)
 
 logger = logging.getLogger(__name__)
 
 
 class ReportScheduler:
-    def __init__(self):
+    def __init__(self, bot=None):
         self.scheduler = BackgroundScheduler()
-        self.bot = Bot(token=BOT_TOKEN)
+        # The application's bot shares its outbound queue, a bot of our own is used standalone
+        self.bot = bot or Bot(token=BOT_TOKEN, request=InstrumentedRequest())
+        self.loop = None
 
-    def start_scheduler(self):
-        """Start the scheduler for weekly reports"""
+    def start_scheduler(self, loop=None):
+        """Start the scheduler for weekly reports.
+
+        With the event loop of the bot, broadcasts run on that loop instead of a loop of their own.
+        """
+        self.loop = loop
         # Schedule weekly report on Monday at specified hour (WIB)
         self.scheduler.add_job(
-            self.send_weekly_reports,
+            self.run_weekly_reports,
             CronTrigger(
                 day_of_week="mon",
                 hour=WEEKLY_REPORT_HOUR,
@@ -36,25 +69,113 @@ class ReportScheduler:
             replace_existing=True,
         )
 
+        # Remove abandoned guided /tambah flows
+        self.scheduler.add_job(
+            sweep_expired_flow_states,
+            IntervalTrigger(minutes=FLOW_STATE_SWEEP_INTERVAL_MINUTES),
+            id="flow_state_sweep_job",
+            name="Sweep expired guided expense flows",
+            replace_existing=True,
+        )
+
+        # Forget handled update IDs Telegram can no longer redeliver
+        self.scheduler.add_job(
+            sweep_processed_updates,
+            IntervalTrigger(minutes=UPDATE_DEDUP_SWEEP_INTERVAL_MINUTES),
+            id="processed_update_sweep_job",
+            name="Sweep old processed update IDs",
+            replace_existing=True,
+        )
+
+        # Record due recurring expenses daily, and once right away to catch up after downtime
+        self.scheduler.add_job(
+            materialize_recurring_expenses,
+            CronTrigger(hour=RECURRING_HOUR, minute=5, timezone=SCHEDULER_TIMEZONE),
+            id="recurring_expense_job",
+            name="Materialize due recurring expenses",
+            replace_existing=True,
+            next_run_time=datetime.now(),
+        )
+
+        # Move closed years out of the hot expenses table (a no-op on most days)
+        self.scheduler.add_job(
+            archive_closed_years,
+            CronTrigger(hour=EXPENSE_ARCHIVE_HOUR, timezone=SCHEDULER_TIMEZONE),
+            id="expense_archive_job",
+            name="Archive expenses of closed years",
+            replace_existing=True,
+        )
+
+        # Month-end forecasts of all users in one batch at night, and right away after a restart
+        self.scheduler.add_job(
+            refresh_forecasts,
+            CronTrigger(hour=FORECAST_HOUR, minute=30, timezone=SCHEDULER_TIMEZONE),
+            id="spending_forecast_job",
+            name="Refresh month-end spending forecasts",
+            replace_existing=True,
+            next_run_time=datetime.now(),
+        )
+
+        # Store the global statistics sketches recorded in memory since the last flush
+        self.scheduler.add_job(
+            flush_stats,
+            IntervalTrigger(minutes=STATS_FLUSH_MINUTES),
+            id="stats_flush_job",
+            name="Store global statistics sketches",
+            replace_existing=True,
+        )
+
         self.scheduler.start()
         logger.info("Scheduler started for weekly reports")
 
     def stop_scheduler(self):
-        """Stop the scheduler"""
-        self.scheduler.shutdown()
+        """Stop the scheduler and store the statistics recorded since the last flush"""
+        if self.scheduler.running:
+            self.scheduler.shutdown()
+        flush_stats()  # Sketches not stored yet would be lost with the process
         logger.info("Scheduler stopped")
 
+    def run_weekly_reports(self):
+        """Scheduler thread entry point of the weekly broadcast"""
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.send_weekly_reports(), self.loop).result()
+        else:
+            asyncio.run(self.send_weekly_reports())
+
+    async def _send_message(self, chat_id, text):
+        """Send a message, waiting and retrying once if Telegram asks us to slow down"""
+        if getattr(self.bot, "rate_limiter", None) is not None:
+            # Queued behind interactive replies, the outbound scheduler handles flood waits
+            await self.bot.send_message(chat_id=chat_id, text=text, rate_limit_args=SCHEDULED)
+            return
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            TELEGRAM_API_RETRIES.inc(method="sendMessage")
+            await asyncio.sleep(e.retry_after)
+            await self.bot.send_message(chat_id=chat_id, text=text)
+
     async def send_weekly_reports(self):
         """Send weekly reports to all active users"""
+        # One query scope for the whole broadcast, so per-user queries show up as N+1
+        with query_scope("weekly_report"):
+            await self._broadcast_weekly_reports()
+
+    async def _broadcast_weekly_reports(self):
+        """Send the weekly report to every active user, one user at a time"""
         try:
             users = get_users_for_weekly_report()
             logger.info(f"Sending weekly reports to {len(users)} users")
+            BROADCAST_LAST_RUN.set(time.time())
+            BROADCAST_PROGRESS.set(len(users), state="total")
+            BROADCAST_PROGRESS.set(0, state="sent")
+            BROADCAST_PROGRESS.set(0, state="failed")
 
             for user in users:
                 try:
-                    # Get weekly expenses comparison
-                    current_data, previous_data = get_weekly_expenses_comparison(
-                        user.telegram_user_id
+                    # Get weekly expenses comparison, off the event loop handlers may share
+                    current_data, previous_data = await asyncio.to_thread(
+                        get_weekly_expenses_comparison, user.telegram_user_id
                     )
 
                     # Only send report if there are expenses this week
@@ -89,13 +210,13 @@ class ReportScheduler:
                             )
 
                         # Send the report to user
-                        await self.bot.send_message(
+                        await self._send_message(
                             chat_id=user.telegram_user_id,
                             text=f"📅 Weekly Expense Report\n\n{report_message}",
                         )
                     else:
                         # Send a message saying no expenses this week
-                        await self.bot.send_message(
+                        await self._send_message(
                             chat_id=user.telegram_user_id,
                             text=(
                                 "📅 Weekly Expense Report\n\n"
@@ -103,8 +224,10 @@ class ReportScheduler:
                                 "Keep tracking your expenses to see your spending patterns!"
                             ),
                         )
+                    BROADCAST_PROGRESS.inc(state="sent")
 
                 except Exception as e:
+                    BROADCAST_PROGRESS.inc(state="failed")
                     logger.error(
                         f"Error sending report to user {user.telegram_user_id}: {str(e)}"
                     )
@@ -0,0 +1,44 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from database.operations import search_expenses
+from utils.formatters import format_search_results
+from utils.validators import validate_date
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEARCH_RESULT_LIMIT = 10
+
+
+def parse_search_args(args):
+    """Split /cari arguments into (query, start_date, end_date), trailing YYYY-MM-DD args are dates"""
+    args = list(args)
+    dates = []
+    while args and len(dates) < 2:
+        parsed, error = validate_date(args[-1])
+        if error:
+            break
+        dates.insert(0, parsed)
+        args.pop()
+    start_date = dates[0] if dates else None
+    end_date = dates[1] if len(dates) > 1 else None
+    return " ".join(args), start_date, end_date
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /cari command - full-text search over descriptions and categories"""
+    telegram_user_id = update.effective_user.id
+    query, start_date, end_date = parse_search_args(context.args or [])
+    if not query.strip():
+        await update.message.reply_text(
+            "❌ Usage: /cari [kata] [tanggal_mulai?] [tanggal_akhir?]\n"
+            "Example: /cari kopi 2024-01-01 2024-03-31"
+        )
+        return
+
+    try:
+        result = search_expenses(telegram_user_id, query, start_date, end_date, SEARCH_RESULT_LIMIT)
+        await update.message.reply_text(format_search_results(query, result))
+    except Exception as e:
+        logger.error(f"Error searching expenses: {str(e)}")
+        await update.message.reply_text(f"❌ Error occurred while searching: {str(e)}")
@@ -0,0 +1,33 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from database.stats import get_global_stats
+from utils.formatters import format_global_stats
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATS_DAYS = 30
+MAX_STATS_DAYS = 365
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /stats command - global usage statistics, for admins only"""
+    from config import ADMIN_USER_IDS
+    telegram_user_id = update.effective_user.id
+    if telegram_user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("❌ Perintah ini khusus admin.")
+        return
+    try:
+        days = STATS_DAYS
+        if context.args:
+            if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= MAX_STATS_DAYS:
+                await update.message.reply_text(f"❌ Jumlah hari harus 1-{MAX_STATS_DAYS}, contoh: /stats 7")
+                return
+            days = int(context.args[0])
+        # Merging a year of sketches takes a moment, off the event loop
+        stats = await asyncio.to_thread(get_global_stats, days)
+        await update.message.reply_text(format_global_stats(stats))
+    except Exception as e:
+        logger.error(f"Error handling stats for admin {telegram_user_id}: {str(e)}")
+        await update.message.reply_text(f"❌ Error occurred while computing statistics: {str(e)}")
@@ -0,0 +1,225 @@
+import asyncio
+import functools
+import hmac
+import json
+import logging
+import secrets
+import signal
+
+from telegram import Update
+
+try:
+    import orjson
+except ImportError:
+    # Plain json decodes the same updates, only slower
+    orjson = None
+
+from utils.metrics import WEBHOOK_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+_REASONS = {
+    200: b"OK",
+    400: b"Bad Request",
+    403: b"Forbidden",
+    404: b"Not Found",
+    405: b"Method Not Allowed",
+    413: b"Payload Too Large",
+    503: b"Service Unavailable",
+}
+
+
+def loads(body):
+    """Decode a JSON request body, with orjson when it is installed"""
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+class BoundedUpdateQueue(asyncio.Queue):
+    """Application update queue that knows how many updates are still in flight.
+
+    An update counts from put until task_done(), i.e. also while it waits in a user's lane
+    or its handler runs, so ``pending`` bounds the updates held in memory.
+    """
+
+    def __init__(self, max_pending):
+        super().__init__()
+        self.max_pending = max_pending
+        self.pending = 0
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self.pending += 1
+
+    def task_done(self):
+        super().task_done()
+        self.pending -= 1
+
+    def offer(self, update):
+        """Queue an update unless max_pending are in flight, returns whether it was queued"""
+        if self.pending >= self.max_pending:
+            return False
+        self.put_nowait(update)
+        return True
+
+
+class WebhookIngress:
+    """HTTP listener for Telegram webhook deliveries.
+
+    Deliveries must carry the secret token registered with setWebhook. When the application
+    already holds max_pending updates, or the user's lane is full, a delivery is refused with
+    503 and Retry-After, and Telegram delivers it again later, so a burst waits at Telegram
+    instead of in memory.
+    Nothing else is served: the port is public, the metrics have a listener of their own.
+    """
+
+    def __init__(self, application, path, secret_token, max_body_bytes=1048576, retry_after=1):
+        if not isinstance(application.update_queue, BoundedUpdateQueue):
+            raise ValueError("The application must be built with a BoundedUpdateQueue")
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token.encode()
+        self.max_body_bytes = max_body_bytes
+        self.retry_after = retry_after
+        self._server = None
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Webhook listening on {host}:{port}{self.path}")
+        return self._server
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def handle_delivery(self, headers, body):
+        """Validate and queue one webhook delivery, returns the HTTP status"""
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret_token):
+            return 403
+        queue = self.application.update_queue
+        if queue.pending >= queue.max_pending:
+            # Checked before decoding, shedding load costs next to nothing
+            return 503
+        try:
+            update = Update.de_json(loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Undecodable webhook delivery: {str(e)}")
+            return 400
+        if update is None:
+            return 400
+        # A user whose lane is full waits at Telegram too, a dropped update would never come back
+        accepts_update = getattr(self.application, "accepts_update", None)
+        if accepts_update is not None and not accepts_update(update):
+            logger.warning(f"Lane of update {update.update_id} is full, asking Telegram to retry")
+            return 503
+        return 200 if queue.offer(update) else 503
+
+    def _respond(self, status):
+        head = b"HTTP/1.1 " + str(status).encode() + b" " + _REASONS.get(status, b"") + b"\r\n"
+        head += b"Content-Type: text/plain\r\n"
+        if status == 503:
+            head += b"Retry-After: " + str(self.retry_after).encode() + b"\r\n"
+        return head + b"Content-Length: 0\r\n\r\n"
+
+    async def _handle_connection(self, reader, writer):
+        # Telegram keeps connections open and sends one delivery after another on them
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if len(parts) < 2:
+                    writer.write(self._respond(400))
+                    break
+
+                method, path = parts[0], parts[1].split("?")[0]
+                length = int(headers.get("content-length") or 0)
+                if length > self.max_body_bytes:
+                    writer.write(self._respond(413))
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                if path == self.path:
+                    status = self.handle_delivery(headers, body) if method == "POST" else 405
+                    WEBHOOK_REQUESTS.inc(status=status)
+                    writer.write(self._respond(status))
+                else:
+                    writer.write(self._respond(404))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def install_update_deduplication(application):
+    """Wrap application.process_update so redelivered message updates are dropped.
+
+    Only message updates are claimed: they are the ones that record expenses, while
+    inline queries and button presses are frequent and harmless to repeat.
+    """
+    from database.operations import claim_update
+
+    process_update = application.process_update
+
+    @functools.wraps(process_update)
+    async def deduplicated_process_update(update):
+        if isinstance(update, Update) and update.message is not None:
+            user = update.effective_user
+            if not claim_update(update.update_id, user.id if user else None):
+                logger.info(f"Dropped redelivered update {update.update_id}")
+                return
+        await process_update(update)
+
+    application.process_update = deduplicated_process_update
+
+
+async def run_webhook(application, host, port, webhook_url, path, secret_token=None,
+                      max_connections=40, max_body_bytes=1048576):
+    """Run the application behind a WebhookIngress until SIGINT or SIGTERM.
+
+    Like run_polling, post_init runs before the start, post_stop after the stop and
+    post_shutdown once the application is shut down.
+    """
+    # Telegram accepts 1-256 characters of A-Z, a-z, 0-9, _ and -
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    ingress = WebhookIngress(application, path, secret_token, max_body_bytes)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await ingress.start(host, port)
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            max_connections=max_connections,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+        try:
+            await stop.wait()
+        finally:
+            await ingress.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
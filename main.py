@@ -1,10 +1,12 @@
+import asyncio
 import logging
-import os
 import sys
 from telegram import Update, BotCommand
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
@@ -18,17 +20,66 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Import handlers and database functions
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN,
+    UPDATE_LANES_ENABLED,
+    UPDATE_MAX_CONCURRENCY,
+    UPDATE_LANE_MAX_DEPTH,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    PROFILER_ENABLED,
+    PROFILER_THRESHOLD_MS,
+    PROFILER_SAMPLE_INTERVAL_MS,
+    PROFILER_RING_SIZE,
+    MAX_QUERIES_PER_UPDATE,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_PENDING_UPDATES,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_MAX_BODY_BYTES,
+    UPDATE_DEDUP_ENABLED,
+    OUTBOUND_QUEUE_ENABLED,
+    OUTBOUND_RATE_PER_SECOND,
+    OUTBOUND_CHAT_RATE_PER_SECOND,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_INTERACTIVE_RESERVE,
+)
 from database.models import initialize_database
+from database.instrumentation import install_query_tracking
 from handlers.start import start
-from handlers.expenses import add_expense_command, receive_amount
+from handlers.expenses import (
+    add_expense_command,
+    receive_amount,
+    start_guided_expense,
+    guided_step_name,
+)
 from handlers.reports import (
     report_command,
     categories_command,
     set_budget_command,
     export_command,
 )
+from handlers.inline import inline_expense_query
+from handlers.search import search_command
+from handlers.recurring import recurring_command
+from handlers.currency import currency_command
+from handlers.stats import stats_command
+from handlers.history import history_command, history_page_callback, CALLBACK_PREFIX as HISTORY_CALLBACK_PREFIX
 from handlers.scheduler import ReportScheduler
+from handlers.dispatcher import LaneApplication
+from handlers.webhook import BoundedUpdateQueue, install_update_deduplication, run_webhook
+from utils.metrics import (
+    InstrumentedRequest,
+    register_application_metrics,
+    register_endpoint,
+    start_metrics_server,
+    track_handler,
+)
+from utils.profiler import UpdateProfiler
+from utils.outbound import OutboundScheduler
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -42,12 +93,19 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/laporan - View today's expenses\n"
         "/laporan minggu - View weekly expenses\n"
         "/laporan bulan - View monthly expenses\n"
+        "/laporan bulan grafik - Add daily, 12-month trend and calendar charts\n"
         "/kategori - View available categories\n"
         "/set_budget - Set monthly budget /set_budget [amount]\n"
+        "/riwayat - Browse your expenses page by page\n"
+        "/cari [kata] - Search expenses by description or category\n"
+        "/rutin - Manage recurring expenses (rent, bills, subscriptions)\n"
+        "/matauang [kode] - Set the currency reports are converted to\n"
         "/export - Export your expense data\n\n"
         "Example usage:\n"
         '/tambah 50000 makan "makan siang"\n'
         '/tambah 75000 transportasi "transportasi ke tempat"\n'
+        "/tambah 25rb makan nasi padang\n"
+        "15k transport ojek  (satu pengeluaran per baris, rb/k/jt boleh)\n"
     )
     await update.message.reply_html(help_text)
 
@@ -61,64 +119,159 @@ async def setup_bot_commands(application: Application):
         BotCommand("laporan", "View expense report"),
         BotCommand("kategori", "View available categories"),
         BotCommand("set_budget", "Set monthly budget"),
+        BotCommand("riwayat", "Browse expense history"),
+        BotCommand("cari", "Search expenses"),
+        BotCommand("rutin", "Manage recurring expenses"),
+        BotCommand("matauang", "Set report currency"),
         BotCommand("export", "Export expense data"),
     ]
     await application.bot.set_my_commands(commands)
 
 
-def main():
-    """Start the bot"""
-    # Initialize database
-    initialize_database()
-    logger.info("Database initialized")
+async def tambah_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /tambah command separately to determine if it has arguments"""
+    if context.args:
+        # If there are command arguments, process directly
+        await add_expense_command(update, context)
+    else:
+        # If no arguments, start guided flow
+        await start_guided_expense(update, context)
 
+
+def build_application(token=BOT_TOKEN, base_url=None, serve_metrics=METRICS_ENABLED,
+                      outbound_queue=OUTBOUND_QUEUE_ENABLED):
+    """Create the Application with all handlers registered"""
     # Create the Application and pass it your bot's token
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    # Register command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("laporan", report_command))
-    application.add_handler(CommandHandler("kategori", categories_command))
-    application.add_handler(CommandHandler("set_budget", set_budget_command))
-    application.add_handler(CommandHandler("export", export_command))
-
-    # Handle the /tambah command separately to determine if it has arguments
-    async def tambah_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if context.args:
-            # If there are command arguments, process directly
-            await add_expense_command(update, context)
-        else:
-            # If no arguments, start guided flow
-            await update.message.reply_text(
-                "Masukkan jumlah pengeluaran (contoh: 50000 makan):"
-            )
-
-    application.add_handler(CommandHandler("tambah", tambah_command))
+    builder = Application.builder().token(token).request(
+        InstrumentedRequest(connection_pool_size=256)
+    ).update_queue(
+        # Updates in flight are capped, the webhook refuses deliveries beyond it
+        BoundedUpdateQueue(WEBHOOK_MAX_PENDING_UPDATES)
+    )
+    if base_url:
+        # e.g. a local Bot API stand-in used for load testing
+        builder = builder.base_url(base_url)
+    if outbound_queue:
+        # Every send is paced and prioritized, replies go ahead of the weekly broadcast
+        builder = builder.rate_limiter(OutboundScheduler(
+            rate=OUTBOUND_RATE_PER_SECOND,
+            burst=int(OUTBOUND_RATE_PER_SECOND),
+            chat_rate=OUTBOUND_CHAT_RATE_PER_SECOND,
+            chat_burst=OUTBOUND_CHAT_BURST,
+            interactive_reserve=OUTBOUND_INTERACTIVE_RESERVE,
+        ))
+    if UPDATE_LANES_ENABLED:
+        # Different users are handled in parallel, each user's updates stay in order
+        builder = builder.application_class(
+            LaneApplication,
+            kwargs={
+                "max_concurrency": UPDATE_MAX_CONCURRENCY,
+                "lane_max_depth": UPDATE_LANE_MAX_DEPTH,
+            },
+        )
+    application = builder.build()
+    register_application_metrics(application)
+
+    # Count SQL statements per update, flag N+1 patterns (and enforce a budget if configured)
+    install_query_tracking(application, max_queries=MAX_QUERIES_PER_UPDATE or None)
+
+    # Profile slow updates end to end, ahead of all handlers
+    if PROFILER_ENABLED:
+        profiler = UpdateProfiler(
+            threshold_ms=PROFILER_THRESHOLD_MS,
+            sample_interval_ms=PROFILER_SAMPLE_INTERVAL_MS,
+            ring_size=PROFILER_RING_SIZE,
+        )
+        profiler.install(application)
+        register_endpoint("/debug/profiles", profiler.dump)
+
+    # Drop webhook redeliveries before any handler (or the profiler) sees them
+    if UPDATE_DEDUP_ENABLED:
+        install_update_deduplication(application)
+
+    # Register command handlers, each one timed under its command name
+    application.add_handler(CommandHandler("start", track_handler("start", start)))
+    application.add_handler(CommandHandler("help", track_handler("help", help_command)))
+    application.add_handler(CommandHandler("laporan", track_handler("laporan", report_command)))
+    application.add_handler(CommandHandler("kategori", track_handler("kategori", categories_command)))
+    application.add_handler(CommandHandler("set_budget", track_handler("set_budget", set_budget_command)))
+    application.add_handler(CommandHandler("export", track_handler("export", export_command)))
+    application.add_handler(CommandHandler("tambah", track_handler("tambah", tambah_command)))
+    application.add_handler(CommandHandler("riwayat", track_handler("riwayat", history_command)))
+    application.add_handler(CommandHandler("cari", track_handler("cari", search_command)))
+    application.add_handler(CommandHandler("rutin", track_handler("rutin", recurring_command)))
+    application.add_handler(CommandHandler("matauang", track_handler("matauang", currency_command)))
+    # Admin only, so not listed in the bot's commands or /help
+    application.add_handler(CommandHandler("stats", track_handler("stats", stats_command)))
+    application.add_handler(CallbackQueryHandler(
+        track_handler("riwayat_page", history_page_callback), pattern=f"^{HISTORY_CALLBACK_PREFIX}:"
+    ))
 
     # Handle guided expense input (text messages after /tambah without args)
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, receive_amount)
+        MessageHandler(filters.TEXT & ~filters.COMMAND, track_handler(guided_step_name, receive_amount))
     )
 
+    # Inline mode: "@QuillieBOT 25000 ma" suggests categories and descriptions
+    application.add_handler(InlineQueryHandler(track_handler("inline", inline_expense_query)))
+
     # Setup bot commands (dipanggil lewat post_init)
     async def post_init(app: Application) -> None:
         await setup_bot_commands(app)
+        if serve_metrics:
+            await start_metrics_server(METRICS_HOST, METRICS_PORT)
 
     application.post_init = post_init
 
-    # Initialize scheduler
-    scheduler = ReportScheduler()
-    scheduler.start_scheduler()
-    logger.info("Scheduler started")
-
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=int(os.environ.get("PORT", 8080)),  # ambil port dari Railway
-        url_path="BOT_TOKEN",
-        webhook_url=f"https://{os.environ.get('RAILWAY_STATIC_URL')}/{"BOT_TOKEN"}",
-        drop_pending_updates=True
-    )
+    return application
+
+
+def install_scheduler(application):
+    """Run a ReportScheduler for as long as the application runs, returns the scheduler"""
+    # Started once the bot runs: broadcasts use its event loop and outbound queue
+    scheduler = ReportScheduler(application.bot)
+    post_init = application.post_init
+
+    async def start_scheduler(app: Application) -> None:
+        await post_init(app)
+        scheduler.start_scheduler(asyncio.get_running_loop())
+        logger.info("Scheduler started")
+
+    # Stopping waits for running jobs, which may need the event loop, and stores the pending
+    # global statistics that would otherwise be lost with the process
+    async def stop_scheduler(app: Application) -> None:
+        await asyncio.to_thread(scheduler.stop_scheduler)
+
+    application.post_init = start_scheduler
+    application.post_shutdown = stop_scheduler
+    return scheduler
+
+
+def main():
+    """Start the bot"""
+    # Initialize database
+    initialize_database()
+    logger.info("Database initialized")
+
+    # Metrics get a listener of their own in both modes, never the public webhook port
+    application = build_application(serve_metrics=METRICS_ENABLED)
+    install_scheduler(application)
+
+    if not WEBHOOK_URL:
+        logger.info("No webhook URL configured, polling for updates")
+        application.run_polling(drop_pending_updates=True)
+        return
+
+    asyncio.run(run_webhook(
+        application,
+        host="0.0.0.0",
+        port=WEBHOOK_PORT,  # ambil port dari Railway
+        webhook_url=WEBHOOK_URL,
+        path=WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        max_body_bytes=WEBHOOK_MAX_BODY_BYTES,
+    ))
 
 
 if __name__ == "__main__":
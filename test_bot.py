@@ -1,8 +1,14 @@
 # test_bot.py - Simple test script to verify bot functionality
 
 import asyncio
+import os
+import tempfile
+
+# Use a throwaway database so running the tests never touches expenses.db
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test_expenses.db")
+
 from database.models import initialize_database
-from database.operations import register_user, add_expense, get_user_expenses
+from database.operations import register_user, add_expense, get_user_expenses, get_users_for_weekly_report
 from utils.validators import validate_amount, validate_category
 from utils.formatters import format_currency
 
@@ -42,6 +48,937 @@ def test_database():
     formatted = format_currency(50000)
     print(f"✓ Currency formatted: {formatted}")
 
+def test_update_lanes():
+    print("\\nTesting per-user update lanes...")
+    import asyncio
+    from datetime import datetime
+    from telegram import Update, Message, Chat, User
+    from telegram.ext import Application
+    from telegram.ext._application import _STOP_SIGNAL
+    from handlers.dispatcher import LaneApplication
+
+    processed = []
+
+    async def fake_process_update(update):
+        # Later updates of user 1 are faster, so they would overtake without lanes
+        await asyncio.sleep(0.01 * (5 - update.update_id % 5))
+        processed.append((update.effective_user.id, update.update_id))
+
+    def make_update(update_id, user_id):
+        user = User(user_id, "Test", False)
+        message = Message(update_id, datetime.now(), Chat(user_id, "private"), from_user=user, text="1")
+        return Update(update_id, message=message)
+
+    async def run():
+        application = (
+            Application.builder()
+            .token("123:TEST")
+            .application_class(LaneApplication, kwargs={"max_concurrency": 4, "lane_max_depth": 3})
+            .build()
+        )
+        application.process_update = fake_process_update
+        fetcher = asyncio.create_task(application._update_fetcher())
+        for update_id in range(5):
+            await application.update_queue.put(make_update(update_id, 1))
+        await application.update_queue.put(make_update(10, 2))
+        await application.update_queue.join()
+        await application.update_queue.put(_STOP_SIGNAL)
+        await fetcher
+        return application
+
+    application = asyncio.run(run())
+    user_1_order = [update_id for user_id, update_id in processed if user_id == 1]
+    assert user_1_order == [0, 1, 2], user_1_order
+    assert application.dropped_updates == 2
+    assert application.active_lanes == 0
+    print(f"✓ Lanes kept order {user_1_order} and dropped {application.dropped_updates} updates")
+
+def test_flow_state():
+    print("\\nTesting guided flow state store...")
+    from datetime import datetime, timedelta
+    from database.models import FlowState, get_session
+    from database.operations import (
+        get_flow_state, save_flow_state, clear_flow_state, sweep_expired_flow_states,
+    )
+    initialize_database()
+
+    save_flow_state(555, 1, amount=25000)
+    state = get_flow_state(555)
+    assert state['step'] == 1 and state['amount'] == 25000
+    clear_flow_state(555)
+    assert get_flow_state(555) is None
+    print("✓ Flow state saved and cleared")
+
+    # Abandoned flows are removed in batches
+    for telegram_user_id in range(1000, 1012):
+        save_flow_state(telegram_user_id, 0)
+    session = get_session()
+    session.query(FlowState).update({FlowState.expires_at: datetime.now() - timedelta(minutes=1)})
+    session.commit()
+    session.close()
+    assert sweep_expired_flow_states(batch_size=5) == 12
+    assert get_flow_state(1000) is None
+    print("✓ Expired flow states swept")
+
+def test_loadtest_smoke():
+    print("\\nTesting end-to-end load test harness...")
+    from tools.loadtest import LoadTest
+    results = asyncio.run(LoadTest(users=5).run())
+    assert results["updates"] == 45
+    assert results["error_rate"] == 0, results["commands"]
+    print(f"✓ {results['updates']} updates handled at {results['throughput_per_s']} updates/s")
+
+def test_query_instrumentation():
+    print("\\nTesting SQL query instrumentation...")
+    from database.instrumentation import assert_max_queries, query_scope, QueryBudgetExceeded
+    from database.operations import get_user_by_telegram_id
+    initialize_database()
+
+    with query_scope("repeat") as stats:
+        for _ in range(3):
+            get_user_by_telegram_id(123456789)
+    assert stats.count == 3
+    assert stats.repeated_statements(3), "repeated lookups should be flagged as N+1"
+
+    with assert_max_queries(1):
+        get_user_by_telegram_id(123456789)
+    try:
+        with assert_max_queries(1):
+            get_user_by_telegram_id(123456789)
+            get_user_by_telegram_id(123456789)
+    except QueryBudgetExceeded:
+        print("✓ Query budget enforced")
+    else:
+        raise AssertionError("query budget was not enforced")
+
+def test_category_cache():
+    print("\\nTesting category cache and case-insensitive categories...")
+    from config import DEFAULT_CATEGORIES
+    from database.instrumentation import assert_max_queries
+    from database.operations import get_user_categories, add_user_category, resolve_category
+    initialize_database()
+    register_user(987654321, "cats", "Cat", "User")
+
+    add_user_category(987654321, "Kopi")
+    add_user_category(987654321, "kopi")
+    categories = get_user_categories(987654321)
+    assert categories == DEFAULT_CATEGORIES + ["Kopi"], categories
+    assert resolve_category(987654321, "KOPI") == "Kopi"
+    with assert_max_queries(0):
+        get_user_categories(987654321)
+    print(f"✓ Categories cached in order: {categories}")
+
+def test_autocomplete():
+    """Test prefix suggestions and inline query parsing"""
+    from utils.autocomplete import PrefixIndex
+    from handlers.inline import parse_inline_query
+
+    index = PrefixIndex(max_terms=3)
+    index.add("Makan", 1)
+    index.add("Minuman", 5)
+    index.add("makan", 2)
+    index.add("Transport", 1)
+    assert index.search("m") == ["Minuman", "Makan"], index.search("m")
+    assert index.search("MA") == ["Makan"]
+    index.add("Mainan", 4)  # evicts the least used term
+    assert len(index) == 3 and index.search("t") == []
+
+    amount, category, description = parse_inline_query("25000 ma")
+    assert (amount, category, description) == (25000, "ma", None), (amount, category, description)
+    assert parse_inline_query("25000 Makan kopi su")[1:] == ("Makan", "kopi su")
+    assert parse_inline_query("abc")[0] is None
+    print("✓ Autocomplete prefix index works")
+
+def test_multi_expense():
+    """Test shorthand amounts and inserting a multi-line message at once"""
+    from decimal import Decimal
+    from database.operations import add_expenses
+    from database.instrumentation import assert_max_queries
+    from utils.validators import parse_expense_lines
+
+    assert validate_amount("25rb")[0] == Decimal("25000")
+    assert validate_amount("1,5jt")[0] == Decimal("1500000")
+    assert validate_amount("Rp 25.000,50")[0] == Decimal("25000.50")
+
+    entries, errors = parse_expense_lines("25rb makan nasi padang\n15k transport\nhalo")
+    assert errors == [(3, "Format tidak dikenali: halo")], errors
+    assert entries[1] == (Decimal("15000"), "transport", None, None), entries
+
+    initialize_database()
+    register_user(555000111, "multi", "Multi", "User")
+    # The user, their spending statistics, one INSERT of the expenses and one of the statistics
+    with assert_max_queries(4):
+        expenses = add_expenses(555000111, entries)
+    assert [expense.amount for expense in expenses] == [Decimal("25000"), Decimal("15000")]
+    print(f"✓ {len(expenses)} expenses added in one transaction")
+
+def test_expense_partitions():
+    """Test archiving a closed year and routing range queries to partitions"""
+    from datetime import date
+    from decimal import Decimal
+    from database.models import get_session, Expense, User
+    from database.partitions import archive_closed_years, partitions_for_range
+
+    initialize_database()
+    register_user(444000222, "archive", "Archive", "User")
+    session = get_session()
+    user = session.query(User).filter(User.telegram_user_id == 444000222).first()
+    old_year = date.today().year - 5
+    session.add(Expense(user_id=user.user_id, amount=Decimal("12000"), category="Makan", date=date(old_year, 6, 1),
+                        description="nasi uduk arsip"))
+    session.commit()
+    session.close()
+
+    assert archive_closed_years() >= 1
+    tables = [table.name for table in partitions_for_range(date(old_year, 1, 1), date(old_year, 12, 31))]
+    assert tables == [f"expenses_{old_year}"], tables
+    assert "expenses" in [table.name for table in partitions_for_range(date.today(), date.today())]
+
+    archived = get_user_expenses(444000222, date(old_year, 1, 1), date(old_year, 12, 31))
+    assert [expense.amount for expense in archived] == [Decimal("12000")]
+
+    # Searched through the archive's own FTS5 index, not a LIKE scan
+    from sqlalchemy import inspect
+    from database.models import get_engine
+    from database.operations import search_expenses
+    assert inspect(get_engine(0)).has_table(f"expenses_{old_year}_fts")
+    result = search_expenses(444000222, "uduk ars")
+    assert result['count'] == 1 and result['matches'][0].date == date(old_year, 6, 1), result
+    assert search_expenses(444000333, "uduk")['count'] == 0
+    print(f"✓ {old_year} archived and still readable")
+
+def test_sharding():
+    """Test routing users to SQLite shards and rebalancing them"""
+    import tempfile
+    from datetime import date, datetime
+    from decimal import Decimal
+    import config
+    from database.models import (
+        ExchangeRate, StatsSketch, dispose_engine, get_session, parse_sharded_url, shard_for_user,
+    )
+    from database.operations import get_user_by_telegram_id
+    from tools.rebalance_shards import rebalance
+
+    assert parse_sharded_url("sqlite:///expenses.db") is None
+    assert parse_sharded_url("sharded+sqlite:///data/e.db?shards=2") == ["sqlite:///data/e.0.db", "sqlite:///data/e.1.db"]
+
+    original_url = config.DATABASE_URL
+    directory = tempfile.mkdtemp()
+    two_shards = f"sharded+sqlite:///{directory}/e.db?shards=2"
+    try:
+        config.DATABASE_URL = two_shards
+        dispose_engine()
+        initialize_database()
+        telegram_user_ids = range(700000, 700010)
+        for telegram_user_id in telegram_user_ids:
+            register_user(telegram_user_id, f"shard{telegram_user_id}")
+            add_expense(telegram_user_id, 1000, "Makan")
+        assert {shard_for_user(t, 2) for t in telegram_user_ids} == {0, 1}
+        assert len(get_users_for_weekly_report()) == 10
+
+        moves = rebalance(two_shards, f"sharded+sqlite:///{directory}/e.db?shards=3")
+        assert sum(moves.values()) > 0
+        for telegram_user_id in telegram_user_ids:
+            assert len(get_user_expenses(telegram_user_id)) == 1
+        assert len(get_users_for_weekly_report()) == 10
+        print(f"✓ Rebalanced {sum(moves.values())} users from 2 to 3 shards")
+
+        # From one file to shards, the tables kept on shard 0 only move to the new shard 0
+        single = f"sqlite:///{directory}/single.db"
+        config.DATABASE_URL = single
+        dispose_engine()
+        initialize_database()
+        register_user(700100, "single")
+        session = get_session(shard=0)
+        session.add(ExchangeRate(currency="USD", date=date(2024, 1, 1), rate=Decimal("15500"), version=1))
+        session.add(StatsSketch(day=date(2024, 1, 1), name="users", data=b"sketch", updated_at=datetime.now()))
+        session.commit()
+        session.close()
+        rebalance(single, f"sharded+sqlite:///{directory}/single.db?shards=2")
+        config.DATABASE_URL = f"sharded+sqlite:///{directory}/single.db?shards=2"
+        dispose_engine()
+        session = get_session(shard=0)
+        assert session.query(ExchangeRate).count() == 1 and session.query(StatsSketch).count() == 1
+        session.close()
+        assert get_user_by_telegram_id(700100) is not None
+        print("✓ Exchange rates and global statistics copied to the new shard 0")
+    finally:
+        config.DATABASE_URL = original_url
+        dispose_engine()
+
+def test_read_replica():
+    """Test read-only queries going to a SQLite copy, except right after a user's own write"""
+    import tempfile
+    import config
+    from database.models import dispose_engine
+    from database.operations import get_expenses_by_period
+    from tools.sqlite_replica import sync_replica
+
+    original = (config.DATABASE_URL, config.DATABASE_READ_URL, config.READ_YOUR_WRITES_SECONDS)
+    directory = tempfile.mkdtemp()
+    try:
+        config.DATABASE_URL = f"sqlite:///{directory}/primary.db"
+        config.DATABASE_READ_URL = f"sqlite:///{directory}/replica.db"
+        dispose_engine()
+        initialize_database()
+        register_user(600000001, "replica")
+        sync_replica(config.DATABASE_URL, config.DATABASE_READ_URL)
+
+        add_expense(600000001, 20000, "Makan")
+        # Sticky: the replica doesn't have the expense yet, but the user sees it
+        assert len(get_expenses_by_period(600000001, "today")) == 1
+
+        config.READ_YOUR_WRITES_SECONDS = 0
+        add_expense(600000001, 30000, "Makan")
+        assert len(get_expenses_by_period(600000001, "today")) == 0, "should read the stale replica"
+        sync_replica(config.DATABASE_URL, config.DATABASE_READ_URL)
+        assert len(get_expenses_by_period(600000001, "today")) == 2
+        print("✓ Reads routed to the replica with read-your-writes")
+    finally:
+        config.DATABASE_URL, config.DATABASE_READ_URL, config.READ_YOUR_WRITES_SECONDS = original
+        dispose_engine()
+
+def test_history_pages():
+    """Test keyset pages of /riwayat and the compact cursor in the callback data"""
+    from datetime import date
+    from database.operations import get_expense_page
+    from handlers.history import encode_cursor, decode_cursor
+
+    initialize_database()
+    register_user(333000444, "history", "History", "User")
+    for amount in range(1, 6):
+        add_expense(333000444, amount * 1000, "Makan")
+
+    first, more = get_expense_page(333000444, limit=3)
+    assert [int(e.amount) for e in first] == [5000, 4000, 3000] and more
+    data = encode_cursor(False, first[-1].date, first[-1].expense_id)
+    assert len(data.encode()) <= 64 and decode_cursor(data) == (False, (first[-1].date, first[-1].expense_id))
+
+    second, more = get_expense_page(333000444, decode_cursor(data)[1], limit=3)
+    assert [int(e.amount) for e in second] == [2000, 1000] and not more
+    back, more = get_expense_page(333000444, (second[0].date, second[0].expense_id), newer=True, limit=3)
+    assert [int(e.amount) for e in back] == [5000, 4000, 3000] and not more
+    assert decode_cursor(encode_cursor(True, date(2024, 2, 29), 123456))[1] == (date(2024, 2, 29), 123456)
+    print(f"✓ History pages with cursor {data}")
+
+def test_search():
+    """Test /cari full-text search through the FTS5 index"""
+    from decimal import Decimal
+    from database.operations import search_expenses
+    from handlers.search import parse_search_args
+
+    initialize_database()
+    register_user(222000555, "search", "Search", "User")
+    add_expense(222000555, 18000, "Makan", "kopi susu gula aren")
+    add_expense(222000555, 22000, "Makan", "Kopi hitam")
+    add_expense(222000555, 50000, "Transportasi", "bensin")
+
+    result = search_expenses(222000555, "kop")
+    assert result['count'] == 2 and result['total'] == Decimal("40000"), result
+    assert search_expenses(222000555, "kopi susu")['count'] == 1
+    assert search_expenses(222000555, "transport")['count'] == 1
+    assert search_expenses(123456789, "kopi")['count'] == 0  # other users' rows never match
+
+    query, start_date, end_date = parse_search_args(["kopi", "susu", "2024-01-01", "2024-01-31"])
+    assert query == "kopi susu" and str(start_date) == "2024-01-01" and str(end_date) == "2024-01-31"
+    assert search_expenses(222000555, "kopi", start_date, end_date)['count'] == 0
+    print(f"✓ Search found {result['count']} expenses for 'kop'")
+
+def test_recurring_expenses():
+    """Test recurring expense rules and idempotent catch-up"""
+    from datetime import date, timedelta
+    from database.models import get_session, RecurringExpense, SpendingStat, User
+    from database.operations import add_recurring_expense, materialize_recurring_expenses
+    from utils.recurrence import parse_schedule, next_occurrence
+
+    assert parse_schedule("harian") == ("* * *", None)
+    assert parse_schedule("senin")[0] == "* * mon"
+    assert parse_schedule("1,15 * *")[0] == "1,15 * *"
+    assert parse_schedule("31 2 *")[1] is not None  # February 31st never comes
+    assert next_occurrence("last * *", date(2024, 2, 1)) == date(2024, 2, 29)
+
+    initialize_database()
+    register_user(222000666, "recurring", "Recurring", "User")
+    rule = add_recurring_expense(222000666, "* * *", 15000, "Makan", "langganan kopi")
+
+    # Pretend the bot was down for three days
+    today = date.today()
+    session = get_session(222000666)
+    session.query(RecurringExpense).filter(RecurringExpense.rule_id == rule.rule_id).update(
+        {"next_run": today - timedelta(days=3)}
+    )
+    session.commit()
+    session.close()
+
+    created = materialize_recurring_expenses(today)
+    assert created >= 4, created
+    assert materialize_recurring_expenses(today) == 0  # catch-up already happened
+    session = get_session(222000666)
+    assert session.get(RecurringExpense, rule.rule_id).next_run == today + timedelta(days=1)
+    # Materialized expenses feed the spending statistics like typed ones
+    stat = session.query(SpendingStat).join(User, User.user_id == SpendingStat.user_id).filter(
+        User.telegram_user_id == 222000666, SpendingStat.category == "Makan"
+    ).one()
+    assert stat.count == 4, stat.count  # Three missed days and today
+    session.close()
+    print(f"✓ Recurring expenses materialized {created} missed runs once")
+
+def test_multi_currency():
+    """Test expenses in foreign currencies converted to the base currency for reports"""
+    from datetime import date
+    from decimal import Decimal
+    from database.models import get_session, Expense, User
+    from database.operations import (
+        get_expenses_by_period, get_user_by_telegram_id, search_expenses, set_base_currency, set_monthly_budget,
+    )
+    from database.rates import load_rates, convert_amounts
+    from utils.formatters import format_budget_message
+    from utils.validators import validate_money
+
+    assert validate_money("12,5usd") == (Decimal("12.5"), "USD", None)
+    assert format_currency(Decimal("1234.5"), "SGD") == "S$1.234,50"
+
+    initialize_database()
+    load_rates([
+        ("USD", date(2024, 1, 1), 15000),
+        ("USD", date(2024, 1, 10), 16000),
+        ("SGD", date(2024, 1, 1), 12000),
+    ])
+    # Latest rate on or before each date, the first known rate before that
+    converted = convert_amounts(
+        [10, 10, 10, 24000], ["USD", "USD", "USD", "IDR"],
+        [date(2023, 12, 1), date(2024, 1, 9), date(2024, 1, 10), date(2024, 1, 10)], "SGD"
+    )
+    assert [round(value, 2) for value in converted] == [12.5, 12.5, 13.33, 2.0], converted
+
+    register_user(222000777, "traveler", "Travel", "User")
+    session = get_session(222000777)
+    user = session.query(User).filter(User.telegram_user_id == 222000777).one()
+    session.query(Expense).filter(Expense.user_id == user.user_id).delete()
+    session.add_all([
+        Expense(user_id=user.user_id, amount=Decimal("10"), currency="USD", category="Makan",
+                description="travel ramen", date=date(2024, 1, 10)),
+        Expense(user_id=user.user_id, amount=Decimal("40000"), category="Makan",
+                description="travel nasi", date=date(2024, 1, 10)),
+    ])
+    session.commit()
+    session.close()
+
+    expenses = get_expenses_by_period(222000777, "2024-01-01 2024-01-31")
+    assert sum(expense.amount for expense in expenses) == Decimal("200000"), expenses
+    assert search_expenses(222000777, "travel")['total'] == Decimal("200000")
+    set_monthly_budget(222000777, Decimal("4800000"))
+    set_base_currency(222000777, "USD")
+    expenses = get_expenses_by_period(222000777, "2024-01-01 2024-01-31")
+    assert sum(expense.amount for expense in expenses) == Decimal("12.50")
+    # The budget moves to the new base currency with the expenses it is compared to
+    budget = get_user_by_telegram_id(222000777).monthly_budget
+    assert budget == Decimal("300.00"), budget
+    assert "US$300,00" in format_budget_message(budget, Decimal("12.50"), currency="USD")
+    print("✓ Foreign currency expenses converted for reports")
+
+def test_columnar_dump_batches():
+    """Test the chunked, watermarked expense reads of the columnar dump"""
+    from datetime import datetime, timedelta
+    from tools.dump_columnar import expense_queries, iter_batches, read_engine
+
+    initialize_database()
+    register_user(222000888, "analyst", "Analyst", "User")
+    add_expense(222000888, 12000, "Makan", "dump")
+
+    def dumped(since):
+        batches = [rows for query in expense_queries(0, since) for rows in iter_batches(read_engine(0), query, 2)]
+        assert all(len(rows) <= 2 for rows in batches)
+        return sum(len(rows) for rows in batches)
+
+    total = dumped(None)
+    assert total >= 1
+    assert dumped(datetime.now() + timedelta(minutes=1)) == 0  # nothing new since the watermark
+    print(f"✓ Columnar dump reads {total} expenses in batches")
+
+def test_report_charts():
+    """Test the pre-aggregated arrays and the single-figure report charts"""
+    from datetime import date
+    from database.operations import get_daily_totals
+    from utils.charts import chart_range, daily_series, monthly_trend, calendar_grid, create_report_charts
+
+    dates = [date(2024, 3, 1), date(2024, 3, 1), date(2024, 3, 3), date(2023, 12, 31)]
+    totals = [10.0, 5.0, 7.0, 99.0]
+    assert list(daily_series(dates, totals, date(2024, 3, 1), date(2024, 3, 3))) == [15.0, 0.0, 7.0]
+    names, matrix = monthly_trend(dates, ["Makan", "Kopi", "Makan", "Makan"], totals, date(2024, 3, 31))
+    assert names == ["Makan", "Kopi"] and matrix.shape == (2, 12) and matrix[0, -1] == 17.0
+    grid = calendar_grid(dates, totals, 2024)
+    assert grid.shape == (7, 53) and grid[4, 8] == 15.0  # 1 March 2024 was a Friday of week 9
+    assert chart_range(date(2024, 3, 1), date(2024, 3, 31)) == (date(2023, 4, 1), date(2024, 12, 31))
+
+    initialize_database()
+    register_user(222000999, "charts", "Chart", "User")
+    add_expense(222000999, 30000, "Makan", "chart")
+    today = date.today()
+    data = get_daily_totals(222000999, *chart_range(today.replace(day=1), today))
+    assert sum(data['totals']) == 30000 and data['currency'] == "IDR"
+    png = create_report_charts(data, today.replace(day=1), today).getvalue()
+    assert png.startswith(b"\x89PNG"), png[:8]
+    print(f"✓ Report charts rendered as one {len(png) // 1024} KB image")
+
+def test_webhook_ingress():
+    """Secret check, decoding and load shedding of webhook deliveries"""
+    import json
+    from collections import deque
+    from main import build_application
+    from handlers.dispatcher import LaneApplication
+    from handlers.webhook import WebhookIngress
+
+    application = build_application("123:TEST", serve_metrics=False)
+    assert isinstance(application, LaneApplication)
+    queue = application.update_queue
+    ingress = WebhookIngress(application, "/hook", "s3cret")
+    headers = {"x-telegram-bot-api-secret-token": "s3cret"}
+    body = json.dumps({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "/start",
+    }}).encode()
+
+    assert ingress.handle_delivery({}, body) == 403
+    assert ingress.handle_delivery({"x-telegram-bot-api-secret-token": "wrong"}, body) == 403
+    assert ingress.handle_delivery(headers, b"{not json") == 400
+    assert ingress.handle_delivery(headers, body) == 200
+    assert queue.get_nowait().update_id == 1 and queue.pending == 1
+
+    queue.max_pending = 1
+    assert ingress.handle_delivery(headers, body) == 503
+    assert b"Retry-After: 1" in ingress._respond(503)
+    queue.task_done()
+    assert queue.pending == 0 and ingress.handle_delivery(headers, body) == 200
+
+    # A full lane refuses its user's deliveries, other users still get through
+    queue.get_nowait()
+    queue.task_done()
+    queue.max_pending = 100
+    application._lanes[7] = deque([None] * application.lane_max_depth)
+    assert ingress.handle_delivery(headers, body) == 503
+    other = body.replace(b'"id": 7', b'"id": 8')
+    assert ingress.handle_delivery(headers, other) == 200
+    del application._lanes[7]
+    print("✓ Webhook rejected bad secrets and bodies and shed load when full")
+
+def test_update_deduplication():
+    """Redelivered updates are dropped from memory and, after a restart, from the table"""
+    from datetime import datetime, timedelta
+    from telegram import Chat, Message, Update, User
+    from telegram.ext import Application
+    from database.operations import _claimed_updates, claim_update, sweep_processed_updates
+    from database.models import ProcessedUpdate, get_session
+    from handlers.webhook import install_update_deduplication
+
+    initialize_database()
+    assert claim_update(9001, 333000111) is True
+    assert claim_update(9001, 333000111) is False  # From memory
+    _claimed_updates.clear()
+    assert claim_update(9001, 333000111) is False  # From the table, as after a restart
+
+    handled = []
+
+    async def fake_process_update(update):
+        handled.append(update.update_id)
+
+    application = Application.builder().token("123:TEST").build()
+    application.process_update = fake_process_update
+    install_update_deduplication(application)
+    user = User(333000111, "Test", False)
+    update = Update(9002, message=Message(1, datetime.now(), Chat(333000111, "private"), from_user=user, text="1"))
+    for _ in range(3):
+        asyncio.run(application.process_update(update))
+    assert handled == [9002], handled
+
+    session = get_session(333000111)
+    try:
+        session.query(ProcessedUpdate).filter(ProcessedUpdate.update_id == 9001).update(
+            {ProcessedUpdate.received_at: datetime.now() - timedelta(days=2)}
+        )
+        session.commit()
+    finally:
+        session.close()
+    assert sweep_processed_updates() >= 1
+    print("✓ Redelivered updates were handled once")
+
+def test_outbound_scheduler():
+    """Interactive sends go first, queued texts to one chat are merged, chats are paced"""
+    from telegram.error import RetryAfter
+    from utils.outbound import INTERACTIVE, SCHEDULED, OutboundScheduler
+
+    sent = []
+    flood_waits = [RetryAfter(0)]
+
+    async def fake_post(endpoint, data, **kwargs):
+        if data.get("text") == "flood" and flood_waits:
+            raise flood_waits.pop()
+        sent.append((data["chat_id"], data.get("text")))
+        return {"message_id": len(sent)}
+
+    async def run():
+        scheduler = OutboundScheduler(rate=1000, burst=1, chat_rate=1000, chat_burst=1, interactive_reserve=0)
+        await scheduler.initialize()
+        send = lambda chat_id, text, priority=None: scheduler.process_request(
+            fake_post, (), {}, "sendMessage", {"chat_id": chat_id, "text": text}, priority
+        )
+        results = await asyncio.gather(
+            send(1, "laporan", SCHEDULED), send(2, "a"), send(2, "b"), send(3, "flood", INTERACTIVE)
+        )
+        await scheduler.shutdown()
+        return results
+
+    results = asyncio.run(run())
+    assert sent == [(2, "a\n\nb"), (3, "flood"), (1, "laporan")], sent
+    assert results[1] == results[2]  # Both callers get the merged message
+    print("✓ Outbound sends prioritized, coalesced and retried after a flood wait")
+
+def test_spending_anomalies():
+    """Running statistics match a full recomputation and unusual amounts are flagged"""
+    import math
+    from types import SimpleNamespace
+    import numpy as np
+    from utils.anomaly import fold
+    from utils.formatters import format_expense_message
+
+    amounts = [12000, 30000, 18000, 25000, 9000, 40000]
+    stats = SimpleNamespace(count=0, weight=0.0, mean=0.0, m2=0.0)
+    for amount in amounts:
+        fold(stats, amount, decay=1.0)  # Without decay this is plain Welford
+    logs = np.log(amounts)
+    assert math.isclose(stats.mean, logs.mean()) and math.isclose(stats.m2 / stats.weight, logs.var())
+
+    initialize_database()
+    register_user(444000222, "anomaly", "Anomaly", "User")
+    for amount in amounts:
+        assert add_expense(444000222, amount, "Kopi").anomaly is None
+    expense = add_expense(444000222, 900000, "Kopi")
+    assert expense.anomaly and expense.anomaly['kind'] == 'category', expense.anomaly
+    assert "⚠️" in format_expense_message(expense)
+    assert add_expense(444000222, 22000, "Kopi").anomaly is None
+    # A currency without exchange rates is still recorded, it just isn't scored
+    assert add_expense(444000222, 12.5, "Kopi", currency="XTS").anomaly is None
+
+    # Switching the base currency converts the statistics instead of flagging everything
+    from datetime import date
+    from database.operations import set_base_currency
+    from database.rates import load_rates
+    load_rates([("USD", date(2024, 1, 1), 15000), ("USD", date(2024, 1, 10), 16000), ("SGD", date(2024, 1, 1), 12000)])
+    register_user(444000333, "rebase", "Rebase", "User")
+    set_base_currency(444000333, "USD")
+    for amount in (3, 4.5, 2.5, 5, 3.5, 4):
+        add_expense(444000333, amount, "Kopi")
+    set_base_currency(444000333, "IDR")
+    assert add_expense(444000333, 60000, "Kopi").anomaly is None
+    assert add_expense(444000333, 2000000, "Kopi").anomaly['kind'] == 'category'
+    print("✓ Unusual expense flagged from running statistics")
+
+def test_month_forecast():
+    """Month-end projection from pace and history, read back from the nightly cache"""
+    from datetime import date, timedelta
+    import numpy as np
+    from database.forecast import HISTORY_MONTHS, get_month_forecast, project_month_end, refresh_forecasts
+
+    # 3000 every past month, half of it by day 15; this month is on the same pace
+    totals = np.full((2, HISTORY_MONTHS + 1), 3000.0)
+    to_date = np.full_like(totals, 1500.0)
+    totals[:, -1] = 1500.0
+    totals[1, :-1] = 0.0  # No history: pace only
+    totals[1, -1] = 1000.0
+    projected = project_month_end(totals, to_date, days_elapsed=15, days_in_month=30)
+    assert np.allclose(projected, [3000.0, 2000.0]), projected
+
+    initialize_database()
+    register_user(666000333, "forecast", "Forecast", "User")
+    add_expense(666000333, 40000, "Makan")
+    tomorrow = date.today() + timedelta(days=1)
+    assert refresh_forecasts(tomorrow) >= 1
+    forecast = get_month_forecast(666000333, tomorrow)
+    assert forecast['categories']['Makan'] >= 40000 and forecast['currency'] == "IDR", forecast
+    print(f"✓ Month-end forecast {forecast['total']:.0f} served from the cache")
+
+def test_report_command():
+    """/laporan replies once, also for users who never ran /start"""
+    from types import SimpleNamespace
+    from handlers.reports import report_command
+
+    class FakeMessage:
+        def __init__(self):
+            self.replies = []
+
+        def get_bot(self):
+            return SimpleNamespace()
+
+        async def reply_text(self, text):
+            self.replies.append(text)
+
+        async def reply_photo(self, photo, caption=None):
+            self.replies.append(caption)
+
+    def run(telegram_user_id, *args):
+        message = FakeMessage()
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=telegram_user_id), message=message)
+        asyncio.run(report_command(update, SimpleNamespace(args=list(args))))
+        return message.replies
+
+    initialize_database()
+    replies = run(999000222, "bulan")  # Not registered
+    assert len(replies) == 1 and not replies[0].startswith("❌"), replies
+    print("✓ Monthly report of an unregistered user sent once")
+
+    def failing_charts(*args):
+        raise RuntimeError("matplotlib failed")
+
+    import handlers.reports
+    create_report_charts = handlers.reports.create_report_charts
+    handlers.reports.create_report_charts = failing_charts
+    try:
+        replies = run(999000222, "bulan", "grafik")
+    finally:
+        handlers.reports.create_report_charts = create_report_charts
+    assert len(replies) == 2 and replies[1] == "❌ Grafik gagal dibuat", replies
+    print("✓ A failing chart did not send the report again")
+
+def test_global_stats():
+    """Sketch accuracy, and admin statistics merged from stored and unflushed sketches"""
+    import random
+    from datetime import date
+    from decimal import Decimal
+    from types import SimpleNamespace
+    from database.stats import flush_stats, get_global_stats, record_expenses
+    from utils.formatters import format_global_stats
+    from utils.sketches import DDSketch, HyperLogLog
+
+    # Two halves merged count like one sketch of all values
+    halves = HyperLogLog(), HyperLogLog()
+    for value in range(50000):
+        halves[value % 2].add(value)
+    estimate = halves[0].merge(halves[1]).count()
+    assert abs(estimate - 50000) / 50000 < 0.05, estimate
+
+    rng = random.Random(7)
+    amounts = [rng.lognormvariate(10, 1.5) for _ in range(20000)]
+    sketches = DDSketch(), DDSketch()
+    for i, amount in enumerate(amounts):
+        sketches[i % 2].add(amount)
+    merged = DDSketch.from_bytes(sketches[0].merge(sketches[1]).to_bytes())
+    ordered = sorted(amounts)
+    for q in (0.5, 0.9, 0.99):
+        exact = ordered[int(q * (len(ordered) - 1))]
+        assert abs(merged.quantile(q) - exact) / exact <= 0.011, (q, merged.quantile(q), exact)
+
+    initialize_database()
+    register_user(777000444, "stats", "Stats", "User")
+    before = get_global_stats(days=7)
+    add_expense(777000444, 50000, "makan")
+    flush_stats()
+    add_expense(777000444, 70000, "Hobi kucing")  # Still in memory
+    after = get_global_stats(days=7)
+    assert after['period'].count == before['period'].count + 2, (before['period'].count, after['period'].count)
+    assert after['categories']['Makan'].count >= 1 and after['categories']['Kategori sendiri'].count >= 1
+    assert after['users']['today'] >= 1
+    flush_stats()
+    assert get_global_stats(days=7)['period'].count == after['period'].count
+
+    # An expense in a currency without rates (USD before load_rates ran; the earlier tests
+    # load USD, so XTS stands in) counts the user but no amount
+    day = date(2001, 1, 1)
+    record_expenses(777000444, [
+        SimpleNamespace(amount=Decimal("12.50"), currency="XTS", date=day, category="Transportasi"),
+        SimpleNamespace(amount=Decimal("30000"), currency="IDR", date=day, category="Makan"),
+    ])
+    old = get_global_stats(days=1, today=day)
+    assert old['users']['period'] == 1 and old['period'].count == 1
+    assert 'Transportasi' not in old['categories'], old['categories']
+    assert "Transportasi" not in format_global_stats(old)
+    print(f"✓ Global statistics of {after['users']['period']} users from mergeable sketches")
+
+def test_shutdown_flush():
+    """The webhook runner calls the shutdown hooks, which store the pending statistics"""
+    import os
+    import signal
+    from types import SimpleNamespace
+    from database import stats
+    from handlers.webhook import BoundedUpdateQueue, run_webhook
+    from main import build_application, install_scheduler
+
+    calls = []
+
+    class FakeApplication:
+        update_queue = BoundedUpdateQueue(10)
+        post_init = None
+
+        def __init__(self):
+            self.bot = SimpleNamespace(set_webhook=self.set_webhook)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            calls.append("shutdown")
+
+        async def start(self):
+            calls.append("start")
+
+        async def stop(self):
+            calls.append("stop")
+
+        async def set_webhook(self, **kwargs):
+            os.kill(os.getpid(), signal.SIGTERM)  # As a deploy stopping the bot
+
+        async def post_stop(self, app):
+            calls.append("post_stop")
+
+        async def post_shutdown(self, app):
+            calls.append("post_shutdown")
+
+    asyncio.run(run_webhook(FakeApplication(), "127.0.0.1", 0, "https://example.invalid/hook", "/hook"))
+    assert calls == ["start", "stop", "post_stop", "shutdown", "post_shutdown"], calls
+
+    initialize_database()
+    register_user(777000555, "shutdown", "Shutdown", "User")
+    application = build_application("123:TEST", serve_metrics=False)
+    install_scheduler(application)
+    add_expense(777000555, 45000, "Makan")
+    assert stats._pending
+    asyncio.run(application.post_shutdown(application))
+    assert not stats._pending
+    print("✓ Pending statistics stored on shutdown")
+
+def test_metrics():
+    """Histogram buckets, exposition text, handler error counting and the /metrics listener"""
+    from types import SimpleNamespace
+    from sqlalchemy import create_engine, text
+    from database.instrumentation import assert_max_queries
+    from database.models import get_engine
+    from handlers.expenses import guided_step_name
+    from utils.metrics import (
+        HANDLER_ERRORS, REGISTRY, Histogram, attach_engine_metrics, start_metrics_server, track_handler,
+    )
+
+    histogram = Histogram("test_wait_seconds", "Test histogram", ["kind"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, kind="a")
+    text_body = REGISTRY.render()
+    assert "# TYPE test_wait_seconds histogram" in text_body and text_body.endswith("\n")
+    for line in ('test_wait_seconds_bucket{kind="a",le="0.1"} 1', 'test_wait_seconds_bucket{kind="a",le="1"} 2',
+                 'test_wait_seconds_bucket{kind="a",le="+Inf"} 3', 'test_wait_seconds_count{kind="a"} 3',
+                 'test_wait_seconds_sum{kind="a"} 5.55'):
+        assert line in text_body, line
+
+    async def failing(update, context):
+        raise RuntimeError("boom")
+
+    errors = HANDLER_ERRORS.value(handler="test_failing")
+    try:
+        asyncio.run(track_handler("test_failing", failing)(None, None))
+    except RuntimeError:
+        pass
+    assert HANDLER_ERRORS.value(handler="test_failing") == errors + 1
+    assert 'quillie_handler_duration_seconds_count{handler="test_failing"}' in REGISTRY.render()
+
+    # A failed statement doesn't leave its start time behind
+    engine = create_engine("sqlite://")
+    attach_engine_metrics(engine)
+    with engine.connect() as conn:
+        try:
+            conn.execute(text("SELECT * FROM missing_table"))
+        except Exception:
+            pass
+        conn.execute(text("SELECT 1"))
+        assert conn.info["query_started"] == []
+    with get_engine(0).connect() as conn:
+        try:
+            conn.execute(text("SELECT * FROM missing_table"))
+        except Exception:
+            pass
+        assert not conn.info.get("query_started") and not conn.info.get("scope_query_started")
+
+    # The metric label of a guided step comes from the cache only, a user not in it costs no query
+    initialize_database()
+    with assert_max_queries(0):
+        assert guided_step_name(SimpleNamespace(effective_user=SimpleNamespace(id=999000111))) == "guided_amount"
+
+    async def scrape(path):
+        server = await start_metrics_server("127.0.0.1", 0)
+        try:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = asyncio.run(scrape("/metrics"))
+    assert response.startswith("HTTP/1.1 200 OK") and "test_wait_seconds_count" in response
+    assert asyncio.run(scrape("/nothing")).startswith("HTTP/1.1 404")
+    print("✓ Metrics rendered and served")
+
+def test_update_profiler():
+    """Slow updates get stack samples recorded, in a bounded ring served by the dump"""
+    import time
+    from types import SimpleNamespace
+    from utils.profiler import UpdateProfiler
+
+    def slow_report_work():
+        time.sleep(0.05)  # Blocks the event loop like a slow query would
+
+    async def process_update(update):
+        if update.effective_message.text.startswith("/laporan"):
+            slow_report_work()
+
+    def make_update(text):
+        return SimpleNamespace(
+            effective_message=SimpleNamespace(text=text), effective_user=SimpleNamespace(id=5),
+            callback_query=None, inline_query=None,
+        )
+
+    profiler = UpdateProfiler(threshold_ms=20, sample_interval_ms=1, ring_size=2)
+    application = SimpleNamespace(process_update=process_update)
+    profiler.install(application)
+
+    async def run():
+        await application.process_update(make_update("/start"))  # Fast, not recorded
+        for _ in range(3):
+            await application.process_update(make_update("/laporan bulan"))
+
+    asyncio.run(run())
+    assert len(profiler.profiles) == 2  # The ring keeps only the latest ring_size profiles
+    profile = profiler.profiles[-1]
+    assert profile["command"] == "/laporan" and profile["duration_ms"] >= 20 and profile["samples"] > 0
+    assert any("slow_report_work" in stack for stack, _ in profile["stacks"]), profile["stacks"]
+    dump = profiler.dump()
+    assert dump.count("== ") == 2 and "/laporan" in dump and "/start" not in dump
+    print(f"✓ Slow updates profiled with {profile['samples']} stack samples")
+
 if __name__ == "__main__":
     test_database()
+    test_update_lanes()
+    test_flow_state()
+    test_loadtest_smoke()
+    test_query_instrumentation()
+    test_category_cache()
+    test_autocomplete()
+    test_multi_expense()
+    test_expense_partitions()
+    test_sharding()
+    test_read_replica()
+    test_history_pages()
+    test_search()
+    test_recurring_expenses()
+    test_multi_currency()
+    test_columnar_dump_batches()
+    test_report_charts()
+    test_webhook_ingress()
+    test_update_deduplication()
+    test_outbound_scheduler()
+    test_spending_anomalies()
+    test_month_forecast()
+    test_report_command()
+    test_global_stats()
+    test_shutdown_flush()
+    test_metrics()
+    test_update_profiler()
     print("\\n✓ All tests completed successfully!")
@@ -0,0 +1,275 @@
+"""Benchmarks for the database functions and utils/formatters.py.
+
+Every dataset size gets a fresh SQLite database seeded by tools.seed_data. Results are
+written as JSON so runs can be compared, and --compare fails on regressions:
+
+    python -m tools.benchmark --sizes 100x100,1000x500 --json bench.json
+    python -m tools.benchmark --json new.json --compare bench.json --threshold 0.25
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+DEFAULT_SIZES = "100x100,500x200,1000x500"
+
+
+def parse_size(size):
+    """Parse "USERSxEXPENSES" into a tuple of ints"""
+    users, expenses = size.lower().split("x")
+    return int(users), int(expenses)
+
+
+def measure(fn, iterations, warmup=3):
+    """Run fn repeatedly and return timing statistics in milliseconds"""
+    for _ in range(min(warmup, iterations)):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    return {
+        "iterations": iterations,
+        "mean_ms": round(mean, 4),
+        "p50_ms": round(samples[len(samples) // 2], 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        "ops_per_s": round(1000 / mean, 1) if mean else 0.0,
+    }
+
+
+def database_benchmarks(rng, telegram_user_ids):
+    """Return (name, fn, iterations) for every public function in database/operations.py,
+    database/forecast.py and database/stats.py"""
+    from database import forecast
+    from database import operations as ops
+    from database import stats
+
+    def any_user():
+        return rng.choice(telegram_user_ids)
+
+    new_user_ids = itertools.count(telegram_user_ids[-1] + 1)
+    category_names = (f"Bench{i}" for i in itertools.count())
+    today = date.today()
+    last_month = (today - timedelta(days=30), today)
+    update_ids = itertools.count(1)
+    # Each run materializes the rules due one day later than the previous run
+    run_days = (today + timedelta(days=i) for i in itertools.count(1))
+    rules = []
+    recorded, _ = ops.get_expense_page(telegram_user_ids[0])
+
+    def flush_recorded():
+        # A flush with nothing recorded returns at once, every run gets a page of expenses
+        stats.record_expenses(telegram_user_ids[0], recorded)
+        stats.flush_stats()
+
+    def add_rule():
+        telegram_user_id = any_user()
+        rule = ops.add_recurring_expense(telegram_user_id, "* * *", 150000, "Tagihan", "bench")
+        rules.append((telegram_user_id, rule.rule_id))
+
+    return [
+        ("register_user.new", lambda: ops.register_user(next(new_user_ids), "bench", "Bench", "User"), 200),
+        ("register_user.existing", lambda: ops.register_user(any_user(), "bench", "Bench", "User"), 200),
+        ("get_user_by_telegram_id", lambda: ops.get_user_by_telegram_id(any_user()), 500),
+        ("add_expense", lambda: ops.add_expense(any_user(), 25000, "Makan", "bench"), 500),
+        ("add_expenses.3", lambda: ops.add_expenses(any_user(), [(25000, "Makan", "bench", None)] * 3), 200),
+        ("get_user_expenses.all", lambda: ops.get_user_expenses(any_user()), 100),
+        ("get_user_expenses.30_days", lambda: ops.get_user_expenses(any_user(), *last_month), 200),
+        ("get_expenses_by_period.today", lambda: ops.get_expenses_by_period(any_user(), "today"), 300),
+        ("get_expenses_by_period.week", lambda: ops.get_expenses_by_period(any_user(), "week"), 300),
+        ("get_expenses_by_period.month", lambda: ops.get_expenses_by_period(any_user(), "month"), 300),
+        ("get_expenses_by_period.year", lambda: ops.get_expenses_by_period(any_user(), "year"), 100),
+        ("get_expenses_by_period.custom",
+         lambda: ops.get_expenses_by_period(any_user(), f"{last_month[0]} {last_month[1]}"), 200),
+        ("get_expense_page.first", lambda: ops.get_expense_page(any_user()), 300),
+        ("get_expense_page.older", lambda: ops.get_expense_page(any_user(), (last_month[0], 0)), 300),
+        ("get_expense_page.newer", lambda: ops.get_expense_page(any_user(), (last_month[0], 0), newer=True), 300),
+        ("search_expenses", lambda: ops.search_expenses(any_user(), "makan"), 200),
+        ("search_expenses.30_days", lambda: ops.search_expenses(any_user(), "makan", *last_month), 200),
+        ("get_daily_totals.30_days", lambda: ops.get_daily_totals(any_user(), *last_month), 300),
+        ("get_daily_totals.year", lambda: ops.get_daily_totals(any_user(), today - timedelta(days=365), today), 100),
+        ("get_weekly_expenses_comparison", lambda: ops.get_weekly_expenses_comparison(any_user()), 300),
+        ("get_user_categories", lambda: ops.get_user_categories(any_user()), 500),
+        ("add_user_category.existing", lambda: ops.add_user_category(any_user(), "Kopi"), 200),
+        ("add_user_category.new", lambda: ops.add_user_category(any_user(), next(category_names)), 200),
+        ("resolve_category", lambda: ops.resolve_category(any_user(), "makan"), 500),
+        ("get_frequent_descriptions", lambda: ops.get_frequent_descriptions(any_user()), 200),
+        ("update_weekly_report_setting", lambda: ops.update_weekly_report_setting(any_user(), True), 200),
+        ("set_monthly_budget", lambda: ops.set_monthly_budget(any_user(), 5000000), 200),
+        ("set_base_currency.same", lambda: ops.set_base_currency(any_user(), "IDR"), 200),
+        ("get_users_for_weekly_report", ops.get_users_for_weekly_report, 20),
+        ("add_recurring_expense", add_rule, 200),
+        ("get_recurring_expenses", lambda: ops.get_recurring_expenses(any_user()), 500),
+        ("materialize_recurring_expenses", lambda: ops.materialize_recurring_expenses(next(run_days)), 20),
+        ("delete_recurring_expense", lambda: ops.delete_recurring_expense(*rules.pop()), 100),
+        ("save_flow_state", lambda: ops.save_flow_state(any_user(), 1, amount=25000), 300),
+        ("get_flow_state", lambda: ops.get_flow_state(any_user()), 500),
+        ("clear_flow_state", lambda: ops.clear_flow_state(any_user()), 300),
+        ("cached_flow_step", lambda: ops.cached_flow_step(any_user()), 5000),
+        ("sweep_expired_flow_states", ops.sweep_expired_flow_states, 50),
+        ("claim_update", lambda: ops.claim_update(next(update_ids), any_user()), 500),
+        ("sweep_processed_updates", ops.sweep_processed_updates, 50),
+        ("refresh_forecasts", forecast.refresh_forecasts, 5),
+        ("get_month_forecast", lambda: forecast.get_month_forecast(any_user()), 500),
+        ("record_expenses", lambda: stats.record_expenses(any_user(), recorded), 500),
+        ("flush_stats", flush_recorded, 50),
+        ("get_global_stats", stats.get_global_stats, 50),
+    ]
+
+
+def formatter_benchmarks(rng, telegram_user_ids):
+    """Return (name, fn, iterations) for the formatters, fed with real seeded expenses"""
+    from database.operations import get_daily_totals, get_expenses_by_period, get_weekly_expenses_comparison
+    from utils import charts
+    from utils import formatters as fmt
+
+    heavy_user = telegram_user_ids[0]
+    expenses = get_expenses_by_period(heavy_user, "year")
+    comparison = get_weekly_expenses_comparison(heavy_user)
+    single = expenses[0] if expenses else None
+    start_date, end_date = date.today().replace(month=1, day=1), date.today()
+    categories = [f"Kategori {i}" for i in range(12)]
+    chart_totals = get_daily_totals(heavy_user, *charts.chart_range(start_date, end_date))
+
+    benchmarks = [
+        ("format_currency", lambda: fmt.format_currency(rng.randint(1, 10**9)), 5000),
+        ("format_date_range", lambda: fmt.format_date_range(start_date, end_date), 5000),
+        ("format_expense_summary", lambda: fmt.format_expense_summary(expenses), 200),
+        ("format_weekly_comparison", lambda: fmt.format_weekly_comparison(*comparison), 5000),
+        ("format_report_message",
+         lambda: fmt.format_report_message(expenses, "Tahun Ini", start_date, end_date, comparison), 200),
+        ("format_categories_list", lambda: fmt.format_categories_list(categories), 5000),
+        ("format_budget_message", lambda: fmt.format_budget_message(5000000, 3200000), 5000),
+        ("create_expense_chart", lambda: fmt.create_expense_chart(expenses), 5),
+        ("create_report_charts", lambda: charts.create_report_charts(chart_totals, start_date, end_date), 5),
+    ]
+    if single is not None:
+        benchmarks.append(("format_expense_message", lambda: fmt.format_expense_message(single), 5000))
+    return benchmarks
+
+
+def run_dataset(users, expenses_per_user, years, seed):
+    """Seed a fresh database for one dataset size and run every benchmark on it"""
+    import config
+    from database.models import dispose_engine
+    from tools.seed_data import seed_database
+
+    database_url = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    os.environ["DATABASE_URL"] = database_url
+    config.DATABASE_URL = database_url
+    dispose_engine()
+
+    started = time.perf_counter()
+    telegram_user_ids = seed_database(users, expenses_per_user, years, seed)
+    seed_seconds = time.perf_counter() - started
+    rows = users * expenses_per_user
+
+    dataset = f"{users}x{expenses_per_user}"
+    results = [{
+        "dataset": dataset,
+        "benchmark": "seed.bulk_insert",
+        "iterations": 1,
+        "mean_ms": round(seed_seconds * 1000, 2),
+        "p50_ms": round(seed_seconds * 1000, 2),
+        "p95_ms": round(seed_seconds * 1000, 2),
+        "ops_per_s": round(rows / seed_seconds, 1),
+    }]
+
+    rng = random.Random(seed)
+    for name, fn, iterations in database_benchmarks(rng, telegram_user_ids) + \
+            formatter_benchmarks(rng, telegram_user_ids):
+        stats = measure(fn, iterations)
+        results.append({"dataset": dataset, "benchmark": name, **stats})
+        print(f"  {dataset:<12}{name:<36}{stats['p50_ms']:>10.3f} ms  {stats['ops_per_s']:>10.1f} ops/s")
+
+    dispose_engine()
+    return results
+
+
+def compare_results(current, baseline, threshold):
+    """Return the benchmarks whose median got slower than baseline by more than threshold"""
+    baseline_p50 = {(r["dataset"], r["benchmark"]): r["p50_ms"] for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline_p50.get((result["dataset"], result["benchmark"]))
+        if previous and result["p50_ms"] > previous * (1 + threshold):
+            regressions.append({
+                "dataset": result["dataset"],
+                "benchmark": result["benchmark"],
+                "baseline_p50_ms": previous,
+                "p50_ms": result["p50_ms"],
+                "change": round(result["p50_ms"] / previous - 1, 3),
+            })
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (subprocess.SubprocessError, OSError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark database operations and formatters")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="comma separated USERSxEXPENSES dataset sizes")
+    parser.add_argument("--years", type=int, default=2, help="years of history per dataset")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", default=None, help="write results as JSON")
+    parser.add_argument("--compare", default=None, help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed p50 slowdown before a benchmark counts as regressed")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes.split(","):
+        users, expenses_per_user = parse_size(size)
+        print(f"Dataset {users} users x {expenses_per_user} expenses over {args.years} year(s)")
+        results.extend(run_dataset(users, expenses_per_user, args.years, args.seed))
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": args.sizes,
+            "years": args.years,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print(
+                f"REGRESSION {regression['dataset']} {regression['benchmark']}: "
+                f"{regression['baseline_p50_ms']} ms -> {regression['p50_ms']} ms "
+                f"({regression['change']:+.0%})"
+            )
+        if regressions:
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
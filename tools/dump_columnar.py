@@ -0,0 +1,271 @@
+"""Dump expenses, users and categories to compressed columnar files for offline analysis.
+
+Expenses are written to one directory per month of their date (Hive style, so pyarrow.dataset
+and most query engines read the month as a column), users and categories as full snapshots:
+
+    dump/expenses/month=2024-01/part-20240201T030000-0.parquet
+    dump/users.parquet
+    dump/categories.parquet
+
+Rows are read with plain SELECTs in chunks of --batch-size, never as ORM objects. Every row
+carries the shard it came from, since user IDs are only unique within a shard. Later runs only
+dump expenses created after the watermark saved by the previous run:
+
+    python -m tools.dump_columnar --out dump              # incremental after the first run
+    python -m tools.dump_columnar --out dump --full       # start over
+    python -m tools.dump_columnar --out dump --format ipc # Arrow IPC files instead of Parquet
+
+Needs pyarrow (pip install pyarrow), which the bot itself does not use.
+"""
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+WATERMARK_FILE = "_watermark.json"
+EXTENSIONS = {"parquet": "parquet", "ipc": "arrow"}
+
+# Expenses created within this many seconds of the start wait for the next run, so rows of
+# transactions still in flight are not skipped by the watermark
+WATERMARK_LAG_SECONDS = 60
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("pyarrow is required for columnar dumps: pip install pyarrow")
+    return pyarrow
+
+
+def arrow_schema(pa, table):
+    """Arrow schema matching the columns of a SQLAlchemy table, plus the shard number"""
+    from sqlalchemy import Boolean, Date, DateTime, Integer, Numeric, String
+
+    fields = [pa.field("shard", pa.int16(), nullable=False)]
+    for column in table.columns:
+        column_type = column.type
+        if isinstance(column_type, Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column_type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column_type, Numeric):
+            arrow_type = pa.decimal128(column_type.precision, column_type.scale)
+        elif isinstance(column_type, DateTime):
+            arrow_type = pa.timestamp("us")
+        elif isinstance(column_type, Date):
+            arrow_type = pa.date32()
+        elif isinstance(column_type, String):
+            arrow_type = pa.string()
+        else:
+            raise TypeError(f"No Arrow type for {table.name}.{column.name} ({column_type})")
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+def iter_batches(engine, query, batch_size):
+    """Run a query on a server-side cursor and yield its rows in lists of batch_size"""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+        for rows in result.partitions(batch_size):
+            yield rows
+
+
+def expense_queries(shard, since=None, until=None):
+    """SELECTs of a shard's expenses created in (since, until], one per partition table.
+
+    Archive tables filled before the watermark are skipped: archiving only moves rows
+    that already existed, so everything in them was dumped by an earlier run.
+    """
+    from database.models import Expense, ExpensePartition, get_session
+    from database.partitions import archive_table, archived_years
+
+    years = sorted(archived_years(shard))
+    archived_at = {}
+    if since is not None and years:
+        session = get_session(shard=shard)
+        try:
+            archived_at = dict(session.query(ExpensePartition.year, ExpensePartition.archived_at))
+        finally:
+            session.close()
+
+    tables = [
+        archive_table(year) for year in years
+        if since is None or archived_at.get(year) is None or archived_at[year] > since
+    ]
+    tables.append(Expense.__table__)
+    for table in tables:
+        query = select(table)
+        if since is not None:
+            query = query.where(table.c.created_at > since)
+        if until is not None:
+            query = query.where(table.c.created_at <= until)
+        yield query
+
+
+def read_engine(shard):
+    """The replica of a shard when one is configured, so dumps don't load the primary"""
+    from database.models import get_engine, get_read_shard_urls, get_reader_engine
+    return get_reader_engine(shard) if get_read_shard_urls() else get_engine(shard)
+
+
+class _Writer:
+    """Compressed Parquet or Arrow IPC file written one record batch at a time.
+
+    The data goes to a hidden temporary file (readers skip names starting with a dot)
+    that commit() renames, so an interrupted dump never leaves half a file behind.
+    """
+
+    def __init__(self, pa, path, schema, file_format):
+        directory, name = os.path.split(path)
+        os.makedirs(directory or ".", exist_ok=True)
+        self.path = path
+        self.temporary_path = os.path.join(directory, f".{name}.tmp")
+        self._sink = None
+        if file_format == "parquet":
+            self._writer = pa.parquet.ParquetWriter(self.temporary_path, schema, compression="zstd")
+        else:
+            self._sink = pa.OSFile(self.temporary_path, "wb")
+            self._writer = pa.ipc.new_file(
+                self._sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+            )
+
+    def write(self, batch):
+        self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+
+    def commit(self):
+        os.replace(self.temporary_path, self.path)
+
+
+def _record_batch(pa, schema, shard, rows):
+    columns = [pa.array([shard] * len(rows), type=pa.int16())]
+    for index, arrow_type in enumerate(schema.types[1:]):
+        columns.append(pa.array([row[index] for row in rows], type=arrow_type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def dump_snapshot(pa, table, path, file_format, batch_size):
+    """Write a whole small table from every shard into one file, returns the row count"""
+    from database.models import get_shard_count
+
+    schema = arrow_schema(pa, table)
+    writer = _Writer(pa, path, schema, file_format)
+    count = 0
+    try:
+        for shard in range(get_shard_count()):
+            for rows in iter_batches(read_engine(shard), select(table), batch_size):
+                writer.write(_record_batch(pa, schema, shard, rows))
+                count += len(rows)
+    finally:
+        writer.close()
+    writer.commit()
+    return count
+
+
+def dump_expenses(pa, out, file_format, batch_size, since, until, run_id):
+    """Write the expenses created in (since, until] into month directories, returns the row count"""
+    from database.models import Expense, get_shard_count
+
+    schema = arrow_schema(pa, Expense.__table__)
+    date_index = list(Expense.__table__.columns.keys()).index("date")
+    extension = EXTENSIONS[file_format]
+    count = 0
+    finished = []
+    for shard in range(get_shard_count()):
+        writers = {}
+        try:
+            for query in expense_queries(shard, since, until):
+                for rows in iter_batches(read_engine(shard), query, batch_size):
+                    by_month = {}
+                    for row in rows:
+                        by_month.setdefault(row[date_index].strftime("%Y-%m"), []).append(row)
+                    for month, month_rows in by_month.items():
+                        writer = writers.get(month)
+                        if writer is None:
+                            path = os.path.join(
+                                out, "expenses", f"month={month}", f"part-{run_id}-{shard}.{extension}"
+                            )
+                            writer = writers[month] = _Writer(pa, path, schema, file_format)
+                        writer.write(_record_batch(pa, schema, shard, month_rows))
+                    count += len(rows)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        finished.extend(writers.values())
+    # Files only get their final names once every shard is done, a failed run leaves none behind
+    for writer in finished:
+        writer.commit()
+    return count
+
+
+def load_watermark(out):
+    path = os.path.join(out, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as watermark_file:
+        return json.load(watermark_file)
+
+
+def save_watermark(out, watermark):
+    path = os.path.join(out, WATERMARK_FILE)
+    with open(f"{path}.tmp", "w") as watermark_file:
+        json.dump(watermark, watermark_file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def dump(out, file_format="parquet", batch_size=50000, full=False):
+    """Dump the database into out, incrementally when a previous watermark exists"""
+    pa = _import_pyarrow()
+    os.makedirs(out, exist_ok=True)
+
+    watermark = None if full else load_watermark(out)
+    if watermark and watermark["format"] != file_format:
+        raise SystemExit(f"{out} holds a {watermark['format']} dump, use --full to switch formats")
+    if watermark is None and os.path.isdir(os.path.join(out, "expenses")):
+        shutil.rmtree(os.path.join(out, "expenses"))
+
+    started = datetime.now()
+    since = datetime.fromisoformat(watermark["expenses_created_at"]) if watermark else None
+    until = started - timedelta(seconds=WATERMARK_LAG_SECONDS)
+    run_id = started.strftime("%Y%m%dT%H%M%S")
+
+    from database.models import Category, User
+
+    extension = EXTENSIONS[file_format]
+    counts = {
+        "expenses": dump_expenses(pa, out, file_format, batch_size, since, until, run_id),
+        "users": dump_snapshot(pa, User.__table__, os.path.join(out, f"users.{extension}"), file_format, batch_size),
+        "categories": dump_snapshot(
+            pa, Category.__table__, os.path.join(out, f"categories.{extension}"), file_format, batch_size
+        ),
+    }
+    save_watermark(out, {"format": file_format, "expenses_created_at": until.isoformat(), "run": run_id})
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dump the database to Parquet or Arrow IPC files")
+    parser.add_argument("--out", default="dump", help="output directory (default: dump)")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default="parquet")
+    parser.add_argument("--batch-size", type=int, default=50000, help="rows read per batch")
+    parser.add_argument("--full", action="store_true", help="ignore the watermark and dump everything")
+    args = parser.parse_args(argv)
+
+    started = datetime.now()
+    counts = dump(args.out, args.format, args.batch_size, args.full)
+    elapsed = (datetime.now() - started).total_seconds()
+    print(", ".join(f"{count} {name}" for name, count in counts.items()) + f" dumped in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
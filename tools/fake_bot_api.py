@@ -0,0 +1,136 @@
+"""Local stand-in for the Telegram Bot API, used for offline load testing.
+
+It speaks just enough HTTP/1.1 for python-telegram-bot's client: every Bot API method
+returns ``{"ok": true, "result": ...}`` with a plausible result, and the texts sent to
+each chat are recorded so a test driver can inspect the bot's replies.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "QuillieBOT",
+    "username": "QuillieBOT",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": True,
+}
+
+# Methods that answer with a Message object, everything else answers True
+MESSAGE_METHODS = {
+    "sendmessage",
+    "sendphoto",
+    "senddocument",
+    "editmessagetext",
+    "editmessagereplymarkup",
+}
+
+
+def parse_form(content_type, body):
+    """Parse the request parameters sent by python-telegram-bot"""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        # Only the plain fields are needed, file parts are ignored
+        fields = re.findall(
+            rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, flags=re.DOTALL
+        )
+        return {name.decode(): value.decode(errors="replace") for name, value in fields}
+    return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+
+class FakeBotApi:
+    """Minimal asyncio HTTP server that mimics the Bot API endpoints the bot uses"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0):
+        self.host = host
+        self.port = port
+        self.latency = latency_ms / 1000
+        self.method_calls = defaultdict(int)
+        self.sent_messages = defaultdict(list)
+        self._message_id = 0
+        self._server = None
+
+    @property
+    def base_url(self):
+        """Value for ApplicationBuilder.base_url()"""
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake Bot API listening on {self.base_url}")
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def pop_messages(self, chat_id):
+        """Return and forget the texts sent to a chat since the last call"""
+        return self.sent_messages.pop(chat_id, [])
+
+    def handle_method(self, method, params):
+        """Return the result of a Bot API call"""
+        method = method.lower()
+        self.method_calls[method] += 1
+
+        if method == "getme":
+            return BOT_USER
+        if method not in MESSAGE_METHODS:
+            return True
+
+        chat_id = int(params.get("chat_id", 0))
+        text = params.get("text") or params.get("caption") or ""
+        self.sent_messages[chat_id].append(text)
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode().split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                params = parse_form(headers.get("content-type", ""), body)
+                result = self.handle_method(path.rsplit("/", 1)[-1], params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(payload)).encode() + b"\r\n\r\n" + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
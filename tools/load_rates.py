@@ -0,0 +1,30 @@
+"""Load exchange rates from a CSV file into the rate table, no network access needed.
+
+The file has a header and one rate per row, the value of one unit in rupiah from that date on:
+
+    date,currency,rate
+    2024-01-01,USD,15500
+    2024-01-01,SGD,11650
+
+    python -m tools.load_rates rates.csv
+
+Each load is a new version of the table, running bots pick it up within RATE_CACHE_CHECK_SECONDS.
+"""
+import argparse
+
+
+def main(argv=None):
+    from database.models import initialize_database
+    from database.rates import load_rates_file
+
+    parser = argparse.ArgumentParser(description="Load exchange rates from a CSV file")
+    parser.add_argument("path", help="CSV file with date, currency and rate columns")
+    args = parser.parse_args(argv)
+
+    initialize_database()
+    version = load_rates_file(args.path)
+    print(f"Loaded {args.path} as rate table version {version}")
+
+
+if __name__ == "__main__":
+    main()
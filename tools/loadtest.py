@@ -0,0 +1,220 @@
+"""End-to-end load test of the bot against the local Bot API stand-in.
+
+Simulated users send /start, quick and guided /tambah and /laporan updates through the
+real Application built by main.py. Runs fully offline on a throwaway SQLite database:
+
+    python -m tools.loadtest --users 2000 --json loadtest.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from tools.fake_bot_api import FakeBotApi
+
+logger = logging.getLogger(__name__)
+
+FIRST_USER_ID = 100000
+AMOUNTS = [10000, 15000, 25000, 50000, 75000, 120000, 350000]
+DESCRIPTIONS = ["makan siang", "bensin motor", "kopi", "pulsa", "skip"]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def user_script(rng, categories):
+    """Return the (label, text) messages a simulated user sends, in order"""
+    amount = rng.choice(AMOUNTS)
+    category = rng.choice(categories)
+    return [
+        ("start", "/start"),
+        ("tambah", f"/tambah {rng.choice(AMOUNTS)} {rng.choice(categories)} {rng.choice(DESCRIPTIONS)}"),
+        ("tambah_guided", "/tambah"),
+        ("guided_amount", str(amount)),
+        ("guided_category", category),
+        ("guided_description", rng.choice(DESCRIPTIONS)),
+        ("laporan", "/laporan"),
+        ("laporan_minggu", "/laporan minggu"),
+        ("laporan_bulan", "/laporan bulan"),
+    ]
+
+
+def make_update_data(update_id, telegram_user_id, text):
+    """Build the JSON Telegram would deliver for a private text message"""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": telegram_user_id, "type": "private"},
+        "from": {"id": telegram_user_id, "is_bot": False, "first_name": f"User{telegram_user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        command_length = len(text.split()[0])
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+    return {"update_id": update_id, "message": message}
+
+
+class LoadTest:
+    def __init__(self, users=1000, concurrency=None, api_latency_ms=0, seed=42):
+        self.users = users
+        self.concurrency = concurrency or users
+        self.api_latency_ms = api_latency_ms
+        self.seed = seed
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._pending = {}
+        self._failed_updates = set()
+        self._update_ids = itertools.count(1)
+
+    async def run(self):
+        """Run the load test and return the results dict"""
+        # Imported here so the caller can point DATABASE_URL somewhere else first
+        from config import DEFAULT_CATEGORIES
+        from database.models import initialize_database
+        from main import build_application
+
+        initialize_database()
+        fake_api = FakeBotApi(latency_ms=self.api_latency_ms)
+        await fake_api.start()
+
+        # The stand-in has no rate limits, pacing sends like Telegram would only measure the pacing
+        application = build_application(base_url=fake_api.base_url, outbound_queue=False)
+        process_update = application.process_update
+
+        async def tracked_process_update(update):
+            try:
+                await process_update(update)
+            finally:
+                future = self._pending.pop(getattr(update, "update_id", None), None)
+                if future and not future.done():
+                    future.set_result(None)
+
+        async def on_error(update, context):
+            self._failed_updates.add(getattr(update, "update_id", None))
+
+        application.process_update = tracked_process_update
+        application.add_error_handler(on_error)
+
+        await application.initialize()
+        await application.start()
+
+        rng = random.Random(self.seed)
+        scripts = [user_script(rng, DEFAULT_CATEGORIES) for _ in range(self.users)]
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def simulate_user(index, script):
+            telegram_user_id = FIRST_USER_ID + index
+            async with slots:
+                for label, text in script:
+                    await self._send(application, fake_api, telegram_user_id, label, text)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate_user(i, script) for i, script in enumerate(scripts)))
+        elapsed = time.perf_counter() - started
+
+        await application.stop()
+        await application.shutdown()
+        await fake_api.stop()
+        return self.summarize(elapsed, fake_api)
+
+    async def _send(self, application, fake_api, telegram_user_id, label, text):
+        """Deliver one update and wait until the application finished processing it"""
+        from telegram import Update
+
+        update_id = next(self._update_ids)
+        update = Update.de_json(make_update_data(update_id, telegram_user_id, text), application.bot)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update_id] = future
+
+        started = time.perf_counter()
+        await application.update_queue.put(update)
+        await future
+        self.latencies[label].append((time.perf_counter() - started) * 1000)
+
+        # Handlers report their own failures as a reply starting with ❌
+        replies = fake_api.pop_messages(telegram_user_id)
+        if update_id in self._failed_updates or any(reply.startswith("❌") for reply in replies):
+            self.errors[label] += 1
+
+    def summarize(self, elapsed, fake_api):
+        """Build the results dict: throughput plus latency percentiles per command"""
+        total = sum(len(values) for values in self.latencies.values())
+        commands = {}
+        for label, values in self.latencies.items():
+            commands[label] = {
+                "count": len(values),
+                "errors": self.errors[label],
+                "error_rate": self.errors[label] / len(values),
+                "p50_ms": round(percentile(values, 50), 2),
+                "p95_ms": round(percentile(values, 95), 2),
+                "p99_ms": round(percentile(values, 99), 2),
+            }
+        return {
+            "users": self.users,
+            "updates": total,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+            "error_rate": sum(self.errors.values()) / total if total else 0.0,
+            "api_calls": dict(fake_api.method_calls),
+            "commands": commands,
+        }
+
+
+def format_results(results):
+    """Format the results dict as a text table"""
+    lines = [
+        f"Users: {results['users']}  Updates: {results['updates']}  "
+        f"Elapsed: {results['elapsed_s']}s  Throughput: {results['throughput_per_s']} updates/s  "
+        f"Errors: {results['error_rate']:.2%}",
+        "",
+        f"{'command':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for label, stats in results["commands"].items():
+        lines.append(
+            f"{label:<20}{stats['count']:>8}{stats['errors']:>8}"
+            f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test for QuillieBOT")
+    parser.add_argument("--users", type=int, default=1000, help="number of simulated users")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="simulated users active at the same time (default: all)")
+    parser.add_argument("--api-latency-ms", type=float, default=0,
+                        help="artificial latency of every Bot API call")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database-url", default=None,
+                        help="database to run against (default: a temporary SQLite file)")
+    parser.add_argument("--json", dest="json_path", default=None, help="also write results as JSON")
+    args = parser.parse_args(argv)
+
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/loadtest.db"
+    # Configured before main.py is imported, so its INFO logging setup becomes a no-op
+    logging.basicConfig(level=logging.WARNING)
+
+    load_test = LoadTest(args.users, args.concurrency, args.api_latency_ms, args.seed)
+    results = asyncio.run(load_test.run())
+    print(format_results(results))
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0 if results["error_rate"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""Move users between SQLite shards after changing the shard count.
+
+Every user is copied to the shard its Telegram user ID hashes to under the new count and
+then deleted from the old one, one user per transaction. Files shared by the old and the
+new layout are rebalanced in place, so a run can be repeated after an interruption:
+
+    python -m tools.rebalance_shards --from "sharded+sqlite:///expenses.db?shards=2" \
+        --to "sharded+sqlite:///expenses.db?shards=4"
+
+Exchange rates and global statistics are kept on shard 0 only. When shard 0 becomes another
+file (e.g. from sqlite:///expenses.db to sharded+sqlite:///expenses.db?shards=2) they are
+copied to the new shard 0 as well.
+
+Stop the bot first, and start it again with DATABASE_URL set to the --to URL.
+"""
+import argparse
+
+from sqlalchemy import create_engine, delete, func, insert, inspect, select
+
+
+def shard_urls(url):
+    from database.models import parse_sharded_url
+    return parse_sharded_url(url) or [url]
+
+
+def _archived_years(conn):
+    from database.models import ExpensePartition
+    if not inspect(conn).has_table(ExpensePartition.__tablename__):
+        return []
+    return [year for (year,) in conn.execute(select(ExpensePartition.year))]
+
+
+def _delete_user(conn, user_id, telegram_user_id, years):
+    """Remove every row of a user from one shard"""
+    from database.models import User, Expense, Category, FlowState, RecurringExpense, SpendingStat, SpendingForecast
+    from database.partitions import archive_table
+
+    for year in years:
+        table = archive_table(year)
+        conn.execute(delete(table).where(table.c.user_id == user_id))
+    conn.execute(delete(Expense.__table__).where(Expense.user_id == user_id))
+    conn.execute(delete(Category.__table__).where(Category.user_id == user_id))
+    conn.execute(delete(RecurringExpense.__table__).where(RecurringExpense.user_id == user_id))
+    conn.execute(delete(SpendingStat.__table__).where(SpendingStat.user_id == user_id))
+    # Forecasts are not copied, the next nightly run computes them on the new shard
+    conn.execute(delete(SpendingForecast.__table__).where(SpendingForecast.user_id == user_id))
+    conn.execute(delete(FlowState.__table__).where(FlowState.telegram_user_id == telegram_user_id))
+    conn.execute(delete(User.__table__).where(User.user_id == user_id))
+
+
+def _without(row, *columns):
+    return {key: value for key, value in row._mapping.items() if key not in columns}
+
+
+def move_user(source_conn, target_conn, user_row, source_years):
+    """Copy a user with all their rows to the target shard, then delete them from the source"""
+    from database.models import User, Expense, Category, FlowState, ExpensePartition, RecurringExpense, SpendingStat
+    from database.partitions import archive_table
+
+    telegram_user_id = user_row.telegram_user_id
+    old_user_id = user_row.user_id
+
+    # A copy left behind by an interrupted run is replaced, the source is still authoritative
+    target_years = _archived_years(target_conn)
+    stale = target_conn.execute(
+        select(User.user_id).where(User.telegram_user_id == telegram_user_id)
+    ).scalar()
+    if stale is not None:
+        _delete_user(target_conn, stale, telegram_user_id, target_years)
+
+    new_user_id = target_conn.execute(
+        insert(User.__table__).values(**_without(user_row, "user_id"))
+    ).inserted_primary_key[0]
+
+    categories = source_conn.execute(select(Category.__table__).where(Category.user_id == old_user_id)).all()
+    if categories:
+        target_conn.execute(insert(Category.__table__), [
+            {**_without(row, "category_id"), "user_id": new_user_id} for row in categories
+        ])
+
+    # Hot expenses get new IDs on the target, archived ones keep theirs (unique per user)
+    expenses = source_conn.execute(select(Expense.__table__).where(Expense.user_id == old_user_id)).all()
+    if expenses:
+        target_conn.execute(insert(Expense.__table__), [
+            {**_without(row, "expense_id"), "user_id": new_user_id} for row in expenses
+        ])
+    for year in source_years:
+        table = archive_table(year)
+        rows = source_conn.execute(select(table).where(table.c.user_id == old_user_id)).all()
+        if not rows:
+            continue
+        table.create(target_conn, checkfirst=True)
+        target_conn.execute(insert(table), [{**row._mapping, "user_id": new_user_id} for row in rows])
+        if year not in target_years:
+            target_conn.execute(insert(ExpensePartition.__table__).values(
+                year=year, table_name=table.name, row_count=0
+            ))
+            target_years.append(year)
+
+    rules = source_conn.execute(
+        select(RecurringExpense.__table__).where(RecurringExpense.user_id == old_user_id)
+    ).all()
+    if rules:
+        target_conn.execute(insert(RecurringExpense.__table__), [
+            {**_without(row, "rule_id"), "user_id": new_user_id} for row in rules
+        ])
+
+    stats = source_conn.execute(
+        select(SpendingStat.__table__).where(SpendingStat.user_id == old_user_id)
+    ).all()
+    if stats:
+        target_conn.execute(insert(SpendingStat.__table__), [
+            {**row._mapping, "user_id": new_user_id} for row in stats
+        ])
+
+    flow_state = source_conn.execute(
+        select(FlowState.__table__).where(FlowState.telegram_user_id == telegram_user_id)
+    ).first()
+    if flow_state is not None:
+        target_conn.execute(insert(FlowState.__table__).values(**flow_state._mapping))
+
+    target_conn.commit()
+    _delete_user(source_conn, old_user_id, telegram_user_id, source_years)
+    source_conn.commit()
+    return len(expenses)
+
+
+def copy_global_tables(source_conn, target_conn):
+    """Copy the tables kept on shard 0 only to another shard 0, returns how many rows were copied"""
+    from database.models import ExchangeRate, StatsSketch
+
+    copied = 0
+    for table in (ExchangeRate.__table__, StatsSketch.__table__):
+        if not inspect(source_conn).has_table(table.name):
+            continue
+        rows = source_conn.execute(select(table)).all()
+        # Rows left by an interrupted run are replaced, the source is still authoritative
+        target_conn.execute(delete(table))
+        if rows:
+            target_conn.execute(insert(table), [dict(row._mapping) for row in rows])
+        copied += len(rows)
+    target_conn.commit()
+    return copied
+
+
+def _refresh_partition_counts(engine):
+    """Recompute expense_partitions.row_count and the archive search indexes after archive rows moved"""
+    from database.models import ExpensePartition
+    from database.partitions import archive_table
+    from database.search import build_archive_search_index, is_search_available
+
+    searchable = is_search_available(engine)
+    with engine.begin() as conn:
+        for year in _archived_years(conn):
+            table = archive_table(year)
+            count = conn.execute(select(func.count()).select_from(table)).scalar()
+            conn.execute(ExpensePartition.__table__.update().where(
+                ExpensePartition.year == year
+            ).values(row_count=count))
+            if searchable:
+                build_archive_search_index(conn, table.name)
+
+
+def rebalance(from_url, to_url, dry_run=False):
+    """Move every user to the shard it belongs to under to_url, returns {(source, target): users}"""
+    import config
+    from database.models import User, dispose_engine, initialize_database, shard_for_user, get_engine
+
+    source_urls = shard_urls(from_url)
+    target_urls = shard_urls(to_url)
+
+    if not dry_run:
+        # Creates the new shard files with tables and default categories
+        config.DATABASE_URL = to_url
+        dispose_engine()
+        initialize_database()
+    target_engines = [get_engine(index) if not dry_run else None for index in range(len(target_urls))]
+
+    moves = {}
+    for source_index, source_url in enumerate(source_urls):
+        if source_url in target_urls and not dry_run:
+            source_engine = target_engines[target_urls.index(source_url)]
+        else:
+            source_engine = create_engine(source_url)
+
+        with source_engine.connect() as source_conn:
+            if not inspect(source_conn).has_table(User.__tablename__):
+                continue
+            source_years = _archived_years(source_conn)
+            users = source_conn.execute(select(User.__table__)).all()
+            for user_row in users:
+                target_index = shard_for_user(user_row.telegram_user_id, len(target_urls))
+                if target_urls[target_index] == source_url:
+                    continue
+                moves[(source_index, target_index)] = moves.get((source_index, target_index), 0) + 1
+                if dry_run:
+                    continue
+                with target_engines[target_index].connect() as target_conn:
+                    move_user(source_conn, target_conn, user_row, source_years)
+        if source_engine not in target_engines:
+            source_engine.dispose()
+
+    if not dry_run:
+        if source_urls[0] != target_urls[0]:
+            source_engine = create_engine(source_urls[0])
+            with source_engine.connect() as source_conn, target_engines[0].connect() as target_conn:
+                copy_global_tables(source_conn, target_conn)
+            source_engine.dispose()
+        for engine in target_engines:
+            _refresh_partition_counts(engine)
+        dispose_engine()
+    return moves
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebalance users across SQLite shards")
+    parser.add_argument("--from", dest="from_url", required=True, help="current DATABASE_URL")
+    parser.add_argument("--to", dest="to_url", required=True, help="DATABASE_URL with the new shard count")
+    parser.add_argument("--dry-run", action="store_true", help="only count the users that would move")
+    args = parser.parse_args(argv)
+
+    moves = rebalance(args.from_url, args.to_url, args.dry_run)
+    for (source, target), users in sorted(moves.items()):
+        print(f"shard {source} -> shard {target}: {users} users")
+    print(f"{'Would move' if args.dry_run else 'Moved'} {sum(moves.values())} users")
+
+    source_urls, target_urls = shard_urls(args.from_url), shard_urls(args.to_url)
+    if source_urls[0] != target_urls[0]:
+        print(f"{'Would copy' if args.dry_run else 'Copied'} exchange rates and global statistics "
+              f"from {source_urls[0]} to {target_urls[0]}")
+    leftover = [url for url in source_urls if url not in target_urls]
+    if leftover and not args.dry_run:
+        print("These shards are no longer used and can be removed: " + ", ".join(leftover))
+
+
+if __name__ == "__main__":
+    main()
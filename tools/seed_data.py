@@ -0,0 +1,140 @@
+"""Deterministic synthetic data generator for benchmarks and load tests.
+
+Creates N users x M expenses spread over Y years ending today, with a realistic skew
+towards everyday categories. The same arguments always produce the same rows:
+
+    python -m tools.seed_data --users 1000 --expenses 500 --years 3 --database-url sqlite:///bench.db
+"""
+import argparse
+import os
+import random
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+FIRST_TELEGRAM_USER_ID = 10_000_000
+INSERT_CHUNK_SIZE = 10_000
+
+# (category, share of expenses, typical amount in rupiah)
+CATEGORY_PROFILE = [
+    ("Makan", 0.38, 35_000),
+    ("Transportasi", 0.20, 25_000),
+    ("Belanja", 0.14, 150_000),
+    ("Hiburan", 0.09, 100_000),
+    ("Lainnya", 0.08, 60_000),
+    ("Kesehatan", 0.06, 200_000),
+    ("Pendidikan", 0.05, 300_000),
+]
+CUSTOM_CATEGORIES = ["Kopi", "Langganan", "Hadiah", "Listrik", "Internet", "Parkir"]
+DESCRIPTIONS = {
+    "Makan": ["makan siang", "sarapan", "makan malam", "gofood", "warteg"],
+    "Transportasi": ["bensin motor", "ojek online", "parkir", "tol", "kereta"],
+    "Belanja": ["supermarket", "baju", "alat rumah", "marketplace"],
+    "Hiburan": ["bioskop", "konser", "game", "nongkrong"],
+    "Lainnya": ["pulsa", "sumbangan", "laundry"],
+    "Kesehatan": ["obat", "dokter", "vitamin"],
+    "Pendidikan": ["buku", "kursus", "alat tulis"],
+}
+
+
+def generate_expense_rows(rng, user_id, expenses_per_user, years, today):
+    """Yield expense row dicts for one user"""
+    categories = [name for name, _, _ in CATEGORY_PROFILE]
+    weights = [share for _, share, _ in CATEGORY_PROFILE]
+    typical_amounts = {name: amount for name, _, amount in CATEGORY_PROFILE}
+    span_days = max(1, years * 365)
+
+    for category in rng.choices(categories, weights=weights, k=expenses_per_user):
+        # Log-normal amounts rounded to Rp 500, like real receipts
+        amount = typical_amounts[category] * rng.lognormvariate(0, 0.6)
+        amount = max(500, int(round(amount / 500)) * 500)
+        expense_date = today - timedelta(days=rng.randrange(span_days))
+        yield {
+            "user_id": user_id,
+            "amount": Decimal(amount),
+            "category": category,
+            "description": rng.choice(DESCRIPTIONS[category]) if rng.random() < 0.8 else None,
+            "date": expense_date,
+            "created_at": datetime.combine(expense_date, time(rng.randrange(6, 23), rng.randrange(60))),
+        }
+
+
+def seed_database(users, expenses_per_user, years=1, seed=42, custom_category_share=0.2):
+    """Insert synthetic users and expenses into the configured database.
+
+    Returns the list of seeded telegram user IDs.
+    """
+    from sqlalchemy import insert
+    from database.models import User, Expense, get_session, get_shard_count, initialize_database, shard_for_user
+    from database.operations import add_user_category
+
+    initialize_database()
+    rng = random.Random(seed)
+    today = date.today()
+    telegram_user_ids = [FIRST_TELEGRAM_USER_ID + i for i in range(users)]
+
+    # Each user's rows go to the shard that holds the user
+    shard_count = get_shard_count()
+    users_by_shard = {}
+    for telegram_user_id in telegram_user_ids:
+        users_by_shard.setdefault(shard_for_user(telegram_user_id, shard_count), []).append(telegram_user_id)
+
+    for shard, shard_user_ids in sorted(users_by_shard.items()):
+        session = get_session(shard=shard)
+        try:
+            session.execute(insert(User), [
+                {
+                    "telegram_user_id": telegram_user_id,
+                    "username": f"user{telegram_user_id}",
+                    "first_name": "Seed",
+                    "last_name": str(telegram_user_id),
+                    "created_at": datetime.combine(today - timedelta(days=years * 365), time(8)),
+                    "is_active": True,
+                    "weekly_report_enabled": rng.random() < 0.9,
+                }
+                for telegram_user_id in shard_user_ids
+            ])
+            session.commit()
+
+            user_ids = dict(session.query(User.telegram_user_id, User.user_id).filter(
+                User.telegram_user_id.in_(shard_user_ids)
+            ).all())
+
+            chunk = []
+            for telegram_user_id in shard_user_ids:
+                for row in generate_expense_rows(rng, user_ids[telegram_user_id], expenses_per_user, years, today):
+                    chunk.append(row)
+                    if len(chunk) >= INSERT_CHUNK_SIZE:
+                        session.execute(insert(Expense), chunk)
+                        chunk = []
+            if chunk:
+                session.execute(insert(Expense), chunk)
+            session.commit()
+        finally:
+            session.close()
+
+    # Custom categories go through the regular write path so they follow its rules
+    for telegram_user_id in telegram_user_ids:
+        if rng.random() < custom_category_share:
+            for category_name in rng.sample(CUSTOM_CATEGORIES, rng.randint(1, 2)):
+                add_user_category(telegram_user_id, category_name)
+
+    return telegram_user_ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed the database with synthetic expenses")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--expenses", type=int, default=200, help="expenses per user")
+    parser.add_argument("--years", type=int, default=1, help="years of history ending today")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database-url", default=None, help="defaults to DATABASE_URL")
+    args = parser.parse_args(argv)
+
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    seed_database(args.users, args.expenses, args.years, args.seed)
+    print(f"Seeded {args.users} users x {args.expenses} expenses over {args.years} year(s)")
+
+
+if __name__ == "__main__":
+    main()
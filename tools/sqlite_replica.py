@@ -0,0 +1,73 @@
+"""Keep a SQLite copy of the database to use as a local read replica.
+
+Copies the primary with SQLite's online backup API, once or every --interval seconds
+(which also simulates replication lag):
+
+    python -m tools.sqlite_replica --interval 5
+    DATABASE_READ_URL=sqlite:///expenses.replica.db python main.py
+
+Sharded URLs are copied shard by shard, the replica URL must use the same shard count.
+"""
+import argparse
+import sqlite3
+import time
+
+from sqlalchemy.engine import make_url
+
+
+def default_replica_url(url):
+    """expenses.db -> expenses.replica.db, also for sharded URLs"""
+    base, question_mark, query = url.partition("?")
+    root, dot, extension = base.rpartition(".")
+    if not dot or "/" in extension:
+        return f"{base}.replica{question_mark}{query}"
+    return f"{root}.replica.{extension}{question_mark}{query}"
+
+
+def copy_sqlite_database(source_url, target_url):
+    """Copy one SQLite database file into another with the online backup API"""
+    source_path = make_url(source_url).database
+    target_path = make_url(target_url).database
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def sync_replica(source_url, target_url):
+    """Copy every shard of source_url over the matching shard of target_url"""
+    from database.models import parse_sharded_url
+
+    source_urls = parse_sharded_url(source_url) or [source_url]
+    target_urls = parse_sharded_url(target_url) or [target_url]
+    if len(source_urls) != len(target_urls):
+        raise ValueError("The replica must have as many shards as the primary")
+    for source, target in zip(source_urls, target_urls):
+        copy_sqlite_database(source, target)
+
+
+def main(argv=None):
+    from config import DATABASE_URL, DATABASE_READ_URL
+
+    parser = argparse.ArgumentParser(description="Copy the SQLite database to a read replica")
+    parser.add_argument("--source", default=DATABASE_URL, help="defaults to DATABASE_URL")
+    parser.add_argument("--target", default=DATABASE_READ_URL or None,
+                        help="defaults to DATABASE_READ_URL, or the source with .replica added")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between copies, 0 copies once")
+    args = parser.parse_args(argv)
+
+    target = args.target or default_replica_url(args.source)
+    while True:
+        started = time.perf_counter()
+        sync_replica(args.source, target)
+        print(f"Copied {args.source} to {target} in {time.perf_counter() - started:.2f}s")
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import math
+
+# Spread below which history counts as "always the same amount" (in log units, about 25%),
+# so a slightly bigger amount after identical ones is not flagged
+MIN_LOG_STD = 0.25
+
+
+def fold(stats, amount, decay):
+    """Add an amount to exponentially decayed running statistics (Welford/West update).
+
+    stats has count, weight, mean and m2 attributes over log amounts: spending is skewed,
+    so "far above typical" is a ratio rather than a fixed number of rupiah. Older amounts
+    lose (1 - decay) of their weight with every new one.
+    """
+    value = math.log(amount)
+    stats.weight = stats.weight * decay + 1
+    stats.m2 *= decay
+    delta = value - stats.mean
+    stats.mean += delta / stats.weight
+    stats.m2 += delta * (value - stats.mean)
+    stats.count += 1
+
+
+def typical_if_unusual(stats, amount, threshold, min_count):
+    """The typical amount (geometric mean) if amount is far above it, otherwise None"""
+    if stats.count < min_count or amount <= 0:
+        return None
+    std = max(math.sqrt(max(stats.m2, 0.0) / stats.weight), MIN_LOG_STD)
+    if (math.log(amount) - stats.mean) / std <= threshold:
+        return None
+    return math.exp(stats.mean)
@@ -0,0 +1,123 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Most terms scanned for one prefix, keeps very short prefixes cheap
+MAX_PREFIX_SCAN = 200
+
+
+class PrefixIndex:
+    """Sorted array of lowercased terms answering prefix lookups with a binary search"""
+
+    def __init__(self, max_terms=None):
+        self.max_terms = max_terms
+        self._keys = []
+        self._entries = {}  # lowercased term -> [display term, weight]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, term, weight=1):
+        """Add a term or increase the weight of an existing one"""
+        term = term.strip()
+        key = term.lower()
+        if not key:
+            return
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] += weight
+            return
+        if self.max_terms and len(self._keys) >= self.max_terms:
+            # Make room by forgetting the least used term
+            weakest = min(self._keys, key=lambda k: self._entries[k][1])
+            if self._entries[weakest][1] > weight:
+                return
+            self._keys.pop(bisect_left(self._keys, weakest))
+            del self._entries[weakest]
+        insort(self._keys, key)
+        self._entries[key] = [term, weight]
+
+    def search(self, prefix, limit=10):
+        """Terms starting with prefix (case-insensitive), most used first"""
+        prefix = prefix.strip().lower()
+        position = bisect_left(self._keys, prefix)
+        matches = []
+        for key in self._keys[position:position + MAX_PREFIX_SCAN]:
+            if not key.startswith(prefix):
+                break
+            matches.append(self._entries[key])
+        matches.sort(key=lambda entry: -entry[1])
+        return [term for term, _ in matches[:limit]]
+
+
+class UserSuggestions:
+    """Categories and frequent descriptions of one user"""
+
+    def __init__(self, max_descriptions):
+        self.categories = PrefixIndex()
+        self.descriptions = PrefixIndex(max_terms=max_descriptions)
+
+
+_user_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_user_suggestions(telegram_user_id):
+    """Return the user's suggestion index, warming it from the database on first use"""
+    from config import AUTOCOMPLETE_CACHE_USERS, AUTOCOMPLETE_MAX_DESCRIPTIONS
+
+    with _lock:
+        suggestions = _user_indexes.get(telegram_user_id)
+        if suggestions is not None:
+            _user_indexes.move_to_end(telegram_user_id)
+            return suggestions
+
+    # Imported here, database.operations notifies this module on writes
+    from database.operations import get_user_categories, get_frequent_descriptions
+
+    suggestions = UserSuggestions(AUTOCOMPLETE_MAX_DESCRIPTIONS)
+    categories = get_user_categories(telegram_user_id)
+    for position, name in enumerate(categories):
+        # Fractional weights keep the configured order until expenses are recorded
+        suggestions.categories.add(name, weight=(len(categories) - position) / 1000)
+    for description, count in get_frequent_descriptions(telegram_user_id, AUTOCOMPLETE_MAX_DESCRIPTIONS):
+        suggestions.descriptions.add(description, weight=count)
+
+    with _lock:
+        _user_indexes[telegram_user_id] = suggestions
+        while len(_user_indexes) > AUTOCOMPLETE_CACHE_USERS:
+            _user_indexes.popitem(last=False)
+    return suggestions
+
+
+def suggest(telegram_user_id, category_prefix, description_prefix=None, limit=8):
+    """Return (categories, descriptions) of the user matching the typed prefixes"""
+    suggestions = get_user_suggestions(telegram_user_id)
+    with _lock:
+        categories = suggestions.categories.search(category_prefix, limit)
+        descriptions = []
+        if description_prefix is not None:
+            descriptions = suggestions.descriptions.search(description_prefix, limit)
+    return categories, descriptions
+
+
+def note_expense(telegram_user_id, category, description=None):
+    """Update a warm suggestion index after an expense was recorded"""
+    with _lock:
+        suggestions = _user_indexes.get(telegram_user_id)
+        if suggestions is None:
+            return
+        suggestions.categories.add(category)
+        if description:
+            suggestions.descriptions.add(description)
+
+
+def note_category(telegram_user_id, category):
+    """Make a newly added category show up in a warm suggestion index"""
+    with _lock:
+        suggestions = _user_indexes.get(telegram_user_id)
+        if suggestions is not None:
+            suggestions.categories.add(category)
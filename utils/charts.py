@@ -0,0 +1,149 @@
+import io
+from datetime import date
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.ticker import FuncFormatter
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "Mei", "Jun", "Jul", "Agu", "Sep", "Okt", "Nov", "Des"]
+DAY_NAMES = ["Sen", "Sel", "Rab", "Kam", "Jum", "Sab", "Min"]
+
+TREND_MONTHS = 12
+TREND_CATEGORIES = 6  # Lines in the trend chart, smaller categories are added up
+OTHER_CATEGORIES = "Kategori lain"
+
+
+def chart_range(start_date, end_date):
+    """Dates the report charts need: the trend months before end_date and the whole year of it"""
+    first_trend_month = _month_number(end_date) - TREND_MONTHS + 1
+    trend_start = date(first_trend_month // 12, first_trend_month % 12 + 1, 1)
+    return min(start_date, trend_start, date(end_date.year, 1, 1)), date(end_date.year, 12, 31)
+
+
+def _month_number(day):
+    return day.year * 12 + day.month - 1
+
+
+def _ordinals(dates):
+    return np.fromiter((day.toordinal() for day in dates), dtype=np.int64, count=len(dates))
+
+
+def daily_series(dates, totals, start_date, end_date):
+    """Total per day from start_date to end_date, days without expenses are 0"""
+    offsets = _ordinals(dates) - start_date.toordinal()
+    days = (end_date - start_date).days + 1
+    in_range = (offsets >= 0) & (offsets < days)
+    return np.bincount(offsets[in_range], weights=np.asarray(totals)[in_range], minlength=days)
+
+
+def monthly_trend(dates, categories, totals, last_month, months=TREND_MONTHS):
+    """Category totals of the months up to last_month: (category names, matrix[category, month]).
+
+    The TREND_CATEGORIES - 1 biggest categories keep their own row, the rest share one.
+    """
+    offsets = np.fromiter((_month_number(day) for day in dates), dtype=np.int64, count=len(dates))
+    offsets -= _month_number(last_month) - months + 1
+    in_range = (offsets >= 0) & (offsets < months)
+    names, codes = np.unique(np.array(categories, dtype=object)[in_range], return_inverse=True)
+    matrix = np.zeros((len(names), months))
+    np.add.at(matrix, (codes, offsets[in_range]), np.asarray(totals)[in_range])
+
+    order = np.argsort(-matrix.sum(axis=1), kind="stable")
+    if len(order) <= TREND_CATEGORIES:
+        return list(names[order]), matrix[order]
+    kept = order[:TREND_CATEGORIES - 1]
+    rest = matrix[order[TREND_CATEGORIES - 1:]].sum(axis=0)
+    return list(names[kept]) + [OTHER_CATEGORIES], np.vstack([matrix[kept], rest])
+
+
+def calendar_grid(dates, totals, year):
+    """Spend per day of a year laid out as weekday rows and week columns, NaN outside the year"""
+    first_day = date(year, 1, 1)
+    per_day = daily_series(dates, totals, first_day, date(year, 12, 31))
+    positions = np.arange(len(per_day)) + first_day.weekday()
+    grid = np.full((7, positions[-1] // 7 + 1), np.nan)
+    grid[positions % 7, positions // 7] = per_day
+    return grid
+
+
+def _compact_amount(value, _position=None):
+    """Axis label like 250rb or 1,2jt"""
+    if abs(value) >= 1000000:
+        return f"{value / 1000000:.1f}jt".replace(".", ",").replace(",0jt", "jt")
+    if abs(value) >= 1000:
+        return f"{value / 1000:.0f}rb"
+    return f"{value:.0f}"
+
+
+def draw_daily_bars(axes, start_date, values, currency):
+    days = np.arange(len(values))
+    axes.bar(days, values, color="#4C72B0", width=0.8)
+    step = max(1, len(values) // 15)
+    axes.set_xticks(days[::step])
+    axes.set_xticklabels(
+        [date.fromordinal(start_date.toordinal() + int(day)).strftime("%d/%m") for day in days[::step]],
+        rotation=45, fontsize=8,
+    )
+    axes.yaxis.set_major_formatter(FuncFormatter(_compact_amount))
+    axes.set_title(f"Pengeluaran Harian ({currency})")
+
+
+def draw_monthly_trend(axes, last_month, names, matrix, currency):
+    first_month = _month_number(last_month) - matrix.shape[1] + 1
+    labels = [
+        f"{MONTH_NAMES[(first_month + offset) % 12]} {str((first_month + offset) // 12)[2:]}"
+        for offset in range(matrix.shape[1])
+    ]
+    for name, row in zip(names, matrix):
+        axes.plot(labels, row, marker="o", markersize=3, label=name)
+    axes.tick_params(axis="x", labelsize=8)
+    axes.yaxis.set_major_formatter(FuncFormatter(_compact_amount))
+    if names:
+        axes.legend(fontsize=8, loc="upper left")
+    axes.set_title(f"Tren {len(labels)} Bulan per Kategori ({currency})")
+
+
+def draw_calendar_heatmap(axes, year, grid):
+    image = axes.imshow(np.ma.masked_invalid(grid), aspect="auto", cmap="YlOrRd", interpolation="nearest")
+    axes.set_yticks(range(7))
+    axes.set_yticklabels(DAY_NAMES, fontsize=8)
+    # A tick at the week column holding the first day of each month
+    offset = date(year, 1, 1).weekday()
+    month_columns = [(date(year, month, 1).timetuple().tm_yday - 1 + offset) // 7 for month in range(1, 13)]
+    axes.set_xticks(month_columns)
+    axes.set_xticklabels(MONTH_NAMES, fontsize=8)
+    axes.figure.colorbar(image, ax=axes, format=FuncFormatter(_compact_amount), shrink=0.8)
+    axes.set_title(f"Kalender Pengeluaran {year}")
+
+
+def render_charts(charts):
+    """Draw (function, args) charts as the panels of one figure and return one PNG buffer.
+
+    The figure, fonts and canvas are set up once for every chart of a report.
+    """
+    height = 3.4 * len(charts)
+    figure = Figure(figsize=(10, height))
+    # Fixed margins in inches: a layout engine would draw the whole figure once more to measure it
+    figure.subplots_adjust(left=0.08, right=0.98, top=1 - 0.35 / height, bottom=0.6 / height, hspace=0.45)
+    panels = figure.subplots(len(charts), 1, squeeze=False)[:, 0]
+    for axes, (draw, args) in zip(panels, charts):
+        draw(axes, *args)
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", dpi=100)
+    buffer.seek(0)
+    return buffer
+
+
+def create_report_charts(totals, start_date, end_date):
+    """Daily bars of the report period, the 12-month category trend and the year heatmap.
+
+    totals is the get_daily_totals() result covering chart_range(start_date, end_date).
+    """
+    dates, categories, amounts = totals['dates'], totals['categories'], np.asarray(totals['totals'], dtype=float)
+    currency = totals['currency']
+    names, matrix = monthly_trend(dates, categories, amounts, end_date)
+    return render_charts([
+        (draw_daily_bars, (start_date, daily_series(dates, amounts, start_date, end_date), currency)),
+        (draw_monthly_trend, (end_date, names, matrix, currency)),
+        (draw_calendar_heatmap, (end_date.year, calendar_grid(dates, amounts, end_date.year))),
+    ])
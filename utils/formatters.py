@@ -2,21 +2,28 @@ from decimal import Decimal
 import matplotlib.pyplot as plt
 import io
 from datetime import date, datetime
-from config import CURRENCY_SYMBOL
+from config import CURRENCY_SYMBOL, CURRENCY_SYMBOLS, DEFAULT_CURRENCY
 
+# Indonesian separators: dots group thousands, a comma starts the cents
+_SEPARATORS = str.maketrans(",.", ".,")
 
-def format_currency(amount):
-    """Format amount as currency"""
+
+def format_currency(amount, currency=None):
+    """Format amount as currency (rupiah unless another currency code is given)"""
     if amount is None:
-        return "Rp 0"
+        amount = 0
 
     # Convert to Decimal if it's not already
     if not isinstance(amount, Decimal):
         amount = Decimal(str(amount))
 
-    # Format with thousands separator and currency symbol
-    formatted_amount = f"{CURRENCY_SYMBOL}{amount:,.0f}".replace(",", ".")
-    return formatted_amount
+    if currency is None or currency == DEFAULT_CURRENCY:
+        # Format with thousands separator and currency symbol
+        formatted_amount = f"{CURRENCY_SYMBOL}{amount:,.0f}".replace(",", ".")
+        return formatted_amount
+
+    symbol = CURRENCY_SYMBOLS.get(currency, f"{currency} ")
+    return f"{symbol}{amount:,.2f}".translate(_SEPARATORS)
 
 
 def format_date_range(start_date, end_date):
@@ -29,11 +36,73 @@ def format_date_range(start_date, end_date):
 
 def format_expense_message(expense):
     """Format a single expense as a message"""
-    message = f"💰 {format_currency(expense.amount)}"
+    message = f"💰 {format_currency(expense.amount, expense.currency)}"
     message += f"🏷️ {expense.category}"
     if expense.description:
         message += f"📝 {expense.description}"
     message += f"📅 {expense.date.strftime('%d %b %Y')}"
+    note = format_anomaly_note(expense)
+    if note:
+        message += f"\n{note}"
+    return message
+
+
+def format_anomaly_note(expense):
+    """Warning line for an expense flagged as unusual spending, or None"""
+    anomaly = getattr(expense, 'anomaly', None)
+    if not anomaly:
+        return None
+    typical = format_currency(round(anomaly['typical']), anomaly['currency'])
+    if anomaly['kind'] == 'category':
+        return f"⚠️ Jauh di atas biasanya untuk {expense.category} (biasanya sekitar {typical})"
+    total = format_currency(round(anomaly['total']), anomaly['currency'])
+    return f"⚠️ Total hari ini {total}, jauh di atas hari biasa (sekitar {typical})"
+
+
+def format_expense_batch_message(expenses):
+    """Format several expenses recorded from one message as a single confirmation"""
+    total_amount = sum(expense.amount for expense in expenses)
+    currencies = {expense.currency for expense in expenses}
+    message = f"✅ {len(expenses)} pengeluaran tercatat!\n"
+    for expense in expenses:
+        message += f"• {format_currency(expense.amount, expense.currency)} 🏷️ {expense.category}"
+        if expense.description:
+            message += f" 📝 {expense.description}"
+        message += "\n"
+        note = format_anomaly_note(expense)
+        if note:
+            message += f"  {note}\n"
+    # Amounts in different currencies only add up in reports, after conversion
+    if len(currencies) == 1:
+        message += f"📊 Total: {format_currency(total_amount, currencies.pop())}"
+    return message.rstrip("\n")
+
+
+def format_expense_history(expenses):
+    """Format one page of /riwayat, newest expense first"""
+    message = "🧾 Riwayat Pengeluaran\n"
+    message += "──────────────────\n"
+    for expense in expenses:
+        message += f"{expense.date.strftime('%d %b %Y')} • {format_currency(expense.amount, expense.currency)} 🏷️ {expense.category}"
+        if expense.description:
+            message += f" 📝 {expense.description}"
+        message += "\n"
+    return message
+
+
+def format_search_results(query, result):
+    """Format the totals and top matches of /cari"""
+    if not result['count']:
+        return f"❌ Tidak ada pengeluaran yang cocok dengan \"{query}\"."
+    message = f"🔍 \"{query}\": {result['count']} pengeluaran, total {format_currency(result['total'], result['currency'])}\n"
+    message += "──────────────────\n"
+    for expense in result['matches']:
+        message += f"{expense.date.strftime('%d %b %Y')} • {format_currency(expense.amount, expense.currency)} 🏷️ {expense.category}"
+        if expense.description:
+            message += f" 📝 {expense.description}"
+        message += "\n"
+    if result['count'] > len(result['matches']):
+        message += f"… dan {result['count'] - len(result['matches'])} lainnya"
     return message
 
 
@@ -42,8 +111,10 @@ def format_expense_summary(expenses):
     if not expenses:
         return "❌ No expenses found for this period."
 
+    # Report expenses are already converted to the user's base currency
+    currency = expenses[0].currency
     total_amount = sum(expense.amount for expense in expenses)
-    message = f"📊 Total: {format_currency(total_amount)}\n"
+    message = f"📊 Total: {format_currency(total_amount, currency)}\n"
     message += "──────────────────\n"
 
     # Group expenses by category
@@ -64,7 +135,7 @@ def format_expense_summary(expenses):
     # Calculate percentages and format
     for category, amount in sorted_categories:
         percentage = (amount / total_amount) * 100
-        message += f"  {category}: {format_currency(amount)} ({percentage:.0f}%)\n"
+        message += f"  {category}: {format_currency(amount, currency)} ({percentage:.0f}%)\n"
 
     return message
 
@@ -158,8 +229,19 @@ def format_categories_list(categories):
     return message
 
 
-def format_budget_message(budget, current_spending):
-    """Format budget status message"""
+def format_month_forecast(projected, currency):
+    """Format projected month-end totals per category"""
+    message = f"🔮 Perkiraan akhir bulan: {format_currency(round(sum(projected.values())), currency)}\n"
+    for category, amount in sorted(projected.items(), key=lambda item: -item[1]):
+        message += f"  • {category}: {format_currency(round(amount), currency)}\n"
+    return message.rstrip("\n")
+
+
+def format_budget_message(budget, current_spending, projected=None, currency=None):
+    """Format budget status message, with the projected month-end spending if known.
+
+    The budget and the amounts are in the same currency, the user's base currency.
+    """
     if budget is None:
         return "❌ Budget not set. Use /set_budget to set your monthly budget."
 
@@ -170,13 +252,17 @@ def format_budget_message(budget, current_spending):
 
     status_emoji = "🟢" if percentage < 50 else "🟡" if percentage < 80 else "🔴"
 
-    message = f"💰 Monthly Budget: {format_currency(budget)}\n"
-    message += f"💳 Spent: {format_currency(current_spending)} ({percentage:.1f}%)\n"
-    message += f"✅ Remaining: {format_currency(remaining)}\n"
+    message = f"💰 Monthly Budget: {format_currency(budget, currency)}\n"
+    message += f"💳 Spent: {format_currency(current_spending, currency)} ({percentage:.1f}%)\n"
+    message += f"✅ Remaining: {format_currency(remaining, currency)}\n"
+    if projected is not None:
+        message += f"🔮 Projected: {format_currency(projected, currency)} ({float(projected) / budget * 100:.1f}%)\n"
     message += f"{status_emoji} Status: "
 
     if percentage >= 100:
         message += "⚠️ Budget exceeded!"
+    elif projected is not None and float(projected) > budget:
+        message += "⚠️ On track to exceed budget"
     elif percentage >= 90:
         message += "⚠️ Approaching budget limit!"
     elif percentage >= 75:
@@ -185,3 +271,30 @@ def format_budget_message(budget, current_spending):
         message += "✅ Within budget"
 
     return message
+
+
+def format_global_stats(stats):
+    """Format the admin statistics of get_global_stats()"""
+    currency = stats['currency']
+
+    def percentiles(sketch):
+        return " / ".join(format_currency(round(sketch.quantile(q)), currency) for q in (0.5, 0.9, 0.99))
+
+    users, period, today = stats['users'], stats['period'], stats['today']
+    message = f"📊 Statistik Global ({stats['days']} hari)\n\n"
+    message += f"👥 Pengguna aktif: hari ini {users['today']}, 7 hari {users['week']}, {stats['days']} hari {users['period']}\n"
+    message += f"🧾 Hari ini: {today.count} pengeluaran, {format_currency(round(today.sum), currency)}\n"
+    message += f"🧾 {stats['days']} hari: {period.count} pengeluaran, {format_currency(round(period.sum), currency)}\n"
+    if not period.count:
+        return message.rstrip("\n")
+
+    message += f"\n📈 Nominal p50 / p90 / p99: {percentiles(period)}\n\n🏷️ Per kategori:\n"
+    for name, sketch in sorted(stats['categories'].items(), key=lambda item: -item[1].sum):
+        if not sketch.count:  # Stored before its amounts could be converted
+            continue
+        share = sketch.sum / period.sum * 100 if period.sum else 0
+        message += (
+            f"  • {name}: {sketch.count}x, {format_currency(round(sketch.sum), currency)} ({share:.1f}%)\n"
+            f"    p50 / p90 / p99: {percentiles(sketch)}\n"
+        )
+    return message.rstrip("\n")
@@ -0,0 +1,342 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cached lookup up to a slow report
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """Base class for metrics with a fixed set of label names"""
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def collect(self):
+        """Return a snapshot of {label values: value}"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Gauge that is either set directly or computed by a function at scrape time.
+
+    The function returns a number, or a dict of {label values tuple: number}.
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        if self.function is None:
+            return super().collect()
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.error(f"Error collecting gauge {self.name}: {str(e)}")
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Handlers
+HANDLER_LATENCY = Histogram(
+    "quillie_handler_duration_seconds", "Time spent in a command handler or guided step", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "quillie_handler_errors_total", "Exceptions raised out of a handler", ["handler"]
+)
+
+# Update queue
+UPDATE_QUEUE = Gauge(
+    "quillie_update_queue", "Updates waiting to be processed, per-user lanes and dropped updates", ["state"]
+)
+
+WEBHOOK_REQUESTS = Counter(
+    "quillie_webhook_requests_total", "Webhook deliveries by response status", ["status"]
+)
+
+DUPLICATE_UPDATES = Counter(
+    "quillie_duplicate_updates_total", "Redelivered updates dropped, by where the first delivery was found", ["source"]
+)
+
+# Database
+DB_QUERY_DURATION = Histogram(
+    "quillie_db_query_duration_seconds", "SQL statement execution time", ["statement"]
+)
+
+DB_QUERIES_PER_UPDATE = Histogram(
+    "quillie_db_queries_per_update", "SQL statements executed per update or job", ["handler"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+)
+
+# Caches
+CACHE_REQUESTS = Counter(
+    "quillie_cache_requests_total", "Cache lookups by result (hit or miss)", ["cache", "result"]
+)
+
+
+def _cache_hit_ratios():
+    ratios = {}
+    for (cache, result), hits in CACHE_REQUESTS.collect().items():
+        if result == "hit":
+            total = hits + CACHE_REQUESTS.value(cache=cache, result="miss")
+            ratios[(cache,)] = round(hits / total, 4) if total else 0.0
+    return ratios
+
+
+CACHE_HIT_RATIO = Gauge(
+    "quillie_cache_hit_ratio", "Share of cache lookups that were hits", ["cache"], function=_cache_hit_ratios
+)
+
+# Weekly report broadcast
+BROADCAST_PROGRESS = Gauge(
+    "quillie_broadcast_users", "Progress of the current or last weekly broadcast", ["state"]
+)
+BROADCAST_LAST_RUN = Gauge(
+    "quillie_broadcast_last_run_timestamp_seconds", "When the last weekly broadcast started"
+)
+
+# Telegram Bot API
+TELEGRAM_API_REQUESTS = Histogram(
+    "quillie_telegram_api_duration_seconds", "Bot API request time", ["method"]
+)
+TELEGRAM_API_ERRORS = Counter(
+    "quillie_telegram_api_errors_total", "Failed Bot API requests", ["method", "reason"]
+)
+TELEGRAM_API_RETRIES = Counter(
+    "quillie_telegram_api_retries_total", "Bot API requests that were retried", ["method"]
+)
+
+OUTBOUND_QUEUE = Gauge(
+    "quillie_outbound_queue", "Bot API requests waiting to be sent, per priority class", ["priority"]
+)
+OUTBOUND_MESSAGES = Counter(
+    "quillie_outbound_messages_total", "Outbound sends by priority class and result", ["priority", "result"]
+)
+OUTBOUND_WAIT = Histogram(
+    "quillie_outbound_wait_seconds", "Time outbound sends spent queued", ["priority"]
+)
+
+
+def register_application_metrics(application):
+    """Report the queue depth of an application at scrape time"""
+    def collect():
+        values = {("queued",): application.update_queue.qsize()}
+        if hasattr(application.update_queue, "pending"):
+            values[("pending",)] = application.update_queue.pending
+        if hasattr(application, "active_lanes"):
+            values[("in_lanes",)] = application.lane_depth
+            values[("active_lanes",)] = application.active_lanes
+            values[("dropped",)] = application.dropped_updates
+        return values
+
+    UPDATE_QUEUE.function = collect
+
+
+def track_handler(name, callback):
+    """Wrap a handler callback so its latency and errors are recorded.
+
+    ``name`` is the handler label, or a function of the update returning it.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        label = name(update) if callable(name) else name
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=label)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=label)
+
+    return wrapper
+
+
+def attach_engine_metrics(engine):
+    """Record the duration of every SQL statement executed on an engine"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        statement_type = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_QUERY_DURATION.observe(time.perf_counter() - started, statement=statement_type)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute, its start time is dropped here
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started and context.execution_context is not None:
+            started.pop()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records Bot API latency and failures per method"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.inc(method=api_method, reason=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_API_REQUESTS.observe(time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            TELEGRAM_API_ERRORS.inc(method=api_method, reason=str(code))
+        return code, payload
+
+
+# Paths served by the metrics listener, path -> function returning the text body
+ENDPOINTS = {"/metrics": REGISTRY.render}
+
+
+def register_endpoint(path, render):
+    """Serve the text returned by render() on path of the metrics listener"""
+    ENDPOINTS[path] = render
+
+
+async def _handle_metrics_connection(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Headers are not needed, but must be read before answering
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode().split()
+        render = ENDPOINTS.get(parts[1].split("?")[0]) if len(parts) >= 2 and parts[0] == "GET" else None
+        if render is not None:
+            status, body = b"200 OK", render().encode()
+        else:
+            status, body = b"404 Not Found", b"Not Found\n"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port):
+    """Serve GET /metrics (and registered endpoints) on host:port from the running event loop"""
+    server = await asyncio.start_server(_handle_metrics_connection, host, port)
+    logger.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
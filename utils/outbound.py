@@ -0,0 +1,255 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from utils.metrics import OUTBOUND_MESSAGES, OUTBOUND_QUEUE, OUTBOUND_WAIT, TELEGRAM_API_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, passed as rate_limit_args; lower numbers are sent first
+INTERACTIVE = 0
+SCHEDULED = 1
+PRIORITY_NAMES = ("interactive", "scheduled")
+
+MAX_MESSAGE_LENGTH = 4096
+# Markup and entities belong to one text, messages carrying them are never merged
+_UNMERGEABLE_FIELDS = ("reply_markup", "entities")
+
+
+async def reply_texts(message, texts):
+    """Send texts as consecutive replies to a message.
+
+    With an OutboundScheduler they are queued at once, in order, so they go out coalesced
+    into as few messages as possible; otherwise they are sent one after the other.
+    """
+    if isinstance(getattr(message.get_bot(), "rate_limiter", None), OutboundScheduler):
+        return await asyncio.gather(*(message.reply_text(text) for text in texts))
+    return [await message.reply_text(text) for text in texts]
+
+
+class TokenBucket:
+    """Allows rate events per second on average and bursts of up to burst events"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until the next event is allowed, 0 if it is allowed now"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Send:
+    """One queued Bot API request, and the callers waiting for its result"""
+    __slots__ = ("callback", "endpoint", "data", "kwargs", "priority", "queued_at", "futures")
+
+    def __init__(self, callback, endpoint, data, kwargs, priority, future):
+        self.callback = callback
+        self.endpoint = endpoint
+        self.data = data
+        self.kwargs = kwargs
+        self.priority = priority
+        self.queued_at = time.monotonic()
+        self.futures = [future]
+
+    def merge(self, endpoint, data, future):
+        """Append a plain text message to this one if both fit in one message"""
+        if endpoint != "sendMessage" or self.endpoint != "sendMessage":
+            return False
+        if any(data.get(field) or self.data.get(field) for field in _UNMERGEABLE_FIELDS):
+            return False
+        if {k: v for k, v in data.items() if k != "text"} != {k: v for k, v in self.data.items() if k != "text"}:
+            return False
+        text = f"{self.data['text']}\n\n{data['text']}"
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        self.data = dict(self.data, text=text)
+        self.futures.append(future)
+        return True
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Rate limiter every Bot API request of the application goes through.
+
+    Requests to a chat wait in a queue per priority class and chat. A worker sends them
+    highest priority first, round robin over chats, within one token bucket for the whole
+    bot and one per chat. Plain text messages queued for the same chat are coalesced into
+    one message. Scheduled sends leave interactive_reserve tokens of the bot's bucket
+    untouched, so replies never queue behind a broadcast. On a flood wait every send
+    pauses, and the request is tried again.
+    """
+
+    def __init__(self, rate=30.0, burst=30, chat_rate=1.0, chat_burst=3, group_rate=20 / 60,
+                 interactive_reserve=5, max_retries=2):
+        self.rate = rate
+        self.burst = burst
+        self.interactive_reserve = interactive_reserve
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._queues = [OrderedDict() for _ in PRIORITY_NAMES]  # chat_id -> deque of _Send
+        self._bucket = None
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._worker = None
+        self._in_flight = set()
+        OUTBOUND_QUEUE.function = self.queue_depths
+
+    def queue_depths(self):
+        return {
+            (name,): sum(len(queue) for queue in chats.values())
+            for name, chats in zip(PRIORITY_NAMES, self._queues)
+        }
+
+    async def initialize(self):
+        self._bucket = TokenBucket(self.rate, self.burst, time.monotonic())
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+        for chats in self._queues:
+            for queue in chats.values():
+                for send in queue:
+                    for future in send.futures:
+                        future.cancel()
+            chats.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._worker is None:
+            # Inline query and button answers, webhook setup: nothing to pace per chat
+            return await self._call(callback, endpoint, data, kwargs)
+
+        priority = INTERACTIVE if rate_limit_args is None else rate_limit_args
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues[priority].setdefault(chat_id, deque())
+        if queue and queue[-1].merge(endpoint, data, future):
+            OUTBOUND_MESSAGES.inc(priority=PRIORITY_NAMES[priority], result="coalesced")
+        else:
+            queue.append(_Send(callback, endpoint, data, kwargs, priority, future))
+        self._wakeup.set()
+        return await future
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Groups and channels (negative IDs or @usernames) allow fewer messages per minute
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst, now)
+        return bucket
+
+    def _next_send(self, now):
+        """Pop the request to send now, or return (None, seconds until one could be sent)"""
+        if not any(self._queues):
+            return None, None
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        delay = self._bucket.delay(now)
+        if delay:
+            return None, delay
+
+        earliest = None
+        for priority, chats in enumerate(self._queues):
+            if priority > INTERACTIVE and chats and self._bucket.tokens < 1 + self.interactive_reserve:
+                delay = (1 + self.interactive_reserve - self._bucket.tokens) / self.rate
+                earliest = delay if earliest is None else min(earliest, delay)
+                break
+            for chat_id, queue in chats.items():
+                bucket = self._chat_bucket(chat_id, now)
+                delay = bucket.delay(now)
+                if delay:
+                    earliest = delay if earliest is None else min(earliest, delay)
+                    continue
+                send = queue.popleft()
+                if queue:
+                    chats.move_to_end(chat_id)  # Round robin: other chats go first next time
+                else:
+                    del chats[chat_id]
+                bucket.take(now)
+                self._bucket.take(now)
+                self._chat_buckets.move_to_end(chat_id)
+                # Buckets of chats idle long enough to be full again carry no state
+                while len(self._chat_buckets) > 1:
+                    oldest_id, oldest = next(iter(self._chat_buckets.items()))
+                    if any(oldest_id in queued for queued in self._queues) or not oldest.is_full(now):
+                        break
+                    del self._chat_buckets[oldest_id]
+                return send, None
+        return None, earliest
+
+    async def _run(self):
+        while True:
+            send, delay = self._next_send(time.monotonic())
+            if send is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if all(future.done() for future in send.futures):
+                continue  # Every caller gave up waiting
+            task = asyncio.create_task(self._dispatch(send))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, send):
+        priority = PRIORITY_NAMES[send.priority]
+        OUTBOUND_WAIT.observe(time.monotonic() - send.queued_at, priority=priority)
+        try:
+            result = await self._call(send.callback, send.endpoint, send.data, send.kwargs)
+        except Exception as e:
+            OUTBOUND_MESSAGES.inc(priority=priority, result="failed")
+            for future in send.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        OUTBOUND_MESSAGES.inc(priority=priority, result="sent")
+        for future in send.futures:
+            if not future.done():
+                future.set_result(result)
+
+    async def _call(self, callback, endpoint, data, kwargs):
+        for attempt in itertools.count():
+            try:
+                return await callback(endpoint, data, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                TELEGRAM_API_RETRIES.inc(method=endpoint)
+                # A flood wait applies to the whole bot, so every queued send waits it out
+                logger.warning(f"Flood wait of {e.retry_after}s on {endpoint}, pausing outbound sends")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                await asyncio.sleep(e.retry_after)
@@ -0,0 +1,141 @@
+import functools
+import itertools
+import logging
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+MAX_STACK_DEPTH = 40
+TOP_STACKS = 30
+
+
+def describe_update(update):
+    """Return the command (or update kind) an update is for, used to tag profiles"""
+    message = getattr(update, "effective_message", None)
+    text = getattr(message, "text", None) or ""
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0]
+    if getattr(update, "callback_query", None):
+        return "callback_query"
+    if getattr(update, "inline_query", None):
+        return "inline_query"
+    return "message" if text else "other"
+
+
+def _collapse_stack(frame):
+    """Format a frame's stack as 'file:function:line' entries from root to leaf"""
+    entries = []
+    while frame is not None and len(entries) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        entries.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(entries))
+
+
+class UpdateProfiler:
+    """Times every update end to end and keeps stack samples of the slow ones.
+
+    While updates are in flight a background thread samples the event loop thread's
+    stack. Updates run concurrently on the same loop, so a sample is attributed to every
+    update in flight at that moment; the stacks belonging to the slow update still stand
+    out because they are the ones that repeat. Updates slower than ``threshold_ms`` get
+    their collapsed stacks stored in a ring buffer of the last ``ring_size`` profiles.
+    """
+
+    def __init__(self, threshold_ms=1000, sample_interval_ms=5, ring_size=20, user_buckets=64):
+        self.threshold = threshold_ms / 1000
+        self.sample_interval = sample_interval_ms / 1000
+        self.user_buckets = user_buckets
+        self.profiles = deque(maxlen=ring_size)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._loop_thread_id = None
+        self._sampling = False
+        self._tokens = itertools.count()
+
+    def install(self, application):
+        """Wrap application.process_update so it runs ahead of all handlers"""
+        process_update = application.process_update
+
+        @functools.wraps(process_update)
+        async def profiled_process_update(update):
+            token = self._begin()
+            try:
+                await process_update(update)
+            finally:
+                self._finish(token, update)
+
+        application.process_update = profiled_process_update
+
+    def user_bucket(self, update):
+        """Stable bucket of the update's user, so profiles don't carry raw user IDs"""
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            return None
+        return zlib.crc32(str(user.id).encode()) % self.user_buckets
+
+    def _begin(self):
+        self._loop_thread_id = threading.get_ident()
+        token = next(self._tokens)
+        with self._lock:
+            self._in_flight[token] = (time.perf_counter(), Counter())
+            start_sampler = not self._sampling
+            self._sampling = True
+        if start_sampler:
+            threading.Thread(target=self._sample_loop, name="update-profiler", daemon=True).start()
+        return token
+
+    def _finish(self, token, update):
+        with self._lock:
+            started, samples = self._in_flight.pop(token)
+        duration = time.perf_counter() - started
+        if duration < self.threshold:
+            return
+
+        profile = {
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "command": describe_update(update),
+            "user_bucket": self.user_bucket(update),
+            "duration_ms": round(duration * 1000, 1),
+            "samples": sum(samples.values()),
+            "stacks": samples.most_common(TOP_STACKS),
+        }
+        self.profiles.append(profile)
+        logger.warning(
+            f"Slow update {profile['command']} (user bucket {profile['user_bucket']}) "
+            f"took {profile['duration_ms']} ms, profile recorded"
+        )
+
+    def _sample_loop(self):
+        # Exits once nothing is in flight, _begin starts a new thread when needed
+        while True:
+            time.sleep(self.sample_interval)
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = _collapse_stack(frame) if frame is not None else None
+            with self._lock:
+                if not self._in_flight:
+                    self._sampling = False
+                    return
+                if stack is not None:
+                    for _, samples in self._in_flight.values():
+                        samples[stack] += 1
+
+    def dump(self):
+        """Format the recorded profiles, most recent first, as text"""
+        if not self.profiles:
+            return "No slow updates recorded.\n"
+        lines = []
+        for profile in reversed(self.profiles):
+            lines.append(
+                f"== {profile['recorded_at']} {profile['command']} user bucket {profile['user_bucket']} "
+                f"{profile['duration_ms']} ms ({profile['samples']} samples)"
+            )
+            for stack, count in profile["stacks"]:
+                lines.append(f"{count:>6} {stack}")
+            lines.append("")
+        return "\n".join(lines) + "\n"
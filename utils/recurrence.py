@@ -0,0 +1,93 @@
+from datetime import datetime, time, timedelta
+
+from apscheduler.triggers.cron import CronTrigger
+
+DAY_NAMES = {
+    "senin": "mon",
+    "selasa": "tue",
+    "rabu": "wed",
+    "kamis": "thu",
+    "jumat": "fri",
+    "sabtu": "sat",
+    "minggu": "sun",
+}
+
+# Catch-up after downtime never creates more than this many expenses for one rule
+MAX_CATCH_UP_RUNS = 366
+
+_triggers = {}
+
+
+def _trigger(schedule):
+    """CronTrigger for a 'day month day_of_week' schedule, raises ValueError if it is invalid"""
+    trigger = _triggers.get(schedule)
+    if trigger is None:
+        fields = schedule.split()
+        if len(fields) != 3:
+            raise ValueError("A schedule has three fields: day month day_of_week")
+        day, month, day_of_week = fields
+        # Only dates matter, UTC midnight avoids daylight saving gaps
+        trigger = CronTrigger(day=day, month=month, day_of_week=day_of_week, hour=0, minute=0, timezone="UTC")
+        _triggers[schedule] = trigger
+    return trigger
+
+
+def parse_schedule(text):
+    """Turn a /rutin schedule into a 'day month day_of_week' cron expression.
+
+    Accepts 'harian', a day name (weekly), a day of the month 1-31 or 'akhir' (monthly),
+    or three cron fields such as '1,15 * *'. Returns (schedule, error).
+    """
+    text = text.strip().lower()
+    if text == "harian":
+        schedule = "* * *"
+    elif text in DAY_NAMES:
+        schedule = f"* * {DAY_NAMES[text]}"
+    elif text == "akhir":
+        schedule = "last * *"
+    elif text.isdigit():
+        schedule = f"{int(text)} * *"
+    else:
+        schedule = " ".join(text.split())
+    try:
+        _trigger(schedule)
+    except ValueError as e:
+        return None, f"Jadwal tidak valid: {text} ({str(e)})"
+    if next_occurrence(schedule, datetime.now().date()) is None:
+        return None, f"Jadwal tidak pernah jatuh tempo: {text}"
+    return schedule, None
+
+
+def describe_schedule(schedule):
+    """Readable form of a schedule for messages"""
+    day, month, day_of_week = schedule.split()
+    if month == "*" and day_of_week == "*":
+        if day == "*":
+            return "setiap hari"
+        if day == "last":
+            return "setiap akhir bulan"
+        if day.isdigit():
+            return f"setiap tanggal {day}"
+    if day == "*" and month == "*":
+        names = {value: key for key, value in DAY_NAMES.items()}
+        if day_of_week in names:
+            return f"setiap hari {names[day_of_week].capitalize()}"
+    return f"cron {schedule}"
+
+
+def next_occurrence(schedule, after):
+    """First date strictly after `after` that matches the schedule, None if there is none"""
+    trigger = _trigger(schedule)
+    start = datetime.combine(after + timedelta(days=1), time(), tzinfo=trigger.timezone)
+    fire_time = trigger.get_next_fire_time(None, start)
+    return fire_time.date() if fire_time else None
+
+
+def due_dates(schedule, first_due, until):
+    """Every run date from first_due (a date matching the schedule) up to and including until"""
+    dates = []
+    run = first_due
+    while run is not None and run <= until and len(dates) < MAX_CATCH_UP_RUNS:
+        dates.append(run)
+        run = next_occurrence(schedule, run)
+    return dates
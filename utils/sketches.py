@@ -0,0 +1,136 @@
+import hashlib
+import json
+import math
+
+import numpy as np
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """Approximate count of distinct values in 2**precision bytes.
+
+    The standard error is about 1.04 / sqrt(2**precision), 1.6% at the default precision.
+    Two sketches of the same precision merge into the sketch of the union of their values.
+    """
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, value):
+        hashed = _hash64(value)
+        rest_bits = 64 - self.precision
+        rest = hashed & ((1 << rest_bits) - 1)
+        # Position of the leftmost 1 bit of what is left after the register index
+        rank = rest_bits - rest.bit_length() + 1
+        index = hashed >> rest_bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precision")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.exp2(-self.registers.astype(np.float64)).sum()
+        empty = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * size and empty:
+            # Linear counting is more accurate while many registers are still empty
+            estimate = size * math.log(size / empty)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], np.frombuffer(data, dtype=np.uint8, offset=1).copy())
+
+
+class DDSketch:
+    """Quantiles of positive values within a relative error, plus their exact count and sum.
+
+    Values are counted in logarithmic buckets, bucket i holding (gamma**(i-1), gamma**i], so
+    any quantile is off by at most relative_accuracy. Amounts from 1 to 10**12 fit in about
+    1400 buckets at 1%. Sketches of the same accuracy merge by adding bucket counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}  # bucket index -> count
+        self.zero_count = 0  # Values <= 0 are counted apart from the buckets
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        if value > 0:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge DDSketches of different accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """The value at quantile q (0-1), None when the sketch is empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return min(self.max, 0.0)
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                break
+        # The middle of the bucket, relative to its bounds, is within relative_accuracy of both
+        value = 2 * self.gamma ** index / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+
+    def to_bytes(self):
+        return json.dumps({
+            "accuracy": self.relative_accuracy,
+            "bins": sorted(self.bins.items()),
+            "zero": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }).encode()
+
+    @classmethod
+    def from_bytes(cls, data):
+        state = json.loads(data)
+        sketch = cls(state["accuracy"])
+        sketch.bins = {index: count for index, count in state["bins"]}
+        sketch.zero_count = state["zero"]
+        sketch.count = state["count"]
+        sketch.sum = state["sum"]
+        if sketch.count:
+            sketch.min, sketch.max = state["min"], state["max"]
+        return sketch
@@ -1,6 +1,43 @@
 import re
 from decimal import Decimal, InvalidOperation
 from datetime import datetime
+from config import CURRENCY_SYMBOLS
+
+
+# "25000", "25.000", "Rp 25.000,50", "25rb", "15k", "1,5jt": dots/commas followed by three
+# digits group thousands, a trailing one or two digits are the fraction
+AMOUNT_PATTERN = (
+    r"(?:rp\.?\s*)?"
+    r"(?P<number>\d{1,3}(?:[.,]\d{3})+|\d+)"
+    r"(?:[.,](?P<fraction>\d{1,2}))?"
+    r"\s*(?P<unit>rb|ribu|k|jt|juta)?"
+)
+# An expense amount may end with a currency code: "12.5usd", "40 sgd"
+MONEY_PATTERN = AMOUNT_PATTERN + rf"(?:\s*(?P<currency>{'|'.join(CURRENCY_SYMBOLS)})\b)?"
+AMOUNT_RE = re.compile(rf"^\s*{AMOUNT_PATTERN}\s*$", re.IGNORECASE)
+MONEY_RE = re.compile(rf"^\s*{MONEY_PATTERN}\s*$", re.IGNORECASE)
+EXPENSE_LINE_RE = re.compile(
+    rf"^\s*{MONEY_PATTERN}\s+(?P<category>\S+)(?:\s+(?P<description>.+?))?\s*$",
+    re.IGNORECASE,
+)
+
+UNIT_MULTIPLIERS = {
+    None: 1,
+    "rb": 1000,
+    "ribu": 1000,
+    "k": 1000,
+    "jt": 1000000,
+    "juta": 1000000,
+}
+
+
+def _amount_from_match(match):
+    """Build the Decimal amount from the groups of an AMOUNT_PATTERN match"""
+    number = match.group("number").replace(".", "").replace(",", "")
+    if match.group("fraction"):
+        number = f"{number}.{match.group('fraction')}"
+    multiplier = UNIT_MULTIPLIERS[(match.group("unit") or "").lower() or None]
+    return Decimal(number) * multiplier
 
 
 def validate_amount(amount_str):
@@ -8,16 +45,63 @@ def validate_amount(amount_str):
     if not amount_str:
         return None, "Amount is required"
     
-    # Remove currency symbols and formatting
-    cleaned_amount = re.sub(r'[Rp\s,.\(\)]', '', amount_str.strip())
+    match = AMOUNT_RE.match(amount_str)
+    if not match:
+        return None, f"Invalid amount format: {amount_str}"
     
-    try:
-        amount = Decimal(cleaned_amount)
+    amount = _amount_from_match(match)
+    if amount <= 0:
+        return None, "Amount must be greater than 0"
+    return amount, None
+
+
+def validate_money(money_str):
+    """Validate an amount with an optional currency code, returns (amount, currency, error)"""
+    if not money_str:
+        return None, None, "Amount is required"
+    
+    match = MONEY_RE.match(money_str)
+    if not match:
+        return None, None, f"Invalid amount format: {money_str}"
+    
+    amount = _amount_from_match(match)
+    if amount <= 0:
+        return None, None, "Amount must be greater than 0"
+    return amount, _currency_from_match(match), None
+
+
+def _currency_from_match(match):
+    """Upper-case currency code of a MONEY_PATTERN match, None when the amount has none"""
+    currency = match.group("currency")
+    return currency.upper() if currency else None
+
+
+def parse_expense_lines(text):
+    """Parse one expense per line ("25rb makan nasi padang", "12usd makan") in a single pass.
+
+    Returns (expenses, errors): expenses is a list of (amount, category, description, currency)
+    tuples, currency being None when the line has no code, and errors a list of (line number, message) for lines that could not be parsed.
+    """
+    expenses = []
+    errors = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        match = EXPENSE_LINE_RE.match(line)
+        if not match:
+            errors.append((line_number, f"Format tidak dikenali: {line.strip()}"))
+            continue
+        amount = _amount_from_match(match)
         if amount <= 0:
-            return None, "Amount must be greater than 0"
-        return amount, None
-    except InvalidOperation:
-        return None, f"Invalid amount format: {amount_str}"
+            errors.append((line_number, "Amount must be greater than 0"))
+            continue
+        category = match.group("category")
+        is_valid, error = validate_category(category)
+        if not is_valid:
+            errors.append((line_number, error))
+            continue
+        expenses.append((amount, category, match.group("description"), _currency_from_match(match)))
+    return expenses, errors
 
 
 def validate_category(category):